@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# dac_segmenter.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Splits a YM2612 DAC timeline into sample blocks that are each played by one ADPCM-B trigger
+#
+# Runs of silence_threshold or more equal samples are candidate gaps between blocks
+# The timeline only keeps runs of DACTimeline.RUN_THRESHOLD or more samples, so that's the lowest threshold allowed
+# These are found directly from the DACRuns in the timeline, so it's O(spans) rather than O(samples)
+#
+# Splitting at a short gap isn't always worth it: each block is padded to the alignment and needs its own trigger
+# Gaps shorter than merge_gap are only split if it reduces the total encoded size plus trigger_cost per block
+
+from ym2612_dac_state import DACRun
+from ym2612_dac_state import DACTimeline
+from ym2612_dac_state import DACSampleBlock
+
+class DACSegmenter:
+	# Length of DACCommandInserter.adpcmb_play_commands(), in bytes
+	TRIGGER_COMMANDS_LENGTH = 39
+
+	# Blocks considered for merging at a time, which bounds the cost of very fragmented timelines
+	MAX_MERGED_REGIONS = 64
+
+	def __init__(self, silence_threshold=512, min_block_length=0, merge_gap=0x1000, alignment=0x200,
+		trigger_cost=TRIGGER_COMMANDS_LENGTH, padding_byte=0x80):
+
+		# At least DACTimeline.RUN_THRESHOLD, shorter runs are stored as literal samples so they can't be found
+		if silence_threshold < DACTimeline.RUN_THRESHOLD:
+			raise ValueError("DAC silence threshold must be at least {:d} samples, got {:d}"
+				.format(DACTimeline.RUN_THRESHOLD, silence_threshold))
+
+		self.silence_threshold = silence_threshold
+		# Blocks shorter than this (before padding) are dropped
+		self.min_block_length = min_block_length
+		self.merge_gap = merge_gap
+		self.alignment = alignment
+		self.trigger_cost = trigger_cost
+		self.padding_byte = padding_byte
+
+	def key(self):
+		# Identifies the settings, for cache keys
+		return "{:d}:{:d}:{:d}:{:d}:{:d}:{:d}".format(self.silence_threshold, self.min_block_length,
+			self.merge_gap, self.alignment, self.trigger_cost, self.padding_byte)
+
+	def encoded_length(self, length):
+		# DeltaT length of a padded block (2 samples per byte)
+		padded_length = -(-length // self.alignment) * self.alignment
+		return padded_length // 2
+
+	def find_regions(self, timeline):
+		# (start, end) of each region between runs of silence
+		regions = []
+		region_start = 0
+
+		for (span, span_start) in zip(timeline.spans, timeline.span_starts):
+			if not isinstance(span, DACRun) or span.length < self.silence_threshold:
+				continue
+
+			if span_start > region_start:
+				regions.append((region_start, span_start))
+
+			region_start = span_start + span.length
+
+		if len(timeline) > region_start:
+			regions.append((region_start, len(timeline)))
+
+		return regions
+
+	def choose_blocks(self, regions):
+		# Chooses which consecutive regions are merged into one block, minimizing the total cost
+		# Returns (start, end) for each block
+		#
+		# best_costs[j] is the lowest cost of all regions before j, where a block ends right before region j
+		# Gaps of merge_gap or longer are always split, so the search restarts at each of them
+
+		best_costs = [0]
+		block_starts = []
+
+		for (index, (_, region_end)) in enumerate(regions):
+			best_cost = None
+			best_start = index
+
+			first_index = max(index - DACSegmenter.MAX_MERGED_REGIONS + 1, 0)
+			for start_index in range(index, first_index - 1, -1):
+				region_start = regions[start_index][0]
+
+				cost = best_costs[start_index] + self.encoded_length(region_end - region_start) + self.trigger_cost
+				if best_cost is None or cost < best_cost:
+					best_cost = cost
+					best_start = start_index
+
+				# Can this block be extended back over the previous gap?
+				if start_index == 0 or (region_start - regions[start_index - 1][1]) >= self.merge_gap:
+					break
+
+			best_costs.append(best_cost)
+			block_starts.append(best_start)
+
+		blocks = []
+		index = len(regions) - 1
+		while index >= 0:
+			start_index = block_starts[index]
+			blocks.append((regions[start_index][0], regions[index][1]))
+			index = start_index - 1
+
+		blocks.reverse()
+		return blocks
+
+	def partition(self, timeline):
+		blocks = []
+
+		for (start, end) in self.choose_blocks(self.find_regions(timeline)):
+			if (end - start) < self.min_block_length:
+				continue
+
+			block = DACSampleBlock()
+			block.timestamp = start
+			block.data = timeline.samples(start, end)
+
+			remainder = len(block.data) % self.alignment
+			if remainder > 0:
+				block.data.extend(bytes([self.padding_byte]) * (self.alignment - remainder))
+
+			blocks.append(block)
+
+		return blocks
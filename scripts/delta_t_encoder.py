@@ -7,48 +7,109 @@
 
 # Note this doesn't zero pad automatically
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sample_kernels import dac_to_s16
+
 class DeltaTEncoder:
 	STEP_SIZES = [
 		57, 57, 57, 57, 77, 102, 128, 153,
 		57, 57, 57, 57, 77, 102, 128, 153
 	]
 
+	MIN_STEP_SIZE = 127
+	MAX_STEP_SIZE = 24576
+
+	# Per step size: the quantized delta for each 3bit magnitude, followed by the next step size for each
+	# Only built for step sizes that are actually reached, which is a small subset of the full range
+	_step_tables = [None] * (MAX_STEP_SIZE + 1)
+
+	@classmethod
+	def step_table(cls, step_size):
+		table = cls._step_tables[step_size]
+		if table is None:
+			deltas = [(magnitude * 2 + 1) * step_size // 8 for magnitude in range(8)]
+			next_step_sizes = [
+				min(max((cls.STEP_SIZES[magnitude] * step_size) // 64, cls.MIN_STEP_SIZE), cls.MAX_STEP_SIZE)
+				for magnitude in range(8)
+			]
+
+			table = tuple(deltas + next_step_sizes)
+			cls._step_tables[step_size] = table
+
+		return table
+
 	def encode(self, pcm_s16):
-		encoded = bytearray()
+		# Produces the same output as the reference encoder:
+		# (abs(dn) << 16) // (step_size << 14) is reduced to (abs(dn) * 4) // step_size,
+		# the per-sample step size update is a table lookup and nibbles are packed in bulk at the end
+		step_tables = DeltaTEncoder._step_tables
+		step_table = DeltaTEncoder.step_table
+
+		codes = bytearray(len(pcm_s16))
 
 		xn = 0
-		step_size = 127
-		flag = 0
-		adpcm_pack = 0
+		step_size = DeltaTEncoder.MIN_STEP_SIZE
+		table = step_table(step_size)
 
-		for sample in pcm_s16:
+		for (index, sample) in enumerate(pcm_s16):
 			dn = sample - xn
-			i = (abs(dn) << 16) // (step_size << 14)
-			if i > 7:
-				i = 7
-			adpcm = i & 0xff
-
-			i = (adpcm * 2 + 1) * step_size // 8
-
 			if dn < 0:
-				adpcm |= 0x8
-				xn -= i
+				magnitude = (-dn * 4) // step_size
+				if magnitude > 7:
+					magnitude = 7
+
+				xn -= table[magnitude]
+				codes[index] = magnitude | 0x8
 			else:
-				xn += i
+				magnitude = (dn * 4) // step_size
+				if magnitude > 7:
+					magnitude = 7
 
-			step_size = (DeltaTEncoder.STEP_SIZES[adpcm] * step_size) // 64
+				xn += table[magnitude]
+				codes[index] = magnitude
 
-			if step_size < 127:
-				step_size = 127
-			elif step_size > 24576:
-				step_size = 24576
+			step_size = table[magnitude + 8]
+			table = step_tables[step_size] or step_table(step_size)
 
-			if flag == 0:
-				adpcm_pack = adpcm << 4
-				flag = 1
-			else:
-				adpcm_pack |= adpcm
-				encoded.append(adpcm_pack)
-				flag = 0
+		return DeltaTEncoder.pack_nibbles(codes)
+
+	@staticmethod
+	def pack_nibbles(codes):
+		# Pairs of 4bit codes -> bytes, first code in the high nibble
+		# A trailing unpaired code is dropped, as it is in the reference encoder
+		length = len(codes) // 2
+		if length == 0:
+			return bytearray()
+
+		high_nibbles = bytes(codes[0 : length * 2 : 2]).translate(_HIGH_NIBBLE)
+		low_nibbles = bytes(codes[1 : length * 2 : 2])
+
+		packed = int.from_bytes(high_nibbles, 'big') | int.from_bytes(low_nibbles, 'big')
+		return bytearray(packed.to_bytes(length, 'big'))
+
+_HIGH_NIBBLE = bytes((x << 4) & 0xff for x in range(0x100))
+
+# Blocks are independent (the encoder state starts over for each) so they can be encoded in parallel
+# Starting worker processes has a fixed cost, so small sets of blocks are always encoded serially
+
+PARALLEL_MIN_SAMPLES = 0x100000
+
+def encode_dac_samples(dac_samples):
+	# Unsigned 8bit DAC samples -> DeltaT
+	return DeltaTEncoder().encode(dac_to_s16(dac_samples))
+
+def encode_dac_sample_blocks(sample_blocks, jobs=None):
+	# Encodes each of sample_blocks (unsigned 8bit DAC samples), returning the results in the same order
+	# jobs defaults to the CPU count
+	jobs = jobs or os.cpu_count() or 1
+	total_samples = sum(len(samples) for samples in sample_blocks)
+
+	if jobs < 2 or len(sample_blocks) < 2 or total_samples < PARALLEL_MIN_SAMPLES:
+		return [encode_dac_samples(samples) for samples in sample_blocks]
 
-		return encoded
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		# Large chunks keep the per-task overhead low when there are many short blocks
+		chunk_size = max(len(sample_blocks) // (jobs * 4), 1)
+		return list(executor.map(encode_dac_samples, [bytes(samples) for samples in sample_blocks], chunksize=chunk_size))
@@ -7,90 +7,86 @@
 # SPDX-License-Identifier: MIT
 
 # Subset of OPN FM state required to do pitch adjustment
+#
+# Registers are dispatched through a table of all 512 addresses (port 1 is 0x100-0x1ff) built once
+# F-number conversion tables are built once for each (reference_clock, target_clock) and shared between OPNStates
+# Translated writes are emitted straight into the output as 0x58 / 0x59 commands
+
+# Register kinds in REGISTER_KINDS
+PASS_THROUGH = 0
+FILTERED = 1
+PITCH_HI = 2
+PITCH_LO = 3
+
+def build_register_tables():
+	kinds = bytearray([PASS_THROUGH]) * 0x200
+	pitch_indexes = bytearray(0x200)
+
+	# Filtering all DAC writes as they are handled externally
+	kinds[0x02a] = FILTERED
+	kinds[0x02b] = FILTERED
+
+	# This would filter out writes to FM CH6 key-on
+	# Attempts to key-on CH6 while DAC is playing might cause issues
+	# This shouldn't happen either way so it's left as a pass through for now
+
+	# Each lo register is followed by its hi register at +4
+	# Indexes 6-11 are the "2CH mode" registers
+	lo_addresses = [0x0a0, 0x0a1, 0x0a2, 0x1a0, 0x1a1, 0x1a2, 0x0a8, 0x0a9, 0x0aa, 0x1a8, 0x1a9, 0x1aa]
+	for (index, lo_address) in enumerate(lo_addresses):
+		kinds[lo_address] = PITCH_LO
+		kinds[lo_address + 4] = PITCH_HI
+		pitch_indexes[lo_address] = index
+		pitch_indexes[lo_address + 4] = index
+
+	return (kinds, pitch_indexes)
+
+REGISTER_KINDS, PITCH_INDEXES = build_register_tables()
+
+pitch_tables = {}
 
-class OPNWriteAction:
-	def __init__(self, address, data):
-		self.address = address
-		self.data = data
+def pitch_table(reference_clock, target_clock):
+	# Converted (hi, lo) F-number bytes for each 11bit F-number, excluding the block bits
+	key = (reference_clock, target_clock)
+	table = pitch_tables.get(key)
+	if table is None:
+		pitch_factor = (reference_clock << 32) // target_clock
+		pitches = [(f_number * pitch_factor) >> 32 for f_number in range(0x800)]
+
+		hi_table = bytes((pitch >> 8) & 0x07 for pitch in pitches)
+		lo_table = bytes(pitch & 0xff for pitch in pitches)
+		table = pitch_tables[key] = (hi_table, lo_table)
+
+	return table
 
 class OPNState:
 	def __init__(self, reference_clock=7670400, target_clock=8000000):
 		self.reference_clock = reference_clock
 		self.target_clock = target_clock
-		self.pitch_factor = (reference_clock << 32) // target_clock
+		(self.pitch_hi_table, self.pitch_lo_table) = pitch_table(reference_clock, target_clock)
 		self.pitches = [0] * 12
 
-	def write(self, address, data):
-		hi_address_map = {
-			0x0a4: 0,
-			0x0a5: 1,
-			0x0a6: 2,
-			0x1a4: 3,
-			0x1a5: 4,
-			0x1a6: 5,
-			# "2CH mode"
-			0x0ac: 6,
-			0x0ad: 7,
-			0x0ae: 8,
-			0x1ac: 9,
-			0x1ad: 10,
-			0x1ae: 11
-		}
-
-		lo_address_map = {
-			0x0a0: 0,
-			0x0a1: 1,
-			0x0a2: 2,
-			0x1a0: 3,
-			0x1a1: 4,
-			0x1a2: 5,
-			# "2CH mode"
-			0x0a8: 6,
-			0x0a9: 7,
-			0x0aa: 8,
-			0x1a8: 9,
-			0x1a9: 10,
-			0x1aa: 11
-		}
-
-		# Filtering all DAC writes as they are handled externally
-		if address in [0x02a, 0x02b]:
-			return []
-
-		# This would filter out writes to FM CH6 key-on
-		# Attempts to key-on CH6 while DAC is playing might cause issues
-		# This shouldn't happen either way so it's commented out for now
-		
-		# if address == 0x28:
-		# 	if (data & 0x7) == 6:
-		# 		print("Filtering CH6.. ")
-		# 		return []
-
-		index = hi_address_map.get(address, None)
-		if index is not None:
-			self.pitches[index] = data
-			# Deferring hi write until lo is written
-			return []
-
-		index = lo_address_map.get(address, None)
-		if index is None:
-			# Pass through original write command
-			return [OPNWriteAction(address, data)]
+	def write(self, output, register_file, address, data):
+		# Appends the translated write(s) to output and tracks them in register_file
+		kind = REGISTER_KINDS[address]
 
-		# Adjust pitch
-
-		lo_pitch_address = address
-		hi_pitch_address = address + 4
-
-		hi_data = self.pitches[index]
-
-		pitch = ((hi_data & 0x07) << 8) | data
-		pitch = (pitch * self.pitch_factor) >> 32
+		if kind == PASS_THROUGH:
+			output.extend((0x59 if address >= 0x100 else 0x58, address & 0xff, data))
+			register_file.write(address, data)
+		elif kind == PITCH_HI:
+			# Deferring hi write until lo is written
+			self.pitches[PITCH_INDEXES[address]] = data
+		elif kind == PITCH_LO:
+			# Adjust pitch
+			hi_data = self.pitches[PITCH_INDEXES[address]]
+			f_number = ((hi_data & 0x07) << 8) | data
 
-		block = hi_data & 0xf8
+			hi_address = address + 4
+			hi_pitch = self.pitch_hi_table[f_number] | (hi_data & 0xf8)
+			lo_pitch = self.pitch_lo_table[f_number]
 
-		return [
 			# Hi write must come first
-			OPNWriteAction(hi_pitch_address, ((pitch >> 8) & 0x07) | block),
-			OPNWriteAction(lo_pitch_address, pitch & 0xff)
-		]
+			write_cmd = 0x59 if address >= 0x100 else 0x58
+			output.extend((write_cmd, hi_address & 0xff, hi_pitch, write_cmd, address & 0xff, lo_pitch))
+			register_file.write(hi_address, hi_pitch)
+			register_file.write(address, lo_pitch)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# pcm_packer.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Lays out ADPCM-A/B PCM blocks in PSRAM
+#
+# Tracks address their samples using bank bytes (address bits 16-23), which are remapped to match the new layout
+# Only the bank byte is rewritten, so blocks can only move by multiples of 64KB
+# All blocks that share an original 64KB bank must also move together, these are packed as one group
+# Blocks that touch across a bank boundary are also kept in one group, since a sample can span both of them
+#
+# A group can share a 64KB bank with other groups as long as the used regions within it don't overlap
+# Blocks also can't cross a 1MB boundary after moving, unless they already did and move in 1MB steps
+#
+# Groups are placed largest first, each at the lowest bank where it fits (first fit decreasing)
+
+import sys
+import bisect
+
+from vgm_profile import log
+
+BANK_SIZE = 0x10000
+REGION_SIZE = 0x100000
+
+# 8MB of PSRAM
+ADDRESS_SPACE_BANKS = 0x80
+
+class PCMBankGroup:
+	def __init__(self, space, blocks):
+		self.space = space
+		self.blocks = blocks
+		self.first_bank = blocks[0].offset // BANK_SIZE
+		self.last_bank = max((block.offset + len(block.data) - 1) // BANK_SIZE for block in blocks)
+		# Bank shift applied to all blocks, assigned when placed
+		self.bank_shift = 0
+
+		# Used byte ranges, merged where they overlap or touch
+		self.ranges = []
+		for block in blocks:
+			start = block.offset
+			end = start + len(block.data)
+
+			if self.ranges and start <= self.ranges[-1][1]:
+				self.ranges[-1][1] = max(self.ranges[-1][1], end)
+			else:
+				self.ranges.append([start, end])
+
+	def size(self):
+		return sum(end - start for (start, end) in self.ranges)
+
+	def shift_allowed(self, bank_shift):
+		shift = bank_shift * BANK_SIZE
+		for block in self.blocks:
+			start = block.offset
+			end = start + len(block.data) - 1
+
+			# Blocks that already crossed a boundary can only keep crossing if the samples in them keep their alignment
+			crosses_region = (start // REGION_SIZE) != (end // REGION_SIZE)
+			new_crosses_region = ((start + shift) // REGION_SIZE) != ((end + shift) // REGION_SIZE)
+			if new_crosses_region and not (crosses_region and shift % REGION_SIZE == 0):
+				return False
+
+		return True
+
+class PCMIntervalIndex:
+	# (start, end) intervals sorted by start, for overlap checks and address lookups in O(log n)
+	def __init__(self, intervals):
+		self.intervals = sorted(intervals)
+		self.starts = [start for (start, _) in self.intervals]
+
+	def has_overlap(self):
+		# Sorted by start, so it's enough to compare each start with the furthest end before it
+		furthest_end = None
+		for (start, end) in self.intervals:
+			if furthest_end is not None and start < furthest_end:
+				return True
+
+			furthest_end = end if furthest_end is None else max(furthest_end, end)
+
+		return False
+
+	def find(self, address):
+		# Index of the last interval starting at or before address that contains it, or None
+		index = bisect.bisect_right(self.starts, address) - 1
+		if index >= 0 and address < self.intervals[index][1]:
+			return index
+
+		return None
+
+class PCMLayoutOccupancy:
+	# Sorted, non-overlapping (start, end) ranges that are already in use
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+
+	def is_free(self, start, end):
+		index = bisect.bisect_right(self.starts, start)
+		if index > 0 and self.ends[index - 1] > start:
+			return False
+
+		return index == len(self.starts) or self.starts[index] >= end
+
+	def add(self, start, end):
+		index = bisect.bisect_right(self.starts, start)
+		self.starts.insert(index, start)
+		self.ends.insert(index, end)
+
+class PCMPacker:
+	def __init__(self, address_space_banks=ADDRESS_SPACE_BANKS):
+		self.address_space_banks = address_space_banks
+		self.groups = []
+
+	def add_space(self, space, blocks):
+		# Blocks in one address space (unified PCM has one space, otherwise ADPCM-A and B have their own)
+		# Bank bytes are remapped separately for each space
+		current_blocks = []
+		current_last_bank = None
+		current_end = None
+
+		for block in sorted(blocks, key=lambda block: block.offset):
+			first_bank = block.offset // BANK_SIZE
+			end = block.offset + len(block.data)
+			last_bank = (end - 1) // BANK_SIZE
+
+			if current_blocks and first_bank > current_last_bank and block.offset > current_end:
+				self.groups.append(PCMBankGroup(space, current_blocks))
+				current_blocks = []
+
+			if current_blocks:
+				current_last_bank = max(current_last_bank, last_bank)
+				current_end = max(current_end, end)
+			else:
+				current_last_bank = last_bank
+				current_end = end
+
+			current_blocks.append(block)
+
+		if current_blocks:
+			self.groups.append(PCMBankGroup(space, current_blocks))
+
+	def pack(self):
+		occupancy = PCMLayoutOccupancy()
+
+		for group in sorted(self.groups, key=lambda group: (-group.size(), group.first_bank)):
+			group_banks = group.last_bank - group.first_bank + 1
+
+			for new_first_bank in range(0, self.address_space_banks - group_banks + 1):
+				bank_shift = new_first_bank - group.first_bank
+				if not group.shift_allowed(bank_shift):
+					continue
+
+				shift = bank_shift * BANK_SIZE
+				if all(occupancy.is_free(start + shift, end + shift) for (start, end) in group.ranges):
+					break
+			else:
+				log.error("PCMPacker: couldn't fit PCM bank group at {:X}", group.first_bank * BANK_SIZE)
+				sys.exit(1)
+
+			group.bank_shift = bank_shift
+			for (start, end) in group.ranges:
+				occupancy.add(start + shift, end + shift)
+
+			for block in group.blocks:
+				block.remapped_offset = block.offset + shift
+
+		self.check_layout()
+		self.print_report(occupancy)
+
+	def check_layout(self):
+		# Blocks that touch or overlap must have kept their relative positions, or samples spanning them are split
+		for space in set(group.space for group in self.groups):
+			blocks = sorted(((block, group.bank_shift) for group in self.groups if group.space == space
+				for block in group.blocks), key=lambda pair: pair[0].offset)
+
+			furthest_end = None
+			for (block, bank_shift) in blocks:
+				if furthest_end is not None and block.offset <= furthest_end and bank_shift != furthest_shift:
+					log.error("PCMPacker: PCM block at {:X} was moved apart from the block before it", block.offset)
+					sys.exit(1)
+
+				end = block.offset + len(block.data)
+				if furthest_end is None or end > furthest_end:
+					furthest_end = end
+					furthest_shift = bank_shift
+
+	def bank_remap_table(self, space):
+		# Original bank byte -> remapped bank byte, for every possible bank byte in one address space
+		# Returns the table and a list of which bank bytes had no PCM data (these are left as they are)
+		table = bytearray(range(0x100))
+		mapped = bytearray(0x100)
+
+		for group in self.groups:
+			if group.space != space:
+				continue
+
+			for bank in range(group.first_bank, min(group.last_bank, 0xff) + 1):
+				table[bank] = bank + group.bank_shift
+				mapped[bank] = 1
+
+		return (table, mapped)
+
+	def print_report(self, occupancy):
+		used = sum(end - start for (start, end) in zip(occupancy.starts, occupancy.ends))
+		span = occupancy.ends[-1] if occupancy.ends else 0
+
+		gaps = 0
+		previous_end = 0
+		for (start, end) in zip(occupancy.starts, occupancy.ends):
+			if start > previous_end:
+				gaps += 1
+			previous_end = end
+
+		utilization = used / span * 100 if span > 0 else 100
+		log.info("PCM layout: {:X} bytes used, {:X} bytes span, {:d} bank groups", used, span, len(self.groups))
+		log.info("PCM layout: utilization {:.1f}%, fragmentation {:.1f}% in {:d} gaps",
+			utilization, 100 - utilization, gaps)
@@ -10,33 +10,55 @@
 # It's translated to approximate SSG commands
 #
 # It's incomplete and doesn't support repurposing one of three channels for noise
+#
+# Tone period conversion tables are built once for each (reference_clock, target_clock) and shared
+# Translated writes are emitted straight into the output as 0x58 commands
+
+from vgm_profile import log
+
+pitch_tables = {}
+
+def pitch_table(reference_clock, target_clock):
+	# Converted (lo, hi) SSG tone period bytes for each 10bit PSG tone period
+	key = (reference_clock, target_clock)
+	table = pitch_tables.get(key)
+	if table is None:
+		pitch_factor = (target_clock << 32) // reference_clock // 2
+		pitches = [(period * pitch_factor) >> 32 for period in range(0x400)]
 
-class SSGWriteAction:
-	def __init__(self, address, data):
-		self.address = address
-		self.data = data
+		lo_table = bytes(pitch & 0xff for pitch in pitches)
+		hi_table = bytes(pitch >> 8 for pitch in pitches)
+		table = pitch_tables[key] = (lo_table, hi_table)
+
+	return table
 
 class PSGState:
 	def __init__(self, reference_clock=3579545, target_clock=8000000):
 		self.reference_clock = reference_clock
 		self.target_clock = target_clock
-		self.pitch_factor = (target_clock << 32) // reference_clock // 2
+		(self.pitch_lo_table, self.pitch_hi_table) = pitch_table(reference_clock, target_clock)
 
 		self.pitches = [0] * 3
 		self.previous_reg = 0
+		self.noise_ignored = False
 
-	def write(self, data):
+	def write(self, output, register_file, data):
+		# Appends the translated SSG write(s) to output and tracks them in register_file
 		if data & 0x80:
-			return self.latch_write(data & 0x7f)
+			self.latch_write(output, register_file, data & 0x7f)
 		else:
-			return self.data_write(data & 0x7f)
+			self.data_write(output, register_file, data & 0x7f)
 
-	def preamble(self):
+	def preamble(self, output, register_file):
 		# Enable all 3 voices as square waves, not noise
 		# This would change if noise support is added
-		return [SSGWriteAction(0x007, ~0x07 & 0xff)]
+		self.write_ssg(output, register_file, 0x007, ~0x07 & 0xff)
+
+	def write_ssg(self, output, register_file, address, data):
+		output.extend((0x58, address, data))
+		register_file.write(address, data)
 
-	def latch_write(self, combined):
+	def latch_write(self, output, register_file, combined):
 		reg = (combined >> 4) & 0x07
 		data = combined & 0x0f
 
@@ -50,25 +72,28 @@ class PSGState:
 
 			if is_volume:
 				# Volume writes don't need deferring
-				return [SSGWriteAction(0x008 + ch, ~data & 0x0f)]
+				self.write_ssg(output, register_file, 0x008 + ch, ~data & 0x0f)
 			else:
 				# Deferring write until high portion of pitch is known
 				self.pitches[ch] = data
-				return []
 		else:
 			# Noise control
 			# (not implemented for now, would need to "steal" one of three SSG voices for this)
-			print("PSG: Ignoring noise control write (TODO) ")
-			return []
+			# Only reported once per track since there can be a lot of these
+			if not self.noise_ignored:
+				log.warning("PSG: Ignoring noise control writes (TODO)")
+				self.noise_ignored = True
 
-	def data_write(self, combined):
+	def data_write(self, output, register_file, combined):
 		data = combined & 0x3f
 		ch = self.previous_reg // 2
 
 		self.pitches[ch] |= data << 4
-		pitch = (self.pitches[ch] * self.pitch_factor) >> 32
+		period = self.pitches[ch]
+
+		lo_pitch = self.pitch_lo_table[period]
+		hi_pitch = self.pitch_hi_table[period]
 
-		return [
-			SSGWriteAction(0x000 + ch * 2, pitch & 0xff),
-			SSGWriteAction(0x001 + ch * 2, pitch >> 8)
-		]
+		output.extend((0x58, ch * 2, lo_pitch, 0x58, ch * 2 + 1, hi_pitch))
+		register_file.write(ch * 2, lo_pitch)
+		register_file.write(ch * 2 + 1, hi_pitch)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# psram_pool.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Host side model of the PCM data held in the board's PSRAM, so PCM blocks shared between tracks are only uploaded once
+#
+# The pool is a list of regions, each a run of 64KB banks holding one bank group with a hash of its contents
+# Before a track is played, each of its bank groups (see pcm_packer.py) is looked up by content:
+# Resident groups are used where they are, the rest are placed in free banks
+# If there's no room, the least recently used regions that aren't part of this track are evicted
+# The track's bank bytes are then remapped to where its groups ended up, so only the missing groups are uploaded
+#
+# Tracks from the same soundtrack usually share the same sample ROM, so switching between them uploads no PCM at all
+#
+# The model is only valid while the board keeps its PSRAM contents, so it's tied to the USB device address
+# (a reset or replug re-enumerates the board with a new address)
+
+import json
+import hashlib
+
+from pcm_packer import PCMPacker
+from pcm_packer import BANK_SIZE
+from pcm_packer import ADDRESS_SPACE_BANKS
+from vgm_profile import log
+
+class PSRAMRegion:
+	def __init__(self, first_bank, last_bank, digest, last_used=0):
+		self.first_bank = first_bank
+		self.last_bank = last_bank
+		self.digest = digest
+		self.last_used = last_used
+
+	def banks(self):
+		return range(self.first_bank, self.last_bank + 1)
+
+class PoolBlock:
+	# A PCMBlock as it is currently laid out, so bank groups can be formed from remapped offsets
+	def __init__(self, block):
+		self.block = block
+		self.offset = block.remapped_offset
+		self.data = block.data
+
+def group_digest(group):
+	# Hash of the group's contents and where they are relative to its first bank
+	digest = hashlib.sha256()
+	group_start = group.first_bank * BANK_SIZE
+
+	for pool_block in group.blocks:
+		digest.update((pool_block.offset - group_start).to_bytes(4, 'little'))
+		digest.update(len(pool_block.data).to_bytes(4, 'little'))
+		digest.update(pool_block.data)
+
+	digest.update((group.last_bank - group.first_bank).to_bytes(4, 'little'))
+	return digest.hexdigest()
+
+class PSRAMPool:
+	def __init__(self, address_space_banks=ADDRESS_SPACE_BANKS):
+		self.address_space_banks = address_space_banks
+		self.regions = []
+		# Incremented for every placed track, used to order regions for eviction
+		self.clock = 0
+
+	def clear(self):
+		self.regions = []
+
+	def copy(self):
+		# For placing a track ahead of time, the copy replaces the original once the track is uploaded
+		pool = PSRAMPool(self.address_space_banks)
+		pool.clock = self.clock
+		pool.regions = [PSRAMRegion(region.first_bank, region.last_bank, region.digest, region.last_used)
+			for region in self.regions]
+		return pool
+
+	def find_region(self, digest):
+		return next((region for region in self.regions if region.digest == digest), None)
+
+	def place(self, processed_vgm):
+		# Moves the track's PCM blocks to resident or free banks and remaps its bank bytes to match
+		# Returns the PCM blocks that still have to be uploaded
+		self.clock += 1
+
+		packer = PCMPacker(self.address_space_banks)
+		packer.add_space(None, [PoolBlock(block) for block in processed_vgm.pcm_blocks if len(block.data) > 0])
+
+		digests = {group: group_digest(group) for group in packer.groups}
+
+		# Regions used by this track can't be evicted while placing the rest
+		used_regions = set()
+		missing_groups = []
+
+		for group in packer.groups:
+			region = self.find_region(digests[group])
+			if region is not None and group.shift_allowed(region.first_bank - group.first_bank):
+				group.bank_shift = region.first_bank - group.first_bank
+				used_regions.add(region)
+			else:
+				missing_groups.append(group)
+
+		evicted_count = 0
+		upload_groups = []
+
+		for group in sorted(missing_groups, key=lambda group: (-group.size(), group.first_bank)):
+			# Identical groups within the track only need uploading once
+			region = self.find_region(digests[group])
+			if region is not None and region in used_regions \
+				and group.shift_allowed(region.first_bank - group.first_bank):
+				group.bank_shift = region.first_bank - group.first_bank
+				continue
+
+			while True:
+				first_bank = self.find_free_banks(group)
+				if first_bank is not None:
+					break
+
+				if not self.evict(used_regions):
+					break
+
+				evicted_count += 1
+
+			if first_bank is None:
+				# Fragmented by this track's own resident regions, so start over with the track's own layout
+				# This always fits since it was already packed into the whole address space
+				log.info("PSRAM pool: no room for the track's PCM, uploading all of it")
+				self.clear()
+				used_regions.clear()
+				upload_groups = []
+
+				for group in packer.groups:
+					group.bank_shift = 0
+					region = PSRAMRegion(group.first_bank, group.last_bank, digests[group])
+					self.regions.append(region)
+					used_regions.add(region)
+					upload_groups.append(group)
+
+				break
+
+			group.bank_shift = first_bank - group.first_bank
+			region = PSRAMRegion(first_bank, first_bank + group.last_bank - group.first_bank, digests[group])
+			self.regions.append(region)
+			used_regions.add(region)
+			upload_groups.append(group)
+
+		for region in used_regions:
+			region.last_used = self.clock
+
+		packer.check_layout()
+
+		(table, _) = packer.bank_remap_table(None)
+		if table != bytearray(range(0x100)):
+			processed_vgm.remap_bank_bytes(table)
+
+		for group in packer.groups:
+			for pool_block in group.blocks:
+				pool_block.block.remapped_offset = pool_block.offset + group.bank_shift * BANK_SIZE
+
+		processed_vgm.sort_pcm_blocks()
+
+		upload_blocks = [pool_block.block for group in upload_groups for pool_block in group.blocks]
+
+		log.info("PSRAM pool: {:d} of {:d} bank groups resident, {:X} bytes to upload, {:d} regions evicted",
+			len(packer.groups) - len(upload_groups), len(packer.groups),
+			sum(len(block.data) for block in upload_blocks), evicted_count)
+
+		return upload_blocks
+
+	def find_free_banks(self, group):
+		# First bank where the group fits in unused banks, or None
+		# Where it already is is preferred, so the bank bytes don't need remapping if nothing else is in the way
+		used = bytearray(self.address_space_banks)
+		for region in self.regions:
+			for bank in region.banks():
+				used[bank] = 1
+
+		group_banks = group.last_bank - group.first_bank + 1
+		first_banks = range(0, self.address_space_banks - group_banks + 1)
+		preferred = [group.first_bank] if group.first_bank in first_banks else []
+		for first_bank in preferred + list(first_banks):
+			if any(used[first_bank : first_bank + group_banks]):
+				continue
+
+			if group.shift_allowed(first_bank - group.first_bank):
+				return first_bank
+
+		return None
+
+	def evict(self, used_regions):
+		# Removes the least recently used region that isn't in used_regions, returns False if there wasn't one
+		candidates = [region for region in self.regions if region not in used_regions]
+		if not candidates:
+			return False
+
+		region = min(candidates, key=lambda region: region.last_used)
+		log.debug("PSRAM pool: evicting banks {:X}-{:X}", region.first_bank, region.last_bank)
+		self.regions.remove(region)
+		return True
+
+	def last_placed_regions(self):
+		# Regions used by the track placed last
+		return [region for region in self.regions if region.last_used == self.clock]
+
+	def scratch_offset(self, keep_regions=()):
+		# Start of a bank that no region holds, where a few bytes can be written without changing anything resident
+		# If every bank is in use, the least recently used region not in keep_regions is evicted to make one
+		# Returns None if every bank is held by keep_regions
+		while True:
+			used = bytearray(self.address_space_banks)
+			for region in self.regions:
+				for bank in region.banks():
+					used[bank] = 1
+
+			free_bank = used.find(0)
+			if free_bank >= 0:
+				return free_bank * BANK_SIZE
+
+			if not self.evict(set(keep_regions)):
+				return None
+
+	# Saved between runs of usb_ctrl.py, keyed by the device so a re-enumerated board starts empty
+
+	def save(self, path, device_key):
+		state = {
+			'device': device_key,
+			'clock': self.clock,
+			'regions': [[region.first_bank, region.last_bank, region.digest, region.last_used]
+				for region in self.regions]
+		}
+
+		path.parent.mkdir(parents=True, exist_ok=True)
+		with open(path, 'w') as file:
+			json.dump(state, file)
+
+	@classmethod
+	def load(cls, path, device_key):
+		pool = cls()
+
+		try:
+			with open(path) as file:
+				state = json.load(file)
+		except (OSError, ValueError):
+			return pool
+
+		if state.get('device') != device_key:
+			return pool
+
+		pool.clock = state['clock']
+		pool.regions = [PSRAMRegion(*region) for region in state['regions']]
+		return pool
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# sample_kernels.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Bulk sample transforms shared by the PCM / DAC conversion steps
+#
+# These work on whole buffers at once using extended slices, bytes.translate() and array
+# so the per-sample work is done in C rather than in a Python loop
+
+import sys
+from array import array
+
+# Unsigned 8bit DAC sample -> high byte of the equivalent signed 16bit sample
+# (x - 0x80) * 0x100 only ever has a non-zero high byte so the low byte is always 0
+_DAC_TO_S16_HIGH = bytes((x - 0x80) & 0xff for x in range(0x100))
+
+def byte_swap_words_in_place(buffer):
+	# Reverses the byte order of each 32bit word in a writable buffer (bytearray or writable memoryview)
+	# Any trailing bytes that don't form a full word are left as they are
+	view = memoryview(buffer)
+	length = len(view) & ~3
+
+	view[0 : length : 4], view[3 : length : 4] = bytes(view[3 : length : 4]), bytes(view[0 : length : 4])
+	view[1 : length : 4], view[2 : length : 4] = bytes(view[2 : length : 4]), bytes(view[1 : length : 4])
+
+	return buffer
+
+def byte_swap_words(data):
+	# Same as above but leaves the input untouched and returns a new bytearray
+	return byte_swap_words_in_place(bytearray(data))
+
+def dac_to_s16_bytes(dac_samples):
+	# Unsigned 8bit DAC samples -> signed 16bit little endian samples (as written to a WAV)
+	pcm_bytes = bytearray(len(dac_samples) * 2)
+	pcm_bytes[1::2] = bytes(dac_samples).translate(_DAC_TO_S16_HIGH)
+	return pcm_bytes
+
+def dac_to_s16(dac_samples):
+	# Unsigned 8bit DAC samples -> signed 16bit samples, as an array('h') that can be iterated directly
+	samples = array('h')
+	samples.frombytes(dac_to_s16_bytes(dac_samples))
+
+	if sys.byteorder == 'big':
+		samples.byteswap()
+
+	return samples
@@ -8,19 +8,35 @@
 
 import sys
 import errno
+import argparse
 
 from vgm_preprocess import VGMPreprocessor
 from vgm_preprocess import PCMType
 from vgm_reader import VGMReader
+from vgm_cache import ProcessedVGMCache
+from vgm_profile import log
+from vgm_profile import verbosity_log_level
+from vgm_profile import VGMProfile
+from vgm_profile import DISABLED_PROFILE
+from usb_upload import WriteMode
+from usb_upload import VGM_BUFFER_SIZE
+from usb_upload import set_write_mode
+from usb_upload import send_write_mode
+from usb_upload import usb_buffer
+from usb_upload import UploadRange
+from usb_upload import USBUploader
+from usb_upload import coalesce_pcm_blocks
+from psram_pool import PSRAMPool
+from vgm_refill import VGMTimeline
+from vgm_refill import RefillMetrics
+from vgm_refill import RefillChunkTable
+from vgm_refill import MetricsReporter
 
 import usb.core
 import usb.util
 
-import binascii
-import struct
 import sys
 from pathlib import Path
-from enum import Enum
 
 import threading
 import time
@@ -31,6 +47,19 @@ LOCAL_VGM_PREPROCESS_TEST = False
 
 ###
 
+def open_device():
+	dev = usb.core.find(idVendor=0x1d50, idProduct=0x6147)
+
+	if dev is None:
+		print("Bitsy device found not found")
+		sys.exit(1)
+
+	# Initial USB config
+
+	dev.set_configuration()
+
+	return (dev, get_data_ep(dev), get_status_ep(dev))
+
 def get_data_ep(dev):
 	cfg = dev.get_active_configuration()
 	intf = cfg[(1,0)]
@@ -71,150 +100,331 @@ def get_status_ep(dev):
 
 ###
 
-class WriteMode(Enum):
-	PCM_A = 0x00
-	PCM_B = 0x01
-	VGM = 0x02
+def pcm_write_mode(block):
+	return WriteMode.PCM_A if block.type == PCMType.A else WriteMode.PCM_B
 
-def set_write_mode(dev, write_mode, length, offset):
-	CTRL_SET_WRITE_MODE = 0x00
+def start_playback(dev):
+	CTRL_START_PLAYBACK = 0x01
 	REQUEST_TYPE = 0x41
 
-	offset_bytes = offset.to_bytes(4, 'little')
-	length_bytes = length.to_bytes(4, 'little')
-	data_bytes = offset_bytes + length_bytes 
+	dev.ctrl_transfer(REQUEST_TYPE, CTRL_START_PLAYBACK, 0, 0)
 
-	dev.ctrl_transfer(REQUEST_TYPE, CTRL_SET_WRITE_MODE, write_mode.value, 0, data_bytes)
+VGM_WRITE_TIMEOUT_MS = 20000
 
 def send_vgm(dev, ep, vgm, offset=0, restart_playback=True):
-	CTRL_READ_STATUS = 0x80
-	CTRL_START_PLAYBACK = 0x01
-	REQUEST_TYPE = 0x41
-
 	# Prepare for writing..
 	set_write_mode(dev, WriteMode.VGM, len(vgm), offset)
 
 	# ..write..
-	ep.write(vgm, 20000)
+	ep.write(usb_buffer(vgm), VGM_WRITE_TIMEOUT_MS)
 
 	if restart_playback:
 		# ..start playback after writing
-		dev.ctrl_transfer(REQUEST_TYPE, CTRL_START_PLAYBACK, 0, 0)
-
-def send_pcm(dev, ep, block):
-	set_write_mode(dev, WriteMode.PCM_A if block.type == PCMType.A else WriteMode.PCM_B, len(block.data), block.remapped_offset)
-	ep.write(block.data, 20000)
+		start_playback(dev)
 
-def send_pcm_blocks(dev, ep, pcm_blocks):
-	for block in pcm_blocks:
-		send_pcm(dev, ep, block)
+def report_upload(description, result, block_count=None):
+	blocks = " from {:d} blocks".format(block_count) if block_count is not None else ""
+	print("Uploaded {:s}: {:d} bytes in {:d} range(s){:s}, {:.3f}s, {:.2f} MB/s"
+		.format(description, result.length, result.ranges, blocks, result.elapsed, result.megabytes_per_second()))
 
-###
-
-def poll_status(stopping_event, status_ep, data_ep, processed_vgm):
-	print("Polling for status...")
+def upload_pcm_blocks(uploader, pcm_blocks):
+	ranges = coalesce_pcm_blocks(pcm_blocks, pcm_write_mode)
+	result = uploader.upload(ranges)
+	report_upload("PCM", result, len(pcm_blocks))
+	return result
 
-	vgm_data = processed_vgm.data
-	sequence_counter = 0
-
-	while not stopping_event.is_set():
-		try:
-			BUFFERING_REQUEST_HEADER = 0x01
-			STATUS_TOTAL_LENGTH = 16
+def upload_vgm(uploader, vgm):
+	# Only the start of the VGM fits in the firmware's buffer, the rest is sent as it's requested
+	vgm_range = UploadRange(WriteMode.VGM, 0)
+	vgm_range.append(memoryview(vgm)[0 : VGM_BUFFER_SIZE])
 
-			status_data = status_ep.read(STATUS_TOTAL_LENGTH, 250)
-			print("Received status data: ", binascii.hexlify(status_data))
+	result = uploader.upload([vgm_range])
+	report_upload("VGM", result)
 
-			header = int.from_bytes(status_data[0 : 4], 'little')
-			if (header & 0xff) != BUFFERING_REQUEST_HEADER:
-				print("Ignoring request with header: ", header)
-				continue
+	start_playback(uploader.dev)
+	return result
 
-			sequence_counter_received = header >> 8
-			if sequence_counter != sequence_counter_received:
-				print("Ignoring request with nonsequential counter: ", header)
-				continue
-
-			sequence_counter += 1
-			sequence_counter &= 0xffffff
+###
 
-			buffer_target_offset = int.from_bytes(status_data[4 : 8], 'little')
-			vgm_start_offset = int.from_bytes(status_data[8 : 12], 'little')
-			vgm_chunk_length = int.from_bytes(status_data[12 : 16], 'little')
+def read_status(status_ep, timeout_ms):
+	# Returns the next status report or None if there wasn't one in time
+	STATUS_TOTAL_LENGTH = 16
 
-			print("Sending VGM chunk to buffer @ {:X}, VGM offset: {:X}, Length: {:X}"\
-				  .format(buffer_target_offset, vgm_start_offset, vgm_chunk_length))
+	try:
+		return status_ep.read(STATUS_TOTAL_LENGTH, timeout_ms)
+	except usb.core.USBTimeoutError:
+		# Timeouts are expected when no data is available since we're polling
+		return None
+	except usb.core.USBError as e:
+		# Incase a libusb version without USBTImeoutError is used, this errno case is also handled
+		if e.backend_error_code == -errno.ETIMEDOUT:
+			return None
+
+		print("A non-timeout USB exception was thrown. Exiting...")
+		raise
+
+class BufferingRequest:
+	HEADER = 0x01
+
+	def __init__(self, sequence_counter, buffer_target_offset, vgm_start_offset, vgm_chunk_length):
+		self.sequence_counter = sequence_counter
+		self.buffer_target_offset = buffer_target_offset
+		self.vgm_start_offset = vgm_start_offset
+		self.vgm_chunk_length = vgm_chunk_length
+
+	@classmethod
+	def from_status(cls, status_data):
+		# None if the status report isn't a buffering request
+		header = int.from_bytes(status_data[0 : 4], 'little')
+		if (header & 0xff) != BufferingRequest.HEADER:
+			return None
+
+		return cls(header >> 8,
+			int.from_bytes(status_data[4 : 8], 'little'),
+			int.from_bytes(status_data[8 : 12], 'little'),
+			int.from_bytes(status_data[12 : 16], 'little'))
+
+def send_vgm_chunk(dev, data_ep, vgm_data, request):
+	# Returns the number of bytes sent
+	vgm_chunk = vgm_data[request.vgm_start_offset : request.vgm_start_offset + request.vgm_chunk_length]
+
+	# The firmware asks for buffers past the end of short tracks, which it never reads
+	if len(vgm_chunk) > 0:
+		send_vgm(dev, data_ep, vgm_chunk, request.buffer_target_offset, restart_playback=False)
+
+	return len(vgm_chunk)
+
+class VGMRefiller:
+	# Answers the firmware's buffering requests for the VGM being played and records RefillMetrics for them
+	def __init__(self, dev, data_ep, metrics):
+		self.dev = dev
+		self.data_ep = data_ep
+		self.metrics = metrics
+		self.vgm_data = b''
+		self.timeline = None
+		self.chunks = None
+		self.sequence_counter = 0
+
+	def start(self, vgm_data, timeline=None, chunks=None):
+		# Called when playback (re)starts, which is when the firmware restarts its sequence counter
+		self.vgm_data = vgm_data
+		self.timeline = timeline
+		self.chunks = chunks if chunks is not None else RefillChunkTable(vgm_data)
+		self.sequence_counter = 0
+
+		if timeline is None:
+			# Refill budgets aren't known until the timeline is built, which is done alongside playback
+			thread = threading.Thread(target=self.build_timeline, args=(vgm_data,))
+			thread.daemon = True
+			thread.start()
+
+	def build_timeline(self, vgm_data):
+		timeline = VGMTimeline(vgm_data)
+		if self.vgm_data is vgm_data:
+			self.timeline = timeline
+
+	def handle_status(self, status_data, received_at):
+		request = BufferingRequest.from_status(status_data)
+		if request is None:
+			log.debug("Ignoring status with header: {:X}", int.from_bytes(status_data[0 : 4], 'little'))
+			return
+
+		if request.sequence_counter != self.sequence_counter:
+			log.debug("Ignoring request with nonsequential counter: {:X}", request.sequence_counter)
+			self.metrics.record_sequence_gap(self.sequence_counter, request.sequence_counter)
+			return
+
+		self.sequence_counter = (self.sequence_counter + 1) & 0xffffff
+
+		chunk = self.chunks.lookup(request)
+		if chunk is not None:
+			(payload, buffer) = chunk
+			send_write_mode(self.dev, WriteMode.VGM, payload)
+			self.data_ep.write(buffer, VGM_WRITE_TIMEOUT_MS)
+			length = len(buffer)
+		else:
+			length = send_vgm_chunk(self.dev, self.data_ep, self.vgm_data, request)
+			if length > 0:
+				self.metrics.record_table_miss()
+
+		latency = time.perf_counter() - received_at
+
+		# Buffers past the end of the data are never read
+		budget = None
+		if self.timeline is not None and length > 0:
+			budget = self.timeline.refill_budget(request.buffer_target_offset, request.vgm_start_offset,
+				request.vgm_chunk_length)
+
+		self.metrics.record_refill(request, latency, length, budget)
+
+		if budget is not None and latency > budget:
+			log.info("Likely underrun: refill of VGM offset {:X} took {:.1f}ms, the buffer lasts {:.1f}ms",
+				request.vgm_start_offset, latency * 1000, budget * 1000)
+
+def poll_status(stopping_event, refiller, status_ep, reporter=None):
+	# Status reads return as soon as a report arrives, the timeout only bounds how often stopping_event is checked
+	STATUS_TIMEOUT_MS = 250
 
-			vgm_chunk = vgm_data[vgm_start_offset : vgm_start_offset + vgm_chunk_length]
+	print("Polling for status...")
 
-			send_vgm(dev, data_ep, vgm_chunk, buffer_target_offset, restart_playback=False)
-		except usb.core.USBTimeoutError:
-			# Timeouts are expected when no data is available since we're polling
-			continue
-		except usb.core.USBError as e:
-			# Incase a libusb version without USBTImeoutError is used, this errno case is also handled
-			if e.backend_error_code == -errno.ETIMEDOUT:
-				continue
+	while not stopping_event.is_set():
+		status_data = read_status(status_ep, STATUS_TIMEOUT_MS)
+		if status_data is not None:
+			refiller.handle_status(status_data, time.perf_counter())
 
-			print("A non-timeout USB exception was thrown. Exiting...")
-			raise
+		if reporter is not None:
+			reporter.update()
 
-def start_polling_status(dev, status_ep, data_ep, processed_vgm):
+def start_polling_status(refiller, status_ep, reporter=None):
 	stopping_event = threading.Event()
-	thread = threading.Thread(target=poll_status, args=(stopping_event, status_ep, data_ep, processed_vgm))
+	thread = threading.Thread(target=poll_status, args=(stopping_event, refiller, status_ep, reporter))
 	thread.daemon = True
 	thread.start()
 	return (thread, stopping_event)
 
-def read_processed_vgm(vgm_path):
-	vgm = VGMReader.read(vgm_path)
-	processor = VGMPreprocessor()
+def read_processed_vgm(vgm_path, use_cache=True, profile=DISABLED_PROFILE):
+	processor = VGMPreprocessor(profile=profile)
+
+	def read_vgm(vgm_path):
+		with profile.stage('read'):
+			return VGMReader.read(vgm_path)
+
+	if use_cache:
+		cache = ProcessedVGMCache()
+		return cache.read_processed_vgm(vgm_path, processor, read_vgm)
+
+	vgm = read_vgm(vgm_path)
 	processed_vgm = processor.preprocess(vgm)
 	return processed_vgm
 
-###
+def load_psram_pool(dev, reset):
+	# The pool saved by the last run, if it was for the same device
+	# Removed until the upload is complete so a failed upload doesn't leave it claiming partially written data
+	path = ProcessedVGMCache().cache_dir / 'psram-pool.json'
+	device_key = "{:d}:{:d}".format(dev.bus, dev.address)
+
+	pool = PSRAMPool() if reset else PSRAMPool.load(path, device_key)
+	path.unlink(missing_ok=True)
+
+	def save(pool):
+		# None removes it, for while an upload is in progress
+		if pool is None:
+			path.unlink(missing_ok=True)
+		else:
+			pool.save(path, device_key)
+
+	return (pool, save)
+
+def parse_time(time_string):
+	# Seconds, or minutes:seconds
+	try:
+		seconds = 0.0
+		for part in time_string.split(':'):
+			seconds = seconds * 60 + float(part)
+	except ValueError:
+		raise argparse.ArgumentTypeError("expected a time in seconds or mm:ss, got: {:s}".format(time_string))
+
+	return seconds
+
+def playback_vgm_data(processed_vgm, start_at):
+	# The VGM data to upload, starting from the nearest keyframe if a start time was given
+	if start_at is None:
+		return processed_vgm.data
 
-if LOCAL_VGM_PREPROCESS_TEST:
-	processed_vgm = read_processed_vgm(sys.argv[1])
-	print(processed_vgm)
-	sys.exit(0)
+	sample_time = int(start_at * VGMPreprocessor.SAMPLE_RATE)
+	(vgm_data, keyframe) = processed_vgm.seek_data(sample_time)
+
+	print("Starting at keyframe: {:.2f}s (VGM offset: {:X})"
+		.format(keyframe.sample_time / VGMPreprocessor.SAMPLE_RATE, keyframe.offset))
+
+	return vgm_data
 
 ###
 
-dev = usb.core.find(idVendor=0x1d50, idProduct=0x6147)
+def main():
+	parser = argparse.ArgumentParser(description="Upload and play a VGM over USB")
+	parser.add_argument('vgm_path', help="VGM / VGZ file to play")
+	parser.add_argument('--no-cache', action='store_true', help="always preprocess the VGM, ignoring any cached result")
+	parser.add_argument('--start-at', type=parse_time, metavar='TIME', help="start playback at this time (seconds or mm:ss)")
+	parser.add_argument('-v', '--verbose', action='count', default=0, help="show preprocessing details (-vv for more)")
+	parser.add_argument('--profile', nargs='?', const='-', metavar='PATH',
+		help="write preprocessing / upload stage times and counters as JSON to PATH (or stdout)")
+	parser.add_argument('--upload-all-pcm', action='store_true',
+		help="upload all PCM blocks, even those that earlier tracks left in PSRAM")
+	parser.add_argument('--chunk-size', type=int, default=USBUploader.CHUNK_SIZE // 1024, metavar='KB',
+		help="size of each bulk transfer when uploading (default {:d})".format(USBUploader.CHUNK_SIZE // 1024))
+	parser.add_argument('--queue-depth', type=int, default=USBUploader.QUEUE_DEPTH,
+		help="chunks prepared ahead of the transfer in progress (default {:d})".format(USBUploader.QUEUE_DEPTH))
+	parser.add_argument('--metrics', nargs='?', const='-', metavar='PATH',
+		help="append a JSON summary of buffer refills to PATH (or stdout) every --metrics-interval seconds")
+	parser.add_argument('--metrics-interval', type=float, default=10, metavar='SECONDS',
+		help="seconds between refill summaries (default 10)")
+	args = parser.parse_args()
 
-if dev is None:
-	print("Bitsy device found not found")
-	sys.exit(1)
+	log.level = verbosity_log_level(args.verbose)
+	profile = VGMProfile() if args.profile is not None else DISABLED_PROFILE
 
-# Initial USB config
+	if LOCAL_VGM_PREPROCESS_TEST:
+		processed_vgm = read_processed_vgm(args.vgm_path, use_cache=not args.no_cache, profile=profile)
+		vgm_data = playback_vgm_data(processed_vgm, args.start_at)
+		print(processed_vgm)
+		if args.profile is not None:
+			profile.write_report(args.profile)
+		sys.exit(0)
 
-dev.set_configuration()
+	###
 
-data_ep = get_data_ep(dev)
-status_ep = get_status_ep(dev)
+	(dev, data_ep, status_ep) = open_device()
 
-# Read a VGM to send
+	# Read a VGM to send
 
-if len(sys.argv) != 2:
-	print("Expected one argument with filename")
-	sys.exit(1)
+	processed_vgm = read_processed_vgm(args.vgm_path, use_cache=not args.no_cache, profile=profile)
 
-filename = sys.argv[1]
-processed_vgm = read_processed_vgm(filename)
+	# PCM blocks already in PSRAM are reused, which moves the track's blocks and remaps its bank bytes
+	(psram_pool, save_psram_pool) = load_psram_pool(dev, args.upload_all_pcm)
+	with profile.stage('pcm_placement'):
+		upload_blocks = psram_pool.place(processed_vgm)
 
-send_pcm_blocks(dev, data_ep, processed_vgm.pcm_blocks)
-send_vgm(dev, data_ep, processed_vgm.data)
+	vgm_data = playback_vgm_data(processed_vgm, args.start_at)
 
-(status_thread, status_stopping_event) = start_polling_status(dev, status_ep, data_ep, processed_vgm)
+	# Started before uploading so the refill timeline is built during the upload
+	metrics = RefillMetrics()
+	refiller = VGMRefiller(dev, data_ep, metrics)
+	refiller.start(vgm_data)
+	reporter = MetricsReporter(metrics, args.metrics, args.metrics_interval) if args.metrics is not None else None
 
-while True:
-	try:
-		if not status_thread.is_alive():
-			break
+	uploader = USBUploader(dev, data_ep, chunk_size=args.chunk_size * 1024, queue_depth=args.queue_depth)
 
-		time.sleep(0.5)
-	except KeyboardInterrupt:
-		status_stopping_event.set()
-		status_thread.join()
-		sys.exit(1)
+	with profile.stage('upload_pcm'):
+		pcm_result = upload_pcm_blocks(uploader, upload_blocks)
+
+	save_psram_pool(psram_pool)
+	profile.count('pcm_blocks_resident', len(processed_vgm.pcm_blocks) - len(upload_blocks))
+
+	with profile.stage('upload_vgm'):
+		vgm_result = upload_vgm(uploader, vgm_data)
+
+	profile.count('upload_bytes', pcm_result.length + vgm_result.length)
+	profile.count('upload_ranges', pcm_result.ranges + vgm_result.ranges)
+
+	# Written before playback starts since the status loop runs until interrupted
+	if args.profile is not None:
+		profile.write_report(args.profile)
+
+	(status_thread, status_stopping_event) = start_polling_status(refiller, status_ep, reporter)
+
+	while True:
+		try:
+			if not status_thread.is_alive():
+				break
+
+			time.sleep(0.5)
+		except KeyboardInterrupt:
+			status_stopping_event.set()
+			status_thread.join()
+			if reporter is not None:
+				reporter.report()
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
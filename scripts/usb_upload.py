@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# usb_upload.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Bulk uploads of PCM blocks and VGM data to the board
+#
+# Each write is a range: a SET_WRITE_MODE control transfer (mode, offset, length) followed by exactly length bytes
+# PCM blocks that are adjacent in PSRAM are merged into one range so they share a single control transfer
+# (ADPCM-A and B writes both go to the same PSRAM offset in the firmware, so either mode can be used for a range)
+#
+# Ranges are streamed in fixed size chunks
+# pyusb transfers are synchronous, so a separate thread prepares the next chunks while the current one is written
+# Up to queue_depth chunks are prepared ahead of the transfer in progress
+
+import time
+import queue
+import threading
+from enum import Enum
+from array import array
+
+# Size of the firmware's VGM buffer (see fw/ym2610/vgm.c)
+# The initial upload fills it, then 8KB buffers are refilled as the firmware requests them
+VGM_BUFFER_SIZE = 0x18000
+
+class WriteMode(Enum):
+	PCM_A = 0x00
+	PCM_B = 0x01
+	VGM = 0x02
+
+def write_mode_payload(length, offset):
+	# Data of the SET_WRITE_MODE control transfer
+	offset_bytes = offset.to_bytes(4, 'little')
+	length_bytes = length.to_bytes(4, 'little')
+	return offset_bytes + length_bytes
+
+def send_write_mode(dev, write_mode, payload):
+	CTRL_SET_WRITE_MODE = 0x00
+	REQUEST_TYPE = 0x41
+
+	dev.ctrl_transfer(REQUEST_TYPE, CTRL_SET_WRITE_MODE, write_mode.value, 0, payload)
+
+def set_write_mode(dev, write_mode, length, offset):
+	send_write_mode(dev, write_mode, write_mode_payload(length, offset))
+
+def usb_buffer(data):
+	# pyusb passes array('B') buffers straight to the backend but converts anything else element by element
+	# PCM blocks are usually memoryviews of the input, so this makes the one unavoidable copy in C instead
+	if isinstance(data, array):
+		return data
+
+	buffer = array('B')
+	buffer.frombytes(data)
+	return buffer
+
+class UploadRange:
+	def __init__(self, write_mode, offset):
+		self.write_mode = write_mode
+		self.offset = offset
+		# Data written in sequence from offset
+		self.parts = []
+		self.length = 0
+
+	def append(self, data):
+		self.parts.append(memoryview(data).cast('B'))
+		self.length += len(data)
+
+	def end(self):
+		return self.offset + self.length
+
+	def chunks(self, chunk_size):
+		# Yields array('B') buffers of up to chunk_size bytes covering all parts
+		buffer = array('B')
+
+		for part in self.parts:
+			index = 0
+			while index < len(part):
+				take = min(chunk_size - len(buffer), len(part) - index)
+				buffer.frombytes(part[index : index + take])
+				index += take
+
+				if len(buffer) == chunk_size:
+					yield buffer
+					buffer = array('B')
+
+		if buffer:
+			yield buffer
+
+def coalesce_pcm_blocks(pcm_blocks, pcm_write_mode):
+	# Returns UploadRanges covering pcm_blocks, merging blocks that directly follow each other in PSRAM
+	# Gaps are never filled in since they may hold data that isn't part of this upload
+	ranges = []
+
+	for block in sorted(pcm_blocks, key=lambda block: block.remapped_offset):
+		if len(block.data) == 0:
+			continue
+
+		if not ranges or ranges[-1].end() != block.remapped_offset:
+			ranges.append(UploadRange(pcm_write_mode(block), block.remapped_offset))
+
+		ranges[-1].append(block.data)
+
+	return ranges
+
+class UploadResult:
+	def __init__(self, length, ranges, elapsed):
+		self.length = length
+		self.ranges = ranges
+		self.elapsed = elapsed
+
+	def megabytes_per_second(self):
+		return self.length / 1e6 / max(self.elapsed, 1e-9)
+
+class USBUploader:
+	CHUNK_SIZE = 0x40000
+	QUEUE_DEPTH = 4
+
+	# Per chunk, rather than per range, so large uploads don't need a longer timeout
+	TIMEOUT_MS = 5000
+
+	def __init__(self, dev, ep, chunk_size=CHUNK_SIZE, queue_depth=QUEUE_DEPTH):
+		self.dev = dev
+		self.ep = ep
+		self.chunk_size = chunk_size
+		self.queue_depth = queue_depth
+
+	def upload(self, ranges):
+		# Writes all ranges in order, returning an UploadResult
+		chunk_queue = queue.Queue(maxsize=self.queue_depth)
+		stopping_event = threading.Event()
+		# Raised again here if preparing the chunks failed, the None that follows it doesn't mean the upload is complete
+		prepare_errors = []
+
+		def prepare_chunks():
+			# None marks the start of each range, which is followed by its chunks
+			try:
+				for upload_range in ranges:
+					chunk_queue.put((upload_range, None))
+					for chunk in upload_range.chunks(self.chunk_size):
+						if stopping_event.is_set():
+							return
+
+						chunk_queue.put((upload_range, chunk))
+			except Exception as error:
+				prepare_errors.append(error)
+			finally:
+				chunk_queue.put(None)
+
+		start_time = time.perf_counter()
+		length = 0
+
+		thread = threading.Thread(target=prepare_chunks)
+		thread.daemon = True
+		thread.start()
+
+		try:
+			while True:
+				item = chunk_queue.get()
+				if item is None:
+					break
+
+				(upload_range, chunk) = item
+				if chunk is None:
+					set_write_mode(self.dev, upload_range.write_mode, upload_range.length, upload_range.offset)
+				else:
+					self.ep.write(chunk, USBUploader.TIMEOUT_MS)
+					length += len(chunk)
+		finally:
+			# If a write failed, the preparing thread is stopped before it fills the queue
+			stopping_event.set()
+			while thread.is_alive():
+				try:
+					chunk_queue.get(timeout=0.1)
+				except queue.Empty:
+					pass
+
+		if prepare_errors:
+			raise prepare_errors[0]
+
+		# A short upload would leave PSRAM partly written, so playback mustn't be started from it
+		expected_length = sum(upload_range.length for upload_range in ranges)
+		if length != expected_length:
+			raise RuntimeError("Upload sent {:X} of {:X} bytes".format(length, expected_length))
+
+		return UploadResult(length, len(ranges), time.perf_counter() - start_time)
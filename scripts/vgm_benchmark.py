@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# vgm_benchmark.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Benchmarks for the conversion pipeline using the synthetic VGMs from vgm_synth.py
+#
+# Each benchmark is run at several sizes and the best of --repeat runs is kept
+# Results can be saved as a baseline, and later runs compared against it to flag regressions
+#
+# Timings are only comparable on the same machine and Python version, which are recorded in the baseline
+#
+# Each benchmark function yields (name, prepare) where prepare() builds the inputs and returns the function to time
+
+import sys
+import time
+import json
+import random
+import argparse
+import platform
+
+from vgm_preprocess import VGMPreprocessor
+from vgm_preprocess import PCMBlock
+from delta_t_encoder import DeltaTEncoder
+from vgm_inserter import DACCommandInserter
+from ym2612_dac_state import DACSampleBlock
+from sample_kernels import dac_to_s16
+from vgm_synth import CORPUS
+from vgm_profile import log
+from vgm_profile import ERROR
+
+# Size name -> scale, each is 4x the previous
+SIZES = {
+	'small': 1,
+	'medium': 4,
+	'large': 16
+}
+
+def time_best(function, repeat):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		function()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+
+	return best
+
+def preprocess_benchmarks(scale):
+	def prepare(synthesize):
+		vgm = synthesize(scale)
+
+		def run():
+			# DAC blocks are encoded serially so results don't depend on the CPU count
+			VGMPreprocessor(encode_jobs=1).preprocess(vgm, rewrite_pcm=True, byteswap_pcm=False)
+
+		return run
+
+	for (name, synthesize) in CORPUS.items():
+		yield ('preprocess.' + name, lambda synthesize=synthesize: prepare(synthesize))
+
+def deltat_encode_benchmark(scale):
+	def prepare():
+		rng = random.Random(3)
+		dac_samples = bytes(0x80 + rng.randrange(-64, 64) for _ in range(0x10000 * scale))
+		pcm_s16 = dac_to_s16(dac_samples)
+
+		return lambda: DeltaTEncoder().encode(pcm_s16)
+
+	yield ('deltat_encode', prepare)
+
+def dac_triggers_benchmark(scale):
+	def prepare():
+		# Many short blocks, half of them repeats of an earlier block
+		dac_sample_blocks = []
+		encoded_blocks = []
+
+		for index in range(0x400 * scale):
+			sample_block = DACSampleBlock()
+			sample_block.timestamp = index * 0x800
+			sample_block.data = bytes(0x200)
+			dac_sample_blocks.append(sample_block)
+
+			if index % 2 == 0:
+				encoded_block = PCMBlock()
+				encoded_block.remapped_offset = index * 0x100
+				encoded_block.data = bytes(0x100)
+
+			encoded_blocks.append(encoded_block)
+
+		return lambda: DACCommandInserter(dac_sample_blocks, encoded_blocks).triggers()
+
+	yield ('dac_triggers', prepare)
+
+def byte_swap_benchmark(scale):
+	def prepare():
+		data = random.Random(4).randbytes(0x40000 * scale)
+		return lambda: PCMBlock.byte_swap(data)
+
+	yield ('byte_swap', prepare)
+
+BENCHMARKS = [
+	preprocess_benchmarks,
+	deltat_encode_benchmark,
+	dac_triggers_benchmark,
+	byte_swap_benchmark
+]
+
+def run_benchmarks(sizes, repeat, name_filter=None):
+	results = {}
+
+	for size in sizes:
+		scale = SIZES[size]
+		for benchmarks in BENCHMARKS:
+			for (name, prepare) in benchmarks(scale):
+				full_name = "{:s}.{:s}".format(name, size)
+				if name_filter is not None and name_filter not in full_name:
+					continue
+
+				results[full_name] = time_best(prepare(), repeat)
+				print("{:<40s} {:10.4f}s".format(full_name, results[full_name]))
+
+	return results
+
+def environment():
+	return {
+		'python': platform.python_version(),
+		'machine': platform.machine(),
+		'processor': platform.processor()
+	}
+
+def compare(results, baseline, tolerance):
+	# Returns the names of benchmarks that are slower than the baseline by more than tolerance (a fraction)
+	regressions = []
+
+	if baseline['environment'] != environment():
+		print("Warning: baseline was recorded in a different environment: {:s}".format(str(baseline['environment'])))
+
+	print()
+	print("{:<40s} {:>10s} {:>10s} {:>8s}".format("Benchmark", "Baseline", "Current", "Change"))
+
+	for (name, elapsed) in results.items():
+		baseline_elapsed = baseline['results'].get(name)
+		if baseline_elapsed is None:
+			print("{:<40s} {:>10s} {:9.4f}s".format(name, "-", elapsed))
+			continue
+
+		change = elapsed / baseline_elapsed - 1
+		regressed = change > tolerance
+		if regressed:
+			regressions.append(name)
+
+		print("{:<40s} {:9.4f}s {:9.4f}s {:+7.1f}%{:s}"
+			.format(name, baseline_elapsed, elapsed, change * 100, "  REGRESSION" if regressed else ""))
+
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark VGM conversion using synthetic VGMs")
+	parser.add_argument('--sizes', default=','.join(SIZES.keys()),
+		help="comma separated sizes to run ({:s})".format(', '.join(SIZES.keys())))
+	parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark, the fastest is kept")
+	parser.add_argument('--filter', help="only run benchmarks with names containing this")
+	parser.add_argument('--save-baseline', metavar='PATH', help="save the results as a baseline")
+	parser.add_argument('--baseline', metavar='PATH', help="compare the results against a saved baseline")
+	parser.add_argument('--tolerance', type=float, default=0.15,
+		help="fraction a benchmark can be slower than the baseline before it's flagged (default 0.15)")
+	args = parser.parse_args()
+
+	sizes = args.sizes.split(',')
+	for size in sizes:
+		if size not in SIZES:
+			print("Unknown size: {:s}".format(size))
+			sys.exit(1)
+
+	# Only the timings are of interest here
+	log.level = ERROR
+
+	results = run_benchmarks(sizes, max(args.repeat, 1), args.filter)
+
+	if args.save_baseline is not None:
+		with open(args.save_baseline, 'w') as file:
+			json.dump({'environment': environment(), 'results': results}, file, indent=1)
+			file.write('\n')
+
+	if args.baseline is not None:
+		with open(args.baseline) as file:
+			baseline = json.load(file)
+
+		regressions = compare(results, baseline, args.tolerance)
+		if regressions:
+			print()
+			print("{:d} benchmark(s) regressed".format(len(regressions)))
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# vgm_cache.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# On-disk cache of preprocessed VGMs, keyed by the input file contents and preprocessing options
+#
+# Each entry is a single file holding the command data, all PCM blocks and the register keyframes
+# Least recently used entries are evicted once the total size exceeds max_size
+
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+
+from vgm_preprocess import VGMPreprocessor
+from vgm_preprocess import ProcessedVGM
+from vgm_preprocess import PCMBlock
+from vgm_preprocess import PCMType
+from vgm_keyframes import VGMKeyframe
+from vgm_profile import log
+
+class ProcessedVGMCache:
+	MAGIC = b'PVGM'
+	SUFFIX = '.pvgm'
+
+	DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+	def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+		if cache_dir is None:
+			cache_base = os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')
+			cache_dir = Path(cache_base) / 'ym2610-pcb'
+
+		self.cache_dir = Path(cache_dir)
+		self.max_size = max_size
+
+	def read_processed_vgm(self, vgm_path, preprocessor, read_vgm, rewrite_pcm=False, byteswap_pcm=True):
+		# Returns the cached result if there is one, otherwise reads and preprocesses the VGM using read_vgm(path)
+		key = self.key(vgm_path, preprocessor, rewrite_pcm, byteswap_pcm)
+
+		processed_vgm = self.load(key)
+		if processed_vgm is not None:
+			log.info("Using cached preprocessed VGM: {:s}", key)
+			return processed_vgm
+
+		vgm = read_vgm(vgm_path)
+		processed_vgm = preprocessor.preprocess(vgm, rewrite_pcm=rewrite_pcm, byteswap_pcm=byteswap_pcm)
+		self.store(key, processed_vgm)
+
+		return processed_vgm
+
+	def key(self, vgm_path, preprocessor, rewrite_pcm, byteswap_pcm):
+		digest = hashlib.sha256()
+
+		with open(vgm_path, 'rb') as file:
+			while True:
+				chunk = file.read(0x100000)
+				if not chunk:
+					break
+
+				digest.update(chunk)
+
+		options = "v{:d}:{:d}:{:d}:{:d}:{:s}:{:s}".format(VGMPreprocessor.VERSION,
+			int(rewrite_pcm), int(byteswap_pcm), preprocessor.assumed_clock, str(preprocessor.keyframe_interval),
+			preprocessor.dac_segmenter.key())
+		digest.update(options.encode('ascii'))
+
+		return digest.hexdigest()
+
+	def entry_path(self, key):
+		return self.cache_dir / (key + ProcessedVGMCache.SUFFIX)
+
+	# Entry format:
+	# MAGIC, metadata length (4 bytes LE), metadata (JSON), command data, PCM block data (in sequence),
+	# keyframe registers then written flags (0x200 bytes each, per keyframe)
+
+	def load(self, key):
+		path = self.entry_path(key)
+
+		try:
+			with open(path, 'rb') as file:
+				entry = file.read()
+		except FileNotFoundError:
+			return None
+
+		try:
+			processed_vgm = ProcessedVGMCache.parse_entry(entry)
+		except (ValueError, KeyError, TypeError) as e:
+			# A damaged entry is a cache miss, it's removed so the track is converted and stored again
+			log.warning("Removing invalid cache entry: {:s}: {:s}", str(path), str(e))
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			return None
+
+		# Bump the modification time so LRU eviction sees this entry as recently used
+		os.utime(path)
+
+		return processed_vgm
+
+	@staticmethod
+	def parse_entry(entry):
+		# Raises ValueError, KeyError or TypeError if the entry is truncated or its metadata is invalid
+		if entry[0 : 4] != ProcessedVGMCache.MAGIC:
+			raise ValueError("bad magic")
+
+		metadata_length = int.from_bytes(entry[4 : 8], 'little')
+		metadata = json.loads(entry[8 : 8 + metadata_length])
+
+		view = memoryview(entry)
+		index = 8 + metadata_length
+
+		expected_length = index + metadata['data_length'] + 0x400 * len(metadata['keyframes']) \
+			+ sum(block_metadata['length'] for block_metadata in metadata['pcm_blocks'])
+		if expected_length != len(entry):
+			raise ValueError("expected {:X} bytes, found {:X}".format(expected_length, len(entry)))
+
+		processed_vgm = ProcessedVGM()
+		processed_vgm.data = bytearray(view[index : index + metadata['data_length']])
+		processed_vgm.header = processed_vgm.data[0x00 : 0x100]
+		index += metadata['data_length']
+
+		for block_metadata in metadata['pcm_blocks']:
+			block = PCMBlock()
+			block.offset = block_metadata['offset']
+			block.remapped_offset = block_metadata['remapped_offset']
+			block.total_size = block_metadata['total_size']
+			block.type = PCMType[block_metadata['type']]
+
+			length = block_metadata['length']
+			block.data = view[index : index + length]
+			index += length
+
+			processed_vgm.pcm_blocks.append(block)
+
+		for (sample_time, offset) in metadata['keyframes']:
+			registers = bytearray(view[index : index + 0x200])
+			written = bytes(view[index + 0x200 : index + 0x400])
+			keyframe = VGMKeyframe(sample_time, registers, written, offset=offset)
+			index += 0x400
+
+			processed_vgm.keyframes.append(keyframe)
+
+		return processed_vgm
+
+	def store(self, key, processed_vgm):
+		metadata = {
+			'data_length': len(processed_vgm.data),
+			'pcm_blocks': [{
+				'offset': block.offset,
+				'remapped_offset': block.remapped_offset,
+				'total_size': block.total_size,
+				'type': block.type.name,
+				'length': len(block.data)
+			} for block in processed_vgm.pcm_blocks],
+			'keyframes': processed_vgm.time_index_offsets()
+		}
+
+		metadata_bytes = json.dumps(metadata).encode('utf-8')
+
+		self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+		# Written to a temporary file first so a partially written entry is never loaded
+		(fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as file:
+				file.write(ProcessedVGMCache.MAGIC)
+				file.write(len(metadata_bytes).to_bytes(4, 'little'))
+				file.write(metadata_bytes)
+				file.write(processed_vgm.data)
+				for block in processed_vgm.pcm_blocks:
+					file.write(block.data)
+				for keyframe in processed_vgm.keyframes:
+					file.write(keyframe.registers)
+					file.write(keyframe.written)
+
+			os.replace(temp_path, self.entry_path(key))
+		except OSError as e:
+			log.warning("Failed to write cache entry: {:s}", str(e))
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+			return
+
+		self.evict()
+
+	def evict(self):
+		entries = []
+		for path in self.cache_dir.glob('*' + ProcessedVGMCache.SUFFIX):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				continue
+
+			entries.append((stat.st_mtime, stat.st_size, path))
+
+		total_size = sum(entry[1] for entry in entries)
+
+		# Oldest first
+		for (_, size, path) in sorted(entries, key=lambda entry: entry[0]):
+			if total_size <= self.max_size:
+				break
+
+			log.info("Evicting cached VGM: {:s}", path.name)
+			path.unlink(missing_ok=True)
+			total_size -= size
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# vgm_commands.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# VGM 1.71 command lengths, used to dispatch and skip commands without decoding them
+#
+# Lengths include the command byte itself
+# None is used for undefined commands, which can't be skipped since their length isn't known
+
+DATA_BLOCK = 0x67
+DATA_BLOCK_HEADER_LENGTH = 7
+
+def _build_command_lengths():
+	lengths = [None] * 0x100
+
+	def assign(first, last, length):
+		for cmd in range(first, last + 1):
+			lengths[cmd] = length
+
+	# Reserved, but with defined operand counts so they can be skipped
+	assign(0x30, 0x3f, 2)
+	assign(0x40, 0x4e, 3)
+
+	# Game Gear PSG stereo, PSG write
+	assign(0x4f, 0x50, 2)
+
+	# Register writes (one per chip / port)
+	assign(0x51, 0x5f, 3)
+
+	# Delays
+	lengths[0x61] = 3
+	lengths[0x62] = 1
+	lengths[0x63] = 1
+
+	# End of stream
+	lengths[0x66] = 1
+
+	# Data block, length is read from the block header (see command_length())
+	lengths[DATA_BLOCK] = 0
+
+	# PCM RAM write
+	lengths[0x68] = 12
+
+	# Delay (4bit) and YM2612 DAC write from data bank
+	assign(0x70, 0x8f, 1)
+
+	# DAC stream control
+	lengths[0x90] = 5
+	lengths[0x91] = 5
+	lengths[0x92] = 6
+	lengths[0x93] = 11
+	lengths[0x94] = 2
+	lengths[0x95] = 5
+
+	# Register writes for other chips, PCM data bank seek
+	assign(0xa0, 0xbf, 3)
+	assign(0xc0, 0xdf, 4)
+	assign(0xe0, 0xff, 5)
+
+	return lengths
+
+COMMAND_LENGTHS = _build_command_lengths()
+
+def data_block_size(vgm, index):
+	# 0x67 0x66 tt ss ss ss ss
+	return vgm[index + 3] | vgm[index + 4] << 8 | vgm[index + 5] << 16 | vgm[index + 6] << 24
+
+def command_length(vgm, index):
+	length = COMMAND_LENGTHS[vgm[index]]
+	if length == 0:
+		return DATA_BLOCK_HEADER_LENGTH + data_block_size(vgm, index)
+
+	return length
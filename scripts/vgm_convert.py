@@ -6,26 +6,277 @@
 #
 # SPDX-License-Identifier: MIT
 
+import os
+import io
 import sys
+import glob
+import time
+import argparse
+import contextlib
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from vgm_preprocess import VGMPreprocessor
-from vgm_preprocess import PCMType
 from vgm_reader import VGMReader
+from vgm_profile import log
+from vgm_profile import verbosity_log_level
+from vgm_profile import VGMProfile
+from vgm_profile import DISABLED_PROFILE
 
-if len(sys.argv) != 3:
-	print("Usage: vgm_convert.py <input_path> <output_path>")
-	sys.exit(1)
+VGM_SUFFIXES = ['.vgm', '.vgz']
 
-input_path = sys.argv[1]
-output_path = sys.argv[2]
+class ConversionResult:
+	def __init__(self, input_path, output_path):
+		self.input_path = input_path
+		self.output_path = output_path
+		self.input_size = 0
+		self.output_size = 0
+		self.pcm_size = 0
+		self.skipped = False
+		self.error = None
+		self.log = None
+		# VGMProfile.report() if profiling
+		self.profile = None
 
-# Read and convert input
+def convert_file(input_path, output_path, encode_jobs=None, profile=None):
+	# Read input
 
-vgm = VGMReader.read(input_path)
-processor = VGMPreprocessor()
-processed_vgm = processor.preprocess(vgm, rewrite_pcm=True, byteswap_pcm=False)
+	if profile is None:
+		profile = DISABLED_PROFILE
 
-# Write converted output
+	with profile.stage('read'):
+		vgm = VGMReader.read(input_path)
 
-with open(output_path, 'wb') as output_file:
-	output_file.write(processed_vgm.data)
+	# Convert and write output (in chunks, as it's converted)
+	# A partially written output is never left behind if conversion fails
+
+	# Converted files can't be seeked into, so no keyframes are recorded
+	processor = VGMPreprocessor(encode_jobs=encode_jobs, keyframe_interval=None, profile=profile)
+
+	partial_path = str(output_path) + '.part'
+	try:
+		with open(partial_path, 'wb') as output_file:
+			processed_vgm = processor.preprocess_to_file(vgm, output_file, rewrite_pcm=True, byteswap_pcm=False)
+
+		os.replace(partial_path, output_path)
+	except BaseException:
+		# Conversion calls sys.exit() for unsupported input, so SystemExit is handled the same as errors
+		if os.path.exists(partial_path):
+			os.remove(partial_path)
+		raise
+
+	result = ConversionResult(input_path, output_path)
+	result.input_size = os.path.getsize(input_path)
+	result.output_size = os.path.getsize(output_path)
+	result.pcm_size = sum(len(block.data) for block in processed_vgm.pcm_blocks)
+
+	return result
+
+def convert_file_isolated(input_path, output_path, encode_jobs=None, log_level=None, profiling=False):
+	# Batch conversion entry point: conversion output is captured and failures are returned rather than raised
+	# Conversion calls sys.exit() for unsupported input so SystemExit is caught here too
+	# The log level is passed in since this can run in a worker process
+	if log_level is not None:
+		log.level = log_level
+
+	profile = VGMProfile() if profiling else None
+	output = io.StringIO()
+
+	try:
+		with contextlib.redirect_stdout(output):
+			result = convert_file(input_path, output_path, encode_jobs, profile)
+
+		if profile is not None:
+			result.profile = profile.report()
+
+		return result
+	except (Exception, SystemExit) as e:
+		result = ConversionResult(input_path, output_path)
+		result.error = "".join(traceback.format_exception_only(type(e), e)).strip()
+		result.log = output.getvalue()
+		return result
+
+def is_up_to_date(input_path, output_path):
+	try:
+		return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+	except OSError:
+		return False
+
+def convert_file_in_worker(input_path, output_path, log_level=None, profiling=False):
+	# Converts one file in its own worker process, so a worker that dies only fails this file
+	with ProcessPoolExecutor(max_workers=1) as executor:
+		future = executor.submit(convert_file_isolated, input_path, output_path, encode_jobs=1,
+			log_level=log_level, profiling=profiling)
+
+		try:
+			return future.result()
+		except BrokenProcessPool:
+			# convert_file() couldn't remove its partial output since the process was killed
+			partial_path = str(output_path) + '.part'
+			if os.path.exists(partial_path):
+				os.remove(partial_path)
+
+			result = ConversionResult(input_path, output_path)
+			result.error = "conversion process exited unexpectedly"
+			return result
+
+def batch_inputs(paths):
+	# Expands directories (recursively) and glob patterns into (input_path, relative_output_path) pairs
+	inputs = []
+
+	for path in paths:
+		if os.path.isdir(path):
+			root = Path(path)
+			for input_path in sorted(root.rglob('*')):
+				if input_path.suffix.lower() in VGM_SUFFIXES and input_path.is_file():
+					inputs.append((input_path, input_path.relative_to(root)))
+		elif glob.has_magic(path):
+			for input_path in sorted(glob.glob(path, recursive=True)):
+				if os.path.isfile(input_path):
+					inputs.append((Path(input_path), Path(Path(input_path).name)))
+		else:
+			inputs.append((Path(path), Path(Path(path).name)))
+
+	return inputs
+
+def convert_batch(paths, output_dir, jobs, force=False, profile=None):
+	# Stage times and counters of all converted files are added to profile
+	pending = []
+	skipped = []
+
+	# Each output path can only be written by one input, or workers would race on the same file
+	# The same input reached more than once (such as through two globs) is only converted once
+	output_inputs = {}
+	conflicts = []
+
+	for (input_path, relative_path) in batch_inputs(paths):
+		output_path = Path(output_dir) / relative_path.with_suffix('.vgm')
+
+		previous_input = output_inputs.get(output_path)
+		if previous_input is not None:
+			if previous_input.resolve() != input_path.resolve():
+				conflicts.append((output_path, previous_input, input_path))
+			continue
+
+		output_inputs[output_path] = input_path
+
+		if not force and is_up_to_date(input_path, output_path):
+			result = ConversionResult(input_path, output_path)
+			result.skipped = True
+			skipped.append(result)
+			continue
+
+		output_path.parent.mkdir(parents=True, exist_ok=True)
+		pending.append((input_path, output_path))
+
+	if conflicts:
+		for (output_path, first_input, second_input) in conflicts:
+			print("Error: {:s} and {:s} would both be converted to {:s}"
+				.format(str(first_input), str(second_input), str(output_path)))
+
+		return False
+
+	print("Converting {:d} files ({:d} up to date) with {:d} jobs..."
+		.format(len(pending), len(skipped), jobs))
+
+	start_time = time.monotonic()
+	results = []
+
+	def report(result):
+		if result.error is not None:
+			print("FAILED: {:s}: {:s}".format(str(result.input_path), result.error))
+			if result.log:
+				print(result.log.rstrip())
+		else:
+			print("Converted: {:s}".format(str(result.input_path)))
+
+		results.append(result)
+
+	if jobs > 1:
+		# Files are already converted in parallel so each one encodes its DAC blocks serially
+		# A worker that dies (killed, out of memory) breaks the pool and every conversion still running in it
+		# Those are converted again one at a time, so only the file that kills its worker fails
+		broken = []
+
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			futures = [(paths, executor.submit(convert_file_isolated, *paths, encode_jobs=1, log_level=log.level,
+				profiling=profile is not None)) for paths in pending]
+			for (paths, future) in futures:
+				try:
+					report(future.result())
+				except BrokenProcessPool:
+					broken.append(paths)
+
+		for paths in broken:
+			report(convert_file_in_worker(*paths, log_level=log.level, profiling=profile is not None))
+	else:
+		for paths in pending:
+			report(convert_file_isolated(*paths, profiling=profile is not None))
+
+	elapsed = time.monotonic() - start_time
+
+	converted = [result for result in results if result.error is None]
+	failed = [result for result in results if result.error is not None]
+
+	if profile is not None:
+		for result in converted:
+			profile.merge_report(result.profile)
+			profile.count('files')
+
+	input_size = sum(result.input_size for result in converted)
+	pcm_size = sum(result.pcm_size for result in converted)
+
+	print()
+	print("Converted: {:d}, skipped (up to date): {:d}, failed: {:d}"
+		.format(len(converted), len(skipped), len(failed)))
+	print("Elapsed: {:.2f}s, {:.2f} files/s, {:.2f} MB/s input"
+		.format(elapsed, len(converted) / max(elapsed, 1e-9), input_size / 1e6 / max(elapsed, 1e-9)))
+	print("Total PCM: {:X} bytes".format(pcm_size))
+
+	for result in failed:
+		print("Failed: {:s}".format(str(result.input_path)))
+
+	return len(failed) == 0
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="Convert YM2612 + SN76489 / YM2610 VGMs to YM2610B VGMs",
+		usage="%(prog)s <input_path> <output_path>\n"
+			"       %(prog)s --output-dir <dir> [--jobs N] [--force] <input_dir_or_glob>...")
+	parser.add_argument('paths', nargs='+', help="input and output path, or inputs in batch mode")
+	parser.add_argument('--output-dir', help="batch mode: convert all inputs (directories or globs) into this directory")
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="batch mode: number of parallel conversions")
+	parser.add_argument('--force', action='store_true', help="batch mode: convert even if the output is up to date")
+	parser.add_argument('-v', '--verbose', action='count', default=0, help="show conversion details (-vv for more)")
+	parser.add_argument('--profile', nargs='?', const='-', metavar='PATH',
+		help="write stage times and counters as JSON to PATH (or stdout, with batch progress moved to stderr)")
+	args = parser.parse_args()
+
+	log.level = verbosity_log_level(args.verbose)
+	profile = VGMProfile() if args.profile is not None else None
+
+	if args.output_dir is not None:
+		# Progress and the summary go to stderr if the report is written to stdout, so it can be parsed as JSON
+		progress_output = sys.stderr if args.profile == '-' else sys.stdout
+		with contextlib.redirect_stdout(progress_output):
+			success = convert_batch(args.paths, args.output_dir, max(args.jobs, 1), args.force, profile)
+
+		if profile is not None:
+			profile.write_report(args.profile)
+
+		sys.exit(0 if success else 1)
+
+	if len(args.paths) != 2:
+		parser.print_usage()
+		sys.exit(1)
+
+	(input_path, output_path) = args.paths
+	convert_file(input_path, output_path, profile=profile)
+
+	if profile is not None:
+		profile.write_report(args.profile)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+# vgm_daemon.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Long running player that keeps the board open and plays a queue of tracks
+#
+# Commands are sent over a Unix socket as one JSON object per line, each answered with one JSON object:
+# {"command": "enqueue", "paths": [...]}, {"command": "skip"}, {"command": "stop"}, {"command": "status"}
+# This script is also the client: "vgm_daemon.py serve" starts the daemon, then enqueue / skip / stop / status
+#
+# While a track plays, the next one is preprocessed (into the preprocessed VGM cache) and placed in PSRAM ahead of time
+# in a separate process, so switching tracks only uploads the PCM that isn't already resident
+# and the start of the command data
+#
+# The firmware has no end of track report, so tracks are switched once they've played for their length
+# Looping tracks play through their loop --loops times
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import socketserver
+import multiprocessing
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from vgm_preprocess import VGMPreprocessor
+from vgm_segments import VGMSegmentList
+from vgm_profile import log
+from vgm_profile import verbosity_log_level
+from usb_upload import USBUploader
+from usb_upload import UploadRange
+from usb_upload import WriteMode
+from usb_ctrl import open_device
+from usb_ctrl import read_status
+from usb_ctrl import read_processed_vgm
+from usb_ctrl import load_psram_pool
+from usb_ctrl import upload_pcm_blocks
+from usb_ctrl import upload_vgm
+from usb_ctrl import pcm_write_mode
+from usb_ctrl import VGMRefiller
+from vgm_refill import VGMTimeline
+from vgm_refill import RefillMetrics
+from vgm_refill import RefillChunkTable
+from vgm_refill import MetricsReporter
+
+def default_socket_path():
+	runtime_dir = os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())
+	return Path(runtime_dir) / 'ym2610-pcb.sock'
+
+def stage_track(vgm_path, pool, loops, log_level):
+	# Runs in the staging process: preprocesses the track (or loads it from the cache) and places it in a copy of
+	# the daemon's PSRAM pool, so none of this competes with buffer refills in the daemon process
+	log.level = log_level
+
+	try:
+		processed_vgm = read_processed_vgm(vgm_path)
+	except SystemExit:
+		raise RuntimeError("couldn't preprocess: {:s}".format(vgm_path))
+
+	upload_blocks = pool.place(processed_vgm)
+
+	# Only the serialized data is sent back to the daemon, the same as a track loaded from the cache
+	# PCM blocks and the conversion segments are views of the input or cache entry, which can't be pickled
+	processed_vgm.segments = VGMSegmentList()
+	processed_vgm.header = processed_vgm.data[0x00 : 0x100]
+	for keyframe in processed_vgm.keyframes:
+		keyframe.mark = None
+
+	for block in processed_vgm.pcm_blocks:
+		block.data = bytes(block.data)
+
+	return Track(vgm_path, processed_vgm, upload_blocks, pool, loops)
+
+def track_duration(processed_vgm, timeline, loops):
+	# Seconds to play the track for, including loops after the first play through
+	total_samples = int.from_bytes(processed_vgm.header[0x18 : 0x1c], 'little')
+	loop_samples = int.from_bytes(processed_vgm.header[0x20 : 0x24], 'little')
+
+	if total_samples == 0:
+		# Not given in the header, so it's counted from the delays instead
+		total_samples = timeline.samples_at(len(processed_vgm.data))
+		loop_samples = total_samples - timeline.samples_at(processed_vgm.loop_index())
+
+	if processed_vgm.loop_index() > 0:
+		total_samples += loop_samples * (loops - 1)
+
+	return total_samples / VGMPreprocessor.SAMPLE_RATE
+
+def silence_vgm():
+	# Keys off all FM / PCM channels and mutes the SSG, then waits (and restarts since there's no loop)
+	data = bytearray(0x100)
+	data[0x00 : 0x04] = b'Vgm '
+	data[0x08 : 0x0c] = (0x171).to_bytes(4, 'little')
+	data[0x34 : 0x38] = (0x100 - 0x34).to_bytes(4, 'little')
+	data[0x4c : 0x50] = (8000000 | 1 << 31).to_bytes(4, 'little')
+
+	for channel in [0x00, 0x01, 0x02, 0x04, 0x05, 0x06]:
+		data.extend([0x58, 0x28, channel])
+
+	# ADPCM-A dump, ADPCM-B reset
+	data.extend([0x59, 0x00, 0xbf, 0x58, 0x10, 0x01])
+
+	for channel in range(3):
+		data.extend([0x58, 0x08 + channel, 0x00])
+
+	data.extend([0x61, 0xff, 0xff, 0x66])
+	data[0x04 : 0x08] = (len(data) - 0x04).to_bytes(4, 'little')
+
+	return data
+
+class Track:
+	def __init__(self, path, processed_vgm, upload_blocks, pool, loops):
+		self.path = path
+		self.processed_vgm = processed_vgm
+		self.timeline = VGMTimeline(processed_vgm.data)
+		self.chunks = RefillChunkTable(processed_vgm.data)
+		self.upload_blocks = upload_blocks
+		# PSRAM pool with this track placed in it, which replaces the daemon's pool once the track is uploaded
+		self.pool = pool
+		self.duration = track_duration(processed_vgm, self.timeline, loops)
+		self.started_at = None
+
+class PlaybackDaemon:
+	STATUS_TIMEOUT_MS = 20
+
+	def __init__(self, dev, data_ep, status_ep, uploader, pool, save_pool, loops, metrics_path=None, metrics_interval=10):
+		self.status_ep = status_ep
+		self.uploader = uploader
+		self.pool = pool
+		self.save_pool = save_pool
+		self.loops = loops
+
+		# Shared with the command handlers
+		self.lock = threading.Lock()
+		self.queue = deque()
+		self.skip_requested = False
+		self.stop_requested = False
+
+		# Track being staged (a Future of a Track, from the staging process) and its path
+		self.staged = None
+		self.staged_path = None
+
+		self.current = None
+
+		self.metrics = RefillMetrics()
+		self.refiller = VGMRefiller(dev, data_ep, self.metrics)
+		self.reporter = None
+		if metrics_path is not None:
+			self.reporter = MetricsReporter(self.metrics, metrics_path, metrics_interval)
+
+		self.stopping_event = threading.Event()
+
+		# Staging is CPU bound so it's kept out of this process, where it would delay buffer refills
+		context = multiprocessing.get_context('spawn')
+		self.stage_executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+
+	def close(self):
+		self.stage_executor.shutdown(wait=False, cancel_futures=True)
+
+	# Commands (called from the socket server threads)
+
+	def handle_command(self, request):
+		command = request.get('command')
+
+		with self.lock:
+			if command == 'enqueue':
+				paths = request.get('paths', [])
+				missing = [path for path in paths if not os.path.isfile(path)]
+				if missing:
+					return {'ok': False, 'error': "not found: {:s}".format(', '.join(missing))}
+
+				self.queue.extend(paths)
+				return {'ok': True, 'queued': len(self.queue)}
+			elif command == 'skip':
+				self.skip_requested = True
+				return {'ok': True}
+			elif command == 'stop':
+				self.queue.clear()
+				self.stop_requested = True
+				return {'ok': True}
+			elif command == 'status':
+				return {'ok': True, 'status': self.status()}
+
+		return {'ok': False, 'error': "unknown command: {:s}".format(str(command))}
+
+	def status(self):
+		current = None
+		if self.current is not None:
+			current = {
+				'path': self.current.path,
+				'elapsed': time.monotonic() - self.current.started_at,
+				'duration': self.current.duration
+			}
+
+		return {
+			'state': 'playing' if self.current is not None else 'idle',
+			'current': current,
+			'next': self.staged_path,
+			'next_ready': self.staged is not None and self.staged.done(),
+			'queue': list(self.queue),
+			'refill': self.metrics.summary()
+		}
+
+	# Playback (all on the thread calling run())
+
+	def run(self):
+		while not self.stopping_event.is_set():
+			status_data = read_status(self.status_ep, PlaybackDaemon.STATUS_TIMEOUT_MS)
+			if status_data is not None:
+				self.refiller.handle_status(status_data, time.perf_counter())
+
+			self.update()
+
+			if self.reporter is not None:
+				self.reporter.update(track=self.current.path if self.current is not None else None)
+
+	def update(self):
+		with self.lock:
+			stop = self.stop_requested
+			skip = self.skip_requested
+			self.stop_requested = False
+
+			if stop:
+				self.skip_requested = False
+				self.discard_staged()
+
+			# Staged against the pool as it is now, which only changes when a track is switched to
+			if self.staged is None and self.queue:
+				self.staged_path = self.queue.popleft()
+				self.staged = self.stage_executor.submit(stage_track, self.staged_path, self.pool.copy(), self.loops,
+					log.level)
+
+			staged = self.staged
+
+		if stop:
+			if self.current is not None:
+				self.play_silence()
+
+			return
+
+		track_ended = self.current is not None and time.monotonic() >= self.current.started_at + self.current.duration
+		if not (skip or track_ended or self.current is None):
+			return
+
+		# The current track keeps playing (or looping) until the next one is ready
+		if staged is not None and not staged.done():
+			return
+
+		with self.lock:
+			self.skip_requested = False
+			self.staged = None
+			self.staged_path = None
+
+		if staged is None:
+			# Nothing left to play
+			if self.current is not None:
+				self.play_silence()
+
+			return
+
+		try:
+			track = staged.result()
+		except Exception as e:
+			log.error("Couldn't stage track: {:s}", str(e))
+			return
+
+		self.play(track)
+
+	def discard_staged(self):
+		# Called with the lock held, the staged pool is dropped so nothing placed in it is assumed to be resident
+		if self.staged is not None:
+			self.staged.cancel()
+			self.staged = None
+			self.staged_path = None
+
+	def halt_playback(self, pool, track=None):
+		# The firmware only stops playback when PCM data is written (VGM writes don't stop it)
+		# This keeps it from playing commands that are being overwritten by the next VGM upload
+		#
+		# A few bytes are written to a bank that holds nothing resident, evicting a region from pool if needed
+		# Only regions used by track are kept, so this only fails if its own PCM fills every bank
+		# Then the start of one of its blocks is written, which is either resident already or uploaded next
+		keep_regions = pool.last_placed_regions() if track is not None else ()
+		offset = pool.scratch_offset(keep_regions)
+
+		if offset is not None:
+			halt_range = UploadRange(WriteMode.PCM_A, offset)
+			halt_range.append(bytes(4))
+		else:
+			block = max(track.processed_vgm.pcm_blocks, key=lambda block: len(block.data))
+			halt_range = UploadRange(pcm_write_mode(block), block.remapped_offset)
+			halt_range.append(memoryview(block.data)[0 : min(len(block.data), 0x40) & ~3])
+
+		self.uploader.upload([halt_range])
+
+	def play(self, track):
+		print("Playing: {:s}".format(track.path))
+
+		self.save_pool(None)
+		self.halt_playback(track.pool, track)
+
+		upload_pcm_blocks(self.uploader, track.upload_blocks)
+		self.pool = track.pool
+		self.save_pool(self.pool)
+
+		self.start_vgm(track.processed_vgm.data, track.timeline, track.chunks)
+
+		# Status is read by the server threads, which must never see the new track without its start time
+		track.started_at = time.monotonic()
+		with self.lock:
+			self.current = track
+
+	def play_silence(self):
+		print("Stopped")
+
+		self.save_pool(None)
+		self.halt_playback(self.pool)
+		self.save_pool(self.pool)
+
+		self.start_vgm(silence_vgm())
+		with self.lock:
+			self.current = None
+
+	def start_vgm(self, vgm_data, timeline=None, chunks=None):
+		self.refiller.start(vgm_data, timeline, chunks)
+		upload_vgm(self.uploader, vgm_data)
+
+class CommandHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				request = json.loads(line)
+			except ValueError:
+				reply = {'ok': False, 'error': "invalid request"}
+			else:
+				reply = self.server.player.handle_command(request)
+
+			self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+def send_command(socket_path, request):
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		try:
+			client.connect(str(socket_path))
+		except OSError:
+			print("Couldn't connect to the daemon at: {:s}".format(str(socket_path)))
+			sys.exit(1)
+
+		client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+		reply = client.makefile('r').readline()
+
+	return json.loads(reply)
+
+def daemon_running(socket_path):
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		try:
+			client.connect(str(socket_path))
+		except OSError:
+			return False
+
+	return True
+
+def serve(args):
+	socket_path = Path(args.socket)
+	if daemon_running(socket_path):
+		print("A daemon is already running at: {:s}".format(str(socket_path)))
+		sys.exit(1)
+
+	# Left behind by a daemon that didn't exit cleanly
+	socket_path.unlink(missing_ok=True)
+
+	(dev, data_ep, status_ep) = open_device()
+	uploader = USBUploader(dev, data_ep)
+	(pool, save_pool) = load_psram_pool(dev, args.upload_all_pcm)
+
+	player = PlaybackDaemon(dev, data_ep, status_ep, uploader, pool, save_pool, args.loops,
+		args.metrics, args.metrics_interval)
+	reply = player.handle_command({'command': 'enqueue', 'paths': [str(Path(path).resolve()) for path in args.vgm_paths]})
+	if not reply['ok']:
+		print("Error: {:s}".format(reply['error']))
+		sys.exit(1)
+
+	server = socketserver.ThreadingUnixStreamServer(str(socket_path), CommandHandler)
+	server.daemon_threads = True
+	server.player = player
+	os.chmod(socket_path, 0o600)
+
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: player.stopping_event.set())
+
+	print("Listening on: {:s}".format(str(socket_path)))
+
+	try:
+		player.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.shutdown()
+		server.server_close()
+		socket_path.unlink(missing_ok=True)
+		player.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Play a queue of VGMs over USB, controlled through a Unix socket")
+	parser.add_argument('--socket', default=str(default_socket_path()), help="socket path (default %(default)s)")
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	serve_parser = subparsers.add_parser('serve', help="run the daemon")
+	serve_parser.add_argument('vgm_paths', nargs='*', help="VGM / VGZ files to queue")
+	serve_parser.add_argument('--loops', type=int, default=2, help="times to play looping tracks through (default 2)")
+	serve_parser.add_argument('--upload-all-pcm', action='store_true',
+		help="upload all PCM blocks of the first track, even those that earlier tracks left in PSRAM")
+	serve_parser.add_argument('--metrics', nargs='?', const='-', metavar='PATH',
+		help="append a JSON summary of buffer refills to PATH (or stdout) every --metrics-interval seconds")
+	serve_parser.add_argument('--metrics-interval', type=float, default=10, metavar='SECONDS',
+		help="seconds between refill summaries (default 10)")
+	serve_parser.add_argument('-v', '--verbose', action='count', default=0, help="show preprocessing details")
+
+	enqueue_parser = subparsers.add_parser('enqueue', help="add tracks to the end of the queue")
+	enqueue_parser.add_argument('vgm_paths', nargs='+', help="VGM / VGZ files to queue")
+
+	subparsers.add_parser('skip', help="switch to the next track")
+	subparsers.add_parser('stop', help="stop playback and clear the queue")
+	subparsers.add_parser('status', help="show the current track and queue")
+
+	args = parser.parse_args()
+
+	if args.command == 'serve':
+		log.level = verbosity_log_level(args.verbose)
+		serve(args)
+		return
+
+	request = {'command': args.command}
+	if args.command == 'enqueue':
+		request['paths'] = [str(Path(path).resolve()) for path in args.vgm_paths]
+
+	reply = send_command(args.socket, request)
+	if not reply['ok']:
+		print("Error: {:s}".format(reply['error']))
+		sys.exit(1)
+
+	if args.command == 'status':
+		print(json.dumps(reply['status'], indent=1))
+
+if __name__ == '__main__':
+	main()
@@ -8,100 +8,47 @@
 
 import sys
 
-class VGMInserter:
-	def __init__(self, processed_vgm, base_index):
-		self.processed_vgm = processed_vgm
-		self.index = base_index
-		self.base_timestamp = 0
-
-	def insert_commands(self, command_bytes, timestamp):
-		data = self.processed_vgm.data
-		while self.index < len(data):
-			if self.base_timestamp >= timestamp:
-				break
-
-			cmd = data[self.index]
-
-			index_delta = self.non_delay_cmd(cmd)
-			if index_delta is not None:
-				self.index += index_delta
-				continue
-
-			delay_t = self.delay_cmd(cmd, data[self.index + 1 : self.index + 9])
-			if delay_t is not None:
-				self.base_timestamp += delay_t[0]
-				self.index += delay_t[1]
-				continue
-
-			if cmd == 0x66:
-				break
-
-			print("VGMInserter: unexpected cmd: {:X} @ {:X}".format(cmd, self.index))
-			sys.exit(1)
-
-		# If we land in the middle of a delay, could split the command
-		# This shouldn't be needed unless the DAC stream commands are used
-
-		data[self.index : self.index] = command_bytes
-
-		# Displace loop offset if the newly inserted commands affect it
-		if self.processed_vgm.loop_index() >= self.index:
-			self.processed_vgm.displace_loop_offset(len(command_bytes))
-
-		print("VGMInserter: inserted ADPCM-B cmd at index: {:X}".format(self.index))
-
-	def delay_cmd(self, cmd, payload):
-		if (cmd & 0xf0) == 0x70:
-			return ((cmd & 0x0f) + 1, 1)
-		if cmd == 0x62:
-			return (735, 1)
-		if cmd == 0x63:
-			return (882, 1)
-		if cmd == 0x61:
-			return (int.from_bytes(payload[0 : 2], 'little'), 3)
-
-		return None
-
-	def non_delay_cmd(self, cmd):
-		command_lengths = [
-			([0x52, 0x53, 0x58, 0x59], 3),
-		]
-
-		for t in command_lengths:
-			if cmd in t[0]:
-				return t[1]
-
-		return None
-
-## TODO: relocate
+from vgm_profile import log
 
 class DACCommandInserter:
-	def __init__(self, processed_vgm, dac_sample_blocks):
-		base_index = processed_vgm.read_header_offset(0x34)
-		self.inserter = VGMInserter(processed_vgm, base_index)
+	def __init__(self, dac_sample_blocks, encoded_blocks):
 		self.dac_sample_blocks = dac_sample_blocks
-		self.processed_vgm = processed_vgm
-		self.encoded_blocks = processed_vgm.pcm_blocks
+		self.encoded_blocks = encoded_blocks
+
+	def triggers(self):
+		# ADPCM-B commands to play each encoded block, as (timestamp, commands) in ascending timestamp order
+		# The commands are merged into the output as it's written, at exactly this sample
+		# Any delay that a trigger lands in is split around it
+		# encoded_blocks can contain the same block more than once, its commands are only built once
+		triggers = []
+		commands_by_block = {}
 
-	def insert(self):
 		base_timestamp = 0
 		for index in range(0, len(self.dac_sample_blocks)):
 			source_block = self.dac_sample_blocks[index]
 			encoded_block = self.encoded_blocks[index]
 
-			commands = self.adpcmb_play_commands(encoded_block)
 			if source_block.timestamp < base_timestamp:
-				print("DACCommandInserter: expected timestamps to be in ascending order")
+				log.error("DACCommandInserter: expected timestamps to be in ascending order")
 				sys.exit(1)
 
-			self.inserter.insert_commands(commands, source_block.timestamp)
+			base_timestamp = source_block.timestamp
+
+			commands = commands_by_block.get(id(encoded_block))
+			if commands is None:
+				commands = self.adpcmb_play_commands(encoded_block)
+				commands_by_block[id(encoded_block)] = commands
+
+			triggers.append((source_block.timestamp, commands))
+
+		return triggers
 
 	def adpcmb_play_commands(self, encoded_block):
 		adpcmb_44p1khz = 0xCB6B
 		start_address = encoded_block.remapped_offset >> 8
 		end_address = start_address + (len(encoded_block.data) >> 8) - 1
 
-		return [
+		return bytes([
 			# Reset
 			0x58, 0x10, 0x01,
 			0x58, 0x10, 0x00,
@@ -124,5 +71,4 @@ class DACCommandInserter:
 
 			# Start
 			0x58, 0x10, 0x80
-		]
-
+		])
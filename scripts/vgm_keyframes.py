@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# vgm_keyframes.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# YM2610B register snapshots ("keyframes") taken periodically as the output VGM is written
+#
+# Playback can start at any keyframe by first writing a short preamble that restores the registers
+# The preamble only depends on the snapshot, so seeking costs the same regardless of the keyframe's position
+
+import bisect
+
+class OPNBRegisterFile:
+	# Tracks the last value written to each register (port 0: 0x000-0x0ff, port 1: 0x100-0x1ff)
+	# Registers that were never written are left alone when restoring
+
+	def __init__(self):
+		self.registers = bytearray(0x200)
+		self.written = bytearray(0x200)
+
+	def write(self, address, data):
+		self.registers[address] = data
+		self.written[address] = 1
+
+	def write_commands(self, commands):
+		# commands is a sequence of 0x58 / 0x59 register writes
+		for index in range(0, len(commands), 3):
+			address = commands[index + 1]
+			if commands[index] == 0x59:
+				address += 0x100
+
+			self.write(address, commands[index + 2])
+
+class DisabledRegisterFile:
+	# Stands in for OPNBRegisterFile when no keyframes are recorded, so register writes cost nothing to track
+	def write(self, address, data):
+		pass
+
+	def write_commands(self, commands):
+		pass
+
+DISABLED_REGISTER_FILE = DisabledRegisterFile()
+
+class VGMKeyframe:
+	def __init__(self, sample_time, registers, written, mark=None, offset=None):
+		self.sample_time = sample_time
+		self.registers = registers
+		self.written = written
+		# Output position of the first command after the keyframe
+		# The mark is resolved to an offset once the output is laid out
+		self.mark = mark
+		self.offset = offset
+
+	@classmethod
+	def capture(cls, sample_time, mark, register_file):
+		return cls(sample_time, bytearray(register_file.registers), bytes(register_file.written), mark=mark)
+
+	def restore_commands(self):
+		# Register writes that put the chip in the state it would be in had playback started from the beginning
+		# Notes and samples that were already playing aren't restarted, they resume on their next key on
+		commands = bytearray()
+
+		def write(address, data):
+			commands.extend([0x59 if address >= 0x100 else 0x58, address & 0xff, data])
+
+		def restore(addresses):
+			for address in addresses:
+				if self.written[address]:
+					write(address, self.registers[address])
+
+		# Silence anything left playing: FM key off, ADPCM-A dump, ADPCM-B reset
+		for channel in [0, 1, 2, 4, 5, 6]:
+			write(0x28, channel)
+
+		write(0x100, 0xbf)
+		write(0x010, 0x01)
+		write(0x010, 0x00)
+
+		# SSG
+		restore(range(0x00, 0x0e))
+
+		# ADPCM-B (everything but the control register, which would start playback)
+		restore(range(0x11, 0x1c))
+
+		# ADPCM flag control, LFO
+		restore([0x1c, 0x22])
+
+		# Timer / CH3 mode: only the CH3 mode bits, the timers aren't used
+		if self.written[0x27]:
+			write(0x27, self.registers[0x27] & 0xc0)
+
+		# FM operators and channels on both ports
+		# F-number high bytes are latched, so they're written before the low bytes
+		for port in [0x000, 0x100]:
+			restore(range(port + 0x30, port + 0xa0))
+
+			for channel in range(3):
+				restore([port + 0xa4 + channel, port + 0xa0 + channel])
+
+			for channel in range(3):
+				restore([port + 0xac + channel, port + 0xa8 + channel])
+
+			restore(range(port + 0xb0, port + 0xb7))
+
+		# ADPCM-A (everything but the key on register)
+		restore(range(0x101, 0x130))
+
+		return commands
+
+def find_keyframe(keyframes, sample_time):
+	# Last keyframe at or before sample_time
+	index = bisect.bisect_right([keyframe.sample_time for keyframe in keyframes], sample_time)
+	return keyframes[max(index - 1, 0)]
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# vgm_memory.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Peak memory of VGM conversion for synthetic inputs of increasing length and PCM size (see vgm_synth.py)
+#
+# Each conversion runs in a new process so its peak RSS isn't affected by earlier ones
+# Peak traced memory (tracemalloc) is recorded for each preprocessing stage, which covers Python allocations only
+# Peak RSS also includes the interpreter itself and any pages of the memory mapped input that were read
+#
+# Conversions can be checked against budgets for the peak traced memory, per MB of input and per minute of playback
+# The growth between sizes is also shown, which is what sets the ceiling for longer tracks
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from vgm_preprocess import VGMPreprocessor
+from vgm_reader import VGMReader
+from vgm_synth import CORPUS
+from vgm_synth import SAMPLE_RATE
+from vgm_profile import VGMProfile
+from vgm_profile import log
+from vgm_profile import ERROR
+
+MB = 1024 * 1024
+
+def peak_rss():
+	# ru_maxrss is in KB on Linux and bytes on macOS
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def measure_conversion(vgm_path, in_memory):
+	# Runs in its own process, returns the profile report with the peak memory of each stage
+	log.level = ERROR
+
+	profile = VGMProfile(trace_memory=True)
+	# Conversion to a file doesn't record keyframes, same as vgm_convert.py
+	keyframe_interval = 1 if in_memory else None
+	processor = VGMPreprocessor(encode_jobs=1, keyframe_interval=keyframe_interval, profile=profile)
+
+	tracemalloc.start()
+
+	with profile.stage('total'):
+		with profile.stage('read'):
+			vgm = VGMReader.read(vgm_path)
+
+		if in_memory:
+			processor.preprocess(vgm, rewrite_pcm=True, byteswap_pcm=False)
+		else:
+			with open(os.devnull, 'wb') as output_file:
+				processor.preprocess_to_file(vgm, output_file, rewrite_pcm=True, byteswap_pcm=False)
+
+	tracemalloc.stop()
+
+	report = profile.report()
+	report['peak_rss'] = peak_rss()
+	return report
+
+def measure(vgm, in_memory):
+	with tempfile.TemporaryDirectory() as temp_dir:
+		vgm_path = os.path.join(temp_dir, 'input.vgm')
+		with open(vgm_path, 'wb') as file:
+			file.write(vgm)
+
+		# Spawned rather than forked so the parent's memory isn't counted
+		context = multiprocessing.get_context('spawn')
+		with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+			return executor.submit(measure_conversion, vgm_path, in_memory).result()
+
+def vgm_minutes(vgm):
+	total_samples = int.from_bytes(vgm[0x18 : 0x1c], 'little')
+	return total_samples / SAMPLE_RATE / 60
+
+def run_case(name, scales, in_memory):
+	results = []
+
+	for scale in scales:
+		vgm = CORPUS[name](scale)
+		report = measure(vgm, in_memory)
+
+		stage_peaks = {stage: stage_report['peak_memory'] for (stage, stage_report) in report['stages'].items()}
+		results.append({
+			'case': name,
+			'scale': scale,
+			'input_mb': len(vgm) / MB,
+			'pcm_mb': report['counters'].get('pcm_bytes', 0) / MB,
+			'minutes': vgm_minutes(vgm),
+			'peak_mb': stage_peaks['total'] / MB,
+			'peak_rss_mb': report['peak_rss'] / MB,
+			'stage_peak_mb': {stage: peak / MB for (stage, peak) in stage_peaks.items() if stage != 'total'}
+		})
+
+	return results
+
+def print_results(results):
+	print("{:<16s} {:>5s} {:>8s} {:>8s} {:>8s} {:>10s} {:>10s}  {:s}"
+		.format("Case", "Scale", "Minutes", "Input", "PCM", "Peak", "Peak RSS", "Largest stage"))
+
+	for result in results:
+		stage_peaks = result['stage_peak_mb']
+		largest_stage = max(stage_peaks, key=stage_peaks.get)
+
+		print("{:<16s} {:5d} {:8.2f} {:7.2f}M {:7.2f}M {:9.2f}M {:9.2f}M  {:s} ({:.2f}M)"
+			.format(result['case'], result['scale'], result['minutes'], result['input_mb'], result['pcm_mb'],
+				result['peak_mb'], result['peak_rss_mb'], largest_stage, stage_peaks[largest_stage]))
+
+def print_growth(results):
+	# Peak memory growth between the smallest and largest scale of each case
+	print()
+	print("{:<16s} {:>14s} {:>14s}".format("Case", "MB per minute", "MB per input MB"))
+
+	for name in dict.fromkeys(result['case'] for result in results):
+		case_results = [result for result in results if result['case'] == name]
+		if len(case_results) < 2:
+			continue
+
+		(first, last) = (case_results[0], case_results[-1])
+		peak_growth = last['peak_mb'] - first['peak_mb']
+
+		print("{:<16s} {:14.3f} {:14.3f}".format(name,
+			peak_growth / max(last['minutes'] - first['minutes'], 1e-9),
+			peak_growth / max(last['input_mb'] - first['input_mb'], 1e-9)))
+
+def check_budgets(results, max_per_minute, max_per_input_mb, max_peak):
+	# Returns a description of each budget that was exceeded
+	exceeded = []
+
+	for result in results:
+		label = "{:s} x{:d}".format(result['case'], result['scale'])
+
+		if max_per_minute is not None and result['minutes'] > 0:
+			per_minute = result['peak_mb'] / result['minutes']
+			if per_minute > max_per_minute:
+				exceeded.append("{:s}: {:.2f}MB per minute (budget {:.2f})".format(label, per_minute, max_per_minute))
+
+		if max_per_input_mb is not None:
+			per_input_mb = result['peak_mb'] / result['input_mb']
+			if per_input_mb > max_per_input_mb:
+				exceeded.append("{:s}: {:.2f}MB per input MB (budget {:.2f})".format(label, per_input_mb, max_per_input_mb))
+
+		if max_peak is not None and result['peak_rss_mb'] > max_peak:
+			exceeded.append("{:s}: {:.2f}MB peak RSS (budget {:.2f})".format(label, result['peak_rss_mb'], max_peak))
+
+	return exceeded
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure peak memory of VGM conversion using synthetic VGMs")
+	parser.add_argument('--cases', default=','.join(CORPUS.keys()),
+		help="comma separated cases to run ({:s})".format(', '.join(CORPUS.keys())))
+	parser.add_argument('--scales', default='1,2,4', help="comma separated input sizes (1 is roughly 30 seconds)")
+	parser.add_argument('--in-memory', action='store_true',
+		help="keep the output in memory (as usb_ctrl.py does) instead of writing it out in chunks")
+	parser.add_argument('--max-mb-per-minute', type=float, help="budget: peak traced MB per minute of playback")
+	parser.add_argument('--max-mb-per-input-mb', type=float, help="budget: peak traced MB per MB of input")
+	parser.add_argument('--max-peak-mb', type=float, help="budget: peak RSS in MB")
+	parser.add_argument('--json', metavar='PATH', help="also write the results as JSON")
+	args = parser.parse_args()
+
+	cases = args.cases.split(',')
+	for name in cases:
+		if name not in CORPUS:
+			print("Unknown case: {:s}".format(name))
+			sys.exit(1)
+
+	scales = sorted(int(scale) for scale in args.scales.split(','))
+
+	results = []
+	for name in cases:
+		results.extend(run_case(name, scales, args.in_memory))
+
+	print_results(results)
+	print_growth(results)
+
+	if args.json is not None:
+		with open(args.json, 'w') as file:
+			json.dump(results, file, indent=1)
+			file.write('\n')
+
+	exceeded = check_budgets(results, args.max_mb_per_minute, args.max_mb_per_input_mb, args.max_peak_mb)
+	if exceeded:
+		print()
+		for message in exceeded:
+			print("Over budget: " + message)
+
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -7,18 +7,52 @@
 # SPDX-License-Identifier: MIT
 
 import sys
+import hashlib
+import tempfile
+from array import array
 from enum import Enum
 from psg_state import PSGState
 from opn_state import OPNState
 from ym2612_dac_state import YM2612DACState
-from delta_t_encoder import DeltaTEncoder
-from vgm_inserter import VGMInserter
+from dac_segmenter import DACSegmenter
+from delta_t_encoder import encode_dac_sample_blocks
 from vgm_inserter import DACCommandInserter
+from vgm_commands import COMMAND_LENGTHS
+from vgm_commands import DATA_BLOCK
+from vgm_commands import command_length
+from vgm_segments import VGMSegmentList
+from vgm_segments import VGMMark
+from sample_kernels import byte_swap_words
+from sample_kernels import byte_swap_words_in_place
+from vgm_keyframes import OPNBRegisterFile
+from vgm_keyframes import DISABLED_REGISTER_FILE
+from vgm_keyframes import VGMKeyframe
+from vgm_keyframes import find_keyframe
+from pcm_packer import PCMPacker
+from pcm_packer import PCMIntervalIndex
+from vgm_profile import log
+from vgm_profile import DISABLED_PROFILE
 
 class PCMType(Enum):
 	A = 0
 	B = 1
 
+def _build_adpcm_bank_registers():
+	# Indexed by (port << 8 | reg), these are the registers holding the high byte of an ADPCM address
+	registers = [None] * 0x200
+
+	# ADPCM-A start / end address (high)
+	for address in list(range(0x118, 0x11e)) + list(range(0x128, 0x12e)):
+		registers[address] = PCMType.A
+
+	# ADPCM-B start / end address (high)
+	for address in [0x013, 0x015]:
+		registers[address] = PCMType.B
+
+	return registers
+
+ADPCM_BANK_REGISTERS = _build_adpcm_bank_registers()
+
 class ChipType(Enum):
 	YM2610 = 0,
 	YM2610B = 1,
@@ -48,21 +82,7 @@ class PCMBlock:
 
 	@classmethod
 	def byte_swap(cls, data):
-		pcm_swapped = bytearray(len(data))
-
-		index = 0
-		while index < len(data):
-			temp = data[index + 0]
-			pcm_swapped[index + 0] = data[index + 3]
-			pcm_swapped[index + 3] = temp
-
-			temp = data[index + 1]
-			pcm_swapped[index + 1] = data[index + 2]
-			pcm_swapped[index + 2] = temp
-
-			index += 4
-
-		return pcm_swapped
+		return byte_swap_words(data)
 
 	@classmethod
 	def from_vgm(cls, vgm, index, byteswap_pcm):
@@ -73,21 +93,21 @@ class PCMBlock:
 		block_size = int.from_bytes(vgm[index + 3 : index + 7], 'little')
 		block_size -= 8
 		if block_size <= 0:
-			print("Expected PCM block size to be > 0")
+			log.warning("Expected PCM block size to be > 0")
 
-		print('PCM block size: {:X}'.format(block_size))
+		log.debug("PCM block size: {:X}", block_size)
 
 		block_total_size = int.from_bytes(vgm[index + 7 : index + 11], 'little')
 		if block_total_size == 0:
-			print('Expected total_size to be > 0')
+			log.error("Expected total_size to be > 0")
 			sys.exit(1)
 
 		offset = int.from_bytes(vgm[index + 11 : index + 15], 'little')
 
 		is_adpcm_a = (block_type == 0x82)
 
-		print("Found block: type ", "A" if is_adpcm_a else "B")
-		print("Size: {:X}, offset: {:X}, total: {:X}".format(block_size, offset, block_total_size))
+		log.debug("Found block: type {:s}", "A" if is_adpcm_a else "B")
+		log.debug("Size: {:X}, offset: {:X}, total: {:X}", block_size, offset, block_total_size)
 
 		pcm_block = PCMBlock()
 		pcm_block.offset = offset
@@ -101,7 +121,8 @@ class PCMBlock:
 		if block_size == 0:
 			return pcm_block
 
-		pcm_data = vgm[index + 15 : index + 15 + block_size]
+		# Kept as a view of the input, it's only copied if it has to be byte swapped
+		pcm_data = memoryview(vgm)[index + 15 : index + 15 + block_size]
 		if byteswap_pcm:
 			pcm_block.data = PCMBlock.byte_swap(pcm_data)
 		else:
@@ -129,68 +150,106 @@ class UncompressedBlock:
 
 		block = UncompressedBlock()
 		block_size = int.from_bytes(vgm[index + 3 : index + 7], 'little')
-		block.data = vgm[index + 7 : index + 7 + block_size]
+		block.data = memoryview(vgm)[index + 7 : index + 7 + block_size]
 
-		print("Uncompressed PCM block size: {:X}".format(block_size))
+		log.debug("Uncompressed PCM block size: {:X}", block_size)
 
 		return block
 
+def write_delay(output, samples):
+	# Only used for parts of existing delays, so samples always fits in a 16bit delay
+	if samples <= 16:
+		output.append(0x70 | (samples - 1))
+	else:
+		output.extend([0x61, samples & 0xff, samples >> 8])
+
 class ProcessedVGM:
 	def __init__(self):
+		self.header = bytearray()
+		self.segments = VGMSegmentList()
 		self.data = bytearray()
 		self.pcm_blocks = []
 
+		# VGMKeyframes in ascending sample_time order, each at a command boundary in the output
+		self.keyframes = []
+
 	def __repr__(self):
 		return "ProcessedVGM:\nCommand data length: {:X}\nPCM blocks: {:X}\n" \
 			.format(len(self.data), len(self.pcm_blocks))
 
-	# VGM writing:
+	# VGM header writing:
+	# The header is always the first segment, offsets in it are only resolved once segments are serialized
+
+	def relocate_header_offset(self, header_index, mark):
+		def resolve(position):
+			file_offset = position(mark) - header_index
+			return file_offset.to_bytes(4, 'little')
 
-	def write_header_offset(self, header_index, file_index):
-		file_offset = file_index - header_index
-		self.data[header_index : header_index + 4] = file_offset.to_bytes(4, 'little')
-		return file_offset
+		header_mark = VGMMark(self.segments, 0, header_index)
+		self.segments.relocate(header_mark, resolve)
 
 	def write_header_word(self, header_index, word):
-		self.data[header_index : header_index + 4] = word.to_bytes(4, 'little')
+		self.header[header_index : header_index + 4] = word.to_bytes(4, 'little')
 
 	###
 
 	def loop_index(self):
 		return self.read_header_offset(0x1c)
 
-	def write_loop_offset(self, loop_index):
-		return self.write_header_offset(0x1c, loop_index)
-
-	def displace_loop_offset(self, displacement):
-		return self.displace_header_offset(0x1c, displacement)
+	def resolve_keyframes(self):
+		# Assigns output offsets to keyframes once all segments are in place
+		position = self.segments.position_resolver()
+		for keyframe in self.keyframes:
+			keyframe.offset = position(keyframe.mark)
+
+	def time_index_offsets(self):
+		return [(keyframe.sample_time, keyframe.offset) for keyframe in self.keyframes]
+
+	def seek_data(self, sample_time):
+		# Standalone VGM that starts playback at the last keyframe before sample_time
+		# This is the header, the keyframe's register restore commands then the command data from the keyframe
+		# If the loop point is before the keyframe, the looped region is appended after so looping still works
+		keyframe = find_keyframe(self.keyframes, sample_time)
+
+		commands_index = self.read_header_offset(0x34)
+		gd3_index = self.read_header_offset(0x14)
+		end_index = gd3_index if gd3_index > 0 else len(self.data)
+		loop_index = self.loop_index()
+
+		data = bytearray(self.data[0x00 : 0x100])
+		data.extend(keyframe.restore_commands())
+		seek_index = len(data)
+		data.extend(self.data[keyframe.offset : end_index])
+
+		if loop_index >= keyframe.offset:
+			loop_index += seek_index - keyframe.offset
+		elif loop_index >= commands_index:
+			loop_start = len(data)
+			data.extend(self.data[loop_index : end_index])
+			loop_index = loop_start
+
+		def write_header_offset(header_index, index):
+			file_offset = index - header_index if index > 0 else 0
+			data[header_index : header_index + 4] = file_offset.to_bytes(4, 'little')
+
+		write_header_offset(0x34, 0x100)
+		write_header_offset(0x1c, loop_index)
+		write_header_offset(0x14, 0)
+		write_header_offset(0x04, len(data))
+
+		return (data, keyframe)
 
 	###
 
 	def read_header_offset(self, header_index):
-		file_offset_bytes = self.data[header_index : header_index + 4]
+		file_offset_bytes = self.header[header_index : header_index + 4]
 		file_offset = int.from_bytes(file_offset_bytes, 'little')
 		return file_offset + header_index if file_offset > 0 else 0
 
-	def displace_header_offset(self, header_index, delta):
-		file_offset_bytes = self.data[header_index : header_index + 4]
-		file_offset = int.from_bytes(file_offset_bytes, 'little') + header_index
-		file_offset += delta
-		self.write_header_offset(header_index, file_offset)
-
-	def write_psg(self, actions):
-		for action in actions:
-			self.data.extend([0x58, action.address & 0xff, action.data])
-
-	def write_opnb(self, actions):
-		for action in actions:
-			write_cmd = 0x59 if action.address >= 0x100 else 0x58
-			self.data.extend([write_cmd, action.address & 0xff, action.data])
-
 	def write_chip_header(self, chip_type, clock):
 		attributes = next(filter(lambda t: t[0] == chip_type, Chip.ATTRIBUTES), None)
 		if attributes is None:
-			print("write_chip_header: couldn't find chip_type")
+			log.error("write_chip_header: couldn't find chip_type")
 			sys.exit(1)
 
 		index = attributes[1]
@@ -198,247 +257,344 @@ class ProcessedVGM:
 		if clock > 0:
 			header_clock |= attributes[2]
 
-		self.data[index : index + 4] = header_clock.to_bytes(4, 'little')
+		self.header[index : index + 4] = header_clock.to_bytes(4, 'little')
 
 	# PCM:
 
-	def sort_pcm_blocks(self, assume_unified_pcm):
-		b_offset = 0 if assume_unified_pcm else 0x1000000
-		sorted(self.pcm_blocks, key=lambda block: block.offset + b_offset if block.type == PCMType.B else 0)
+	def sort_pcm_blocks(self):
+		# Blocks are uploaded in address order
+		self.pcm_blocks.sort(key=lambda block: block.remapped_offset)
 
-	def rebase_pcm_blocks(self):
-		base = 0
+	def blocks_overlap(self):
+		intervals = [(block.remapped_offset, block.remapped_offset + len(block.data)) for block in self.pcm_blocks]
+		return PCMIntervalIndex(intervals).has_overlap()
 
-		def bank_cross_check(block, remapped_offset):
-			nonlocal base
+	def preprocess_pcm(self):
+		# Lays out the PCM blocks and returns tables to remap ADPCM bank bytes to match, for each PCMType
+		# Each is (table, mapped) where table[bank_byte] is the remapped bank byte (see PCMPacker.bank_remap_table)
 
-			# Would inserting this block at its current position cross a 1MB bank?
-			# Need to preemptively move to next bank if so
-			start = base + remapped_offset
-			end = base + remapped_offset + len(block.data)
+		# Overlapping blocks implies non-unified PCM address space
+		# In that case ADPCM-A and B blocks are still packed together, but bank bytes are remapped for each separately
+		unified_pcm = not self.blocks_overlap()
 
-			if (start & 0xf00000) != (end & 0xf00000):
-				base = (base + 0x100000) & 0xf00000
-				print("..crossed 1MB bank..")
-				return True
+		packer = PCMPacker()
 
-			return False
+		if unified_pcm:
+			log.info("PCM blocks don't overlap, assuming unified PCM")
+			packer.add_space(None, self.pcm_blocks)
+		else:
+			log.info("PCM blocks overlap, assuming non-unified PCM")
+			for pcm_type in PCMType:
+				packer.add_space(pcm_type, [block for block in self.pcm_blocks if block.type == pcm_type])
 
-		previous_end_bank = None
-		bank_crossed = False
+		packer.pack()
+		self.sort_pcm_blocks()
 
-		previous_split_index = 0
-		index = 0
-		bank_corrected_indexes = []
+		for block in self.pcm_blocks:
+			log.debug("Remapped PCM block at: {:X}, originally: {:X}, size: {:X}",
+				block.remapped_offset, block.offset, len(block.data))
+
+		return {pcm_type: packer.bank_remap_table(None if unified_pcm else pcm_type) for pcm_type in PCMType}
+
+	def remap_bank_bytes(self, table):
+		# Rewrites the ADPCM bank bytes in the command data and keyframes, table[bank_byte] is the new bank byte
+		# This is for moving already laid out PCM blocks, which applies to both PCM types alike
+		commands_index = self.read_header_offset(0x34)
+		gd3_index = self.read_header_offset(0x14)
+		end_index = gd3_index if gd3_index > 0 else len(self.data)
+
+		data = self.data
+		index = commands_index
+		while index < end_index:
+			cmd = data[index]
+			if cmd == 0x58 or cmd == 0x59:
+				address = (cmd & 0x01) << 8 | data[index + 1]
+				if ADPCM_BANK_REGISTERS[address] is not None:
+					data[index + 2] = table[data[index + 2]]
+			elif COMMAND_LENGTHS[cmd] is None:
+				log.warning("Stopped remapping bank bytes at unrecognized command: {:X}", cmd)
+				break
 
-		while index < len(self.pcm_blocks):
-			block = self.pcm_blocks[index]
+			index += command_length(data, index)
 
-			block_bank = block.offset >> 16
-			block_end_bank = (block.offset + len(block.data)) >> 16
-			remapped_offset = block.offset & 0xffff
+		for keyframe in self.keyframes:
+			for (address, bank_type) in enumerate(ADPCM_BANK_REGISTERS):
+				if bank_type is not None and keyframe.written[address]:
+					keyframe.registers[address] = table[keyframe.registers[address]]
 
-			if not bank_crossed and previous_end_bank is not None and (previous_end_bank != block_bank):
-				base += 0x10000
-				previous_split_index = index
+	def pcm_block_commands(self):
+		# Yields the data block commands for all PCM blocks in sequence, without copying the PCM data itself
+		for block in self.pcm_blocks:
+			# Block header (generic)
+			block_header = bytearray([0x67, 0x66])
+			block_header.append(0x82 if block.type == PCMType.A else 0x83)
+			block_header.extend((len(block.data) + 8).to_bytes(4, 'little'))
+			# PCM data block (sample ROM)
+			block_header.extend(block.total_size.to_bytes(4, 'little'))
+			block_header.extend(block.remapped_offset.to_bytes(4, 'little'))
 
-			bank_crossed = bank_cross_check(block, remapped_offset)
-			if bank_crossed and (index not in bank_corrected_indexes):
-				# Need to go back and move all blocks that share a 64K bank
-				bank_corrected_indexes.append(index)
-				index = previous_split_index
-				print("..returning to index {:X} for 1MB bank crossing.."\
-					.format(previous_split_index))
-			else:
-				remapped_offset += base
-				block.remapped_offset = remapped_offset
+			yield block_header
+			yield block.data
 
-				if block_end_bank != block_bank:
-					base += (block_end_bank - block_bank) * 0x10000
+class VGMPreprocessor:
+	# Bumped whenever preprocessing output changes, so that cached results are invalidated
+	VERSION = 6
 
-				previous_end_bank = block_end_bank
+	SAMPLE_RATE = 44100
 
-				print("Remapped PCM block at: {:X}, originally: {:X}, size: {:X}"\
-					.format(block.remapped_offset, block.offset, len(block.data)))
+	def __init__(self, assumed_clock=8000000, chunk_size=0x10000, keyframe_interval=1, encode_jobs=None,
+		dac_segmenter=None, profile=None):
+		self.assumed_clock = assumed_clock
+		self.chunk_size = chunk_size
+		# Seconds between register keyframes, or None to not record any (they're only needed to seek)
+		self.keyframe_interval = keyframe_interval
+		# Processes used to encode DAC blocks (defaults to the CPU count)
+		self.encode_jobs = encode_jobs
+		# How the YM2612 DAC output is split into ADPCM-B blocks
+		self.dac_segmenter = dac_segmenter if dac_segmenter is not None else DACSegmenter()
+		# VGMProfile that stage times and counters are added to (none are kept by default)
+		self.profile = profile if profile is not None else DISABLED_PROFILE
 
-				index += 1
+	def included_chips(self, vgm):
+		chips = []
+		clock_mask = ~0x80000000
 
-	def remap_pcm_bank_byte(self, bank_byte):
-		for block in self.pcm_blocks:
-			block_offset_bank = block.offset >> 16
+		for t in Chip.ATTRIBUTES:
+			index = t[1]
+			clock = int.from_bytes(vgm[index : index + 4], 'little')
+			if (clock == 0) or ((clock & clock_mask) > 8000000):
+				continue
 
-			end_address = block.offset + len(block.data)
-			block_end_bank = end_address >> 16
-			block_range = range(block_offset_bank, block_end_bank + 1)
-			if bank_byte not in block_range:
+			presence_mask = t[2]
+			if (presence_mask != 0) and ((clock & presence_mask) == 0):
 				continue
 
-			remapped_bank = block.remapped_offset >> 16
-			offset_bank = bank_byte - block_offset_bank
-			offset_bank += remapped_bank
+			chip_type = t[0]
+			chips.append(Chip(chip_type, index, clock & clock_mask))
 
-			return offset_bank
+		return chips
 
-		return None
+	def preprocess(self, vgm_in, rewrite_pcm=False, byteswap_pcm=True, write_wav=False):
+		processed_vgm = ProcessedVGM()
 
-	def blocks_overlap(self):
-		# Basic O(n^2) comparison here since there's just not enough blocks for it to matter
-		for block_x in self.pcm_blocks:
-			for block_y in self.pcm_blocks:
-				if block_x is block_y:
-					continue
-
-				if block_x.overlaps(block_y):
-					return True
-
-		return False
-		
-	def preprocess_pcm(self, adpcm_a_bank_indexes, adpcm_b_bank_indexes, total_size):
-		# PCM block overlap decides whether we rebase or just offset
-		# Overlapping blocks implies non-unified PCM address space
-		rebase_needed = not self.blocks_overlap()
+		self.convert(vgm_in, processed_vgm, rewrite_pcm, byteswap_pcm, write_wav)
 
-		if rebase_needed:
-			print("PCM blocks don't overlap, assuming unified PCM")
+		with self.profile.stage('serialize'):
+			processed_vgm.data = processed_vgm.segments.to_bytearray()
 
-			self.sort_pcm_blocks(rebase_needed)
-			self.rebase_pcm_blocks()
+		self.profile.count('output_bytes', len(processed_vgm.data))
 
-			# Both ADPCMA/B will be adjusted after rebasing
-			bank_indexes = adpcm_a_bank_indexes + adpcm_b_bank_indexes
+		return processed_vgm
 
-			for bank_index in bank_indexes:
-				bank_byte = self.data[bank_index]
-				remapped_bank_byte = self.remap_pcm_bank_byte(bank_byte)
-				if remapped_bank_byte is None:
-					print("Couldn't find matching PCM bank byte: {:X}".format(bank_byte))
-					continue
+	def preprocess_to_file(self, vgm_in, output_file, rewrite_pcm=True, byteswap_pcm=False, write_wav=False):
+		# Command data is spooled to a temporary file in chunks as it's converted so it's never all held in memory
+		# The returned ProcessedVGM has PCM blocks but no command data
+		processed_vgm = ProcessedVGM()
 
-				self.data[bank_index] = remapped_bank_byte
+		with tempfile.TemporaryFile() as spool:
+			processed_vgm.segments.spool = spool
 
-		else:
-			adpcm_b_fixed_offset = 0x400000
-			fixed_bank_offset = adpcm_b_fixed_offset // 0x10000
+			self.convert(vgm_in, processed_vgm, rewrite_pcm, byteswap_pcm, write_wav)
 
-			print("PCM blocks overlap, assuming non-unified PCM")
-			# ADPCM-B blocks are now offset by 4M to resolve the overlap issue
-			for block in self.pcm_blocks:
-				if block.type == PCMType.B:
-					previous_offset = block.remapped_offset
-					block.remapped_offset += adpcm_b_fixed_offset
+			with self.profile.stage('serialize'):
+				processed_vgm.segments.write_to(output_file)
 
-					print("Remapped ADPCM-B from {:X} to {:X}"
-						.format(previous_offset, block.remapped_offset))
+			self.profile.count('output_bytes', len(processed_vgm.segments))
 
-			# Only ADPCMB will be adjusted
-			# There's no need to move ADPCM-A because overlapping tracks will be <4MB total anyway
-			for bank_index in adpcm_b_bank_indexes:
-				self.data[bank_index] += fixed_bank_offset
+		return processed_vgm
 
+	def scan_dac(self, vgm_in, index, dac_state):
+		# First pass over the input, which only collects the YM2612 DAC timeline
+		# This is needed before conversion starts so that DAC triggers can be written in the main pass
 
-	def write_pcm_blocks(self, start_index):
-		# Inserting all PCM blocks in sequence, presumably at start
-		pcm_commands = bytearray()
+		vgm = memoryview(vgm_in)
 
-		for block in self.pcm_blocks:
-			# Block header (generic)
-			pcm_commands.extend([0x67, 0x66])
-			pcm_commands.append(0x82 if block.type == PCMType.A else 0x83)
-			pcm_commands.extend((len(block.data) + 8).to_bytes(4, 'little'))
-			# PCM data block (sample ROM)
-			pcm_commands.extend(block.total_size.to_bytes(4, 'little'))
-			pcm_commands.extend(block.remapped_offset.to_bytes(4, 'little'))
-			pcm_commands.extend(block.data)
+		def skip(index, length):
+			return index + length
 
-		self.data[start_index:start_index] = pcm_commands
-		return len(pcm_commands)
+		def unrecognized(index, length):
+			log.error("Unrecognized command byte: {:X} @ {:X}", vgm[index], index)
+			sys.exit(1)
 
-class VGMPreprocessor:
-	def __init__(self, assumed_clock=8000000):
-		self.assumed_clock = assumed_clock
+		def end_of_stream(index, length):
+			return len(vgm)
 
-	def included_chips(self, vgm):
-		chips = []
-		clock_mask = ~0x80000000
+		def data_block(index, length):
+			# Uncompressed data?
 
-		for t in Chip.ATTRIBUTES:
-			index = t[1]
-			clock = int.from_bytes(vgm[index : index + 4], 'little')
-			if (clock == 0) or ((clock & clock_mask) > 8000000):
-				continue
+			uncompressed_block = UncompressedBlock.from_vgm(vgm_in, index)
+			if uncompressed_block is not None:
+				dac_state.extend_data_bank(uncompressed_block.data)
+				return index + len(uncompressed_block.data) + 7
 
-			presence_mask = t[2]
-			if (presence_mask != 0) and ((clock & presence_mask) == 0):
-				continue
+			return index + command_length(vgm, index)
 
-			chip_type = t[0]
-			chips.append(Chip(chip_type, index, clock & clock_mask))
+		def dac_write(index, length):
+			# Occasionally there is a direct DAC write that needs manual handling
+			if vgm[index + 1] == 0x2a:
+				dac_state.set_output(vgm[index + 2])
 
-		return chips
+			return index + 3
 
-	def byte_swap(self, data):
-		pcm_swapped = bytearray(len(data))
+		def dac_delay_4bit(index, length):
+			dac_state.delay((vgm[index] & 0x0f) + 1)
+			return index + 1
 
-		index = 0
-		while index < len(data):
-			temp = data[index + 0]
-			pcm_swapped[index + 0] = data[index + 3]
-			pcm_swapped[index + 3] = temp
+		def dac_delay_16bit(index, length):
+			dac_state.delay(vgm[index + 1] | vgm[index + 2] << 8)
+			return index + 3
 
-			temp = data[index + 1]
-			pcm_swapped[index + 1] = data[index + 2]
-			pcm_swapped[index + 2] = temp
+		def dac_delay_frame(index, length):
+			dac_state.delay(735 if vgm[index] == 0x62 else 882)
+			return index + 1
 
-			index += 4
+		def dac_bank_write(index, length):
+			dac_state.output_data_bank_sample(vgm[index] & 0x0f)
+			return index + 1
 
-		return pcm_swapped
+		def dac_bank_seek(index, length):
+			dac_state.seek(vgm[index + 1] | vgm[index + 2] << 8 | vgm[index + 3] << 16 | vgm[index + 4] << 24)
+			return index + 5
 
-	def preprocess(self, vgm_in, rewrite_pcm=False, byteswap_pcm=True, write_wav=False):
-		flag_writes_removed = 0
+		command_table = [(skip if length is not None else unrecognized, length) for length in COMMAND_LENGTHS]
 
-		processed_vgm = ProcessedVGM()
+		def assign(commands, handler):
+			for cmd in commands:
+				command_table[cmd] = (handler, COMMAND_LENGTHS[cmd])
+
+		assign([0x66], end_of_stream)
+		assign([DATA_BLOCK], data_block)
+		assign([0x52], dac_write)
+		assign(range(0x70, 0x80), dac_delay_4bit)
+		assign([0x61], dac_delay_16bit)
+		assign([0x62, 0x63], dac_delay_frame)
+		assign(range(0x80, 0x90), dac_bank_write)
+		assign([0xe0], dac_bank_seek)
+
+		end_index = len(vgm)
+		while index < end_index:
+			handler, length = command_table[vgm[index]]
+			index = handler(index, length)
+
+	def encode_dac_blocks(self, dac_state, byteswap_pcm, write_wav):
+		# YM2612 DAC blocks (played using ADPCMB)
+		# Returns the encoded blocks and the ADPCM-B trigger commands to be inserted into the output
+
+		profile = self.profile
+
+		with profile.stage('dac_partition'):
+			dac_sample_blocks = dac_state.parition_blocks(self.dac_segmenter)
+
+			# Repeated blocks (the same drum hit played many times) are only encoded and stored once
+			(unique_sample_data, unique_indexes) = self.deduplicate_dac_blocks(dac_sample_blocks)
+
+		if write_wav:
+			dac_state.write_wav()
+			dac_state.write_wav_blocks(dac_sample_blocks)
+
+		# Encode all unique blocks from 8bit DAC format to DeltaT
+		with profile.stage('deltat_encode'):
+			all_encoded_samples = encode_dac_sample_blocks(unique_sample_data, self.encode_jobs)
+
+		encoded_blocks = []
+		encoded_offset = 0
+		for encoded_samples in all_encoded_samples:
+			encoded_block = PCMBlock()
+			encoded_block.total_size = 0x1000000
+			encoded_block.data = encoded_samples
+			encoded_block.remapped_offset = encoded_offset
+
+			encoded_offset += len(encoded_block.data)
+
+			if byteswap_pcm:
+				byte_swap_words_in_place(encoded_block.data)
+			else:
+				encoded_block.type = PCMType.B
+
+			encoded_blocks.append(encoded_block)
+
+		# Every occurrence of a repeated block plays the same encoded block
+		played_blocks = [encoded_blocks[index] for index in unique_indexes]
+
+		with profile.stage('dac_trigger_commands'):
+			command_inserter = DACCommandInserter(dac_sample_blocks, played_blocks)
+			dac_triggers = command_inserter.triggers()
+
+		profile.count('dac_sample_blocks', len(dac_sample_blocks))
+		profile.count('dac_unique_blocks', len(unique_sample_data))
+		profile.count('dac_encoded_bytes', encoded_offset)
+		profile.count('dac_triggers', len(dac_triggers))
+
+		return (encoded_blocks, dac_triggers)
+
+	def deduplicate_dac_blocks(self, dac_sample_blocks):
+		# Returns the data of each unique block, and the index of the unique block for each of dac_sample_blocks
+		unique_sample_data = []
+		unique_indexes = []
+		indexes_by_digest = {}
+
+		for block in dac_sample_blocks:
+			digest = hashlib.blake2b(block.data, digest_size=16).digest()
+
+			index = indexes_by_digest.get(digest)
+			if index is None or unique_sample_data[index] != block.data:
+				index = len(unique_sample_data)
+				unique_sample_data.append(block.data)
+				indexes_by_digest.setdefault(digest, index)
+
+			unique_indexes.append(index)
+
+		log.info("Unique DAC sample blocks: {:X} of {:X}", len(unique_sample_data), len(dac_sample_blocks))
+
+		return (unique_sample_data, unique_indexes)
+
+	def convert(self, vgm_in, processed_vgm, rewrite_pcm=False, byteswap_pcm=True, write_wav=False):
+		# Builds the converted VGM into processed_vgm.segments:
+		# decode (command table) -> translate (OPN / PSG state) -> emit (segments, in chunks of roughly chunk_size bytes)
+		#
+		# Header offsets and bank bytes are left as relocations, which are resolved once the segments are serialized
+
+		vgm = memoryview(vgm_in)
+		segments = processed_vgm.segments
+		profile = self.profile
+
+		profile.count('input_bytes', len(vgm))
 
 		# Copy existing header which will be updated later
-		processed_vgm.data.extend(vgm_in[0x00 : 0x100])
+		processed_vgm.header = bytearray(vgm[0x00 : 0x100])
 
 		# Read source indexes (from relative offsets):
 		relative_offset_index = 0x34
 		start_index = processed_vgm.read_header_offset(relative_offset_index)
-		print("VGM start index: {:X}".format(start_index))
+		log.info("VGM start index: {:X}", start_index)
 
 		# Clear any leftover junk in the header incase
 		if start_index < 0x100:
-			processed_vgm.data[start_index : 0x100] = [0] * (0x100 - start_index)
+			processed_vgm.header[start_index : 0x100] = [0] * (0x100 - start_index)
 		# Preserve existing loop params if present
 		if start_index < 0x80:
 			loop_base_index = 0x7e
 			loop_modifier_index = 0x7f
-			processed_vgm.data[loop_base_index] = 0
-			processed_vgm.data[loop_modifier_index] = 0
-
-		def copy(length):
-			nonlocal index, vgm_in
-
-			processed_vgm.data.extend(vgm_in[index : index + length])
-			index += length
+			processed_vgm.header[loop_base_index] = 0
+			processed_vgm.header[loop_modifier_index] = 0
 
 		index = start_index
 
 		loop_index = processed_vgm.loop_index()
-		print("VGM loop index: {:X}".format(loop_index))
+		log.info("VGM loop index: {:X}", loop_index)
 
 		# What chips are included in this VGM?
 
 		chips = self.included_chips(vgm_in)
 		for chip in chips:
-			print("Found {:s} @ {:d}Hz".format(chip.chip_type.name, chip.clock))
+			log.info("Found {:s} @ {:d}Hz", chip.chip_type.name, chip.clock)
 
 		ym2610_chip = next(filter(lambda c: c.chip_type in [ChipType.YM2610, ChipType.YM2610B], chips), None)
 		ym2612_chip = next(filter(lambda c: c.chip_type == ChipType.YM2612, chips), None)
 		psg_chip = next(filter(lambda c: c.chip_type == ChipType.SN76489, chips), None)
 
 		if (ym2610_chip is None) and (ym2612_chip is None):
-			print("Error: expected either YM2610 or YM2612")
+			log.error("Error: expected either YM2610 or YM2612")
 			sys.exit(1)
 
 		# Bump version to 1.70 as some versions predate YM2610(B) support
@@ -446,237 +602,364 @@ class VGMPreprocessor:
 		output_version = 0x00000170
 		processed_vgm.write_header_word(version_index, output_version)
 
-		# Bump the index to 0x100 to make space for full-size header, if needed
+		# Commands always start directly after the full-size header
 		# Some tracks may have a shorter header by setting a lower start-offset
-		minimum_start_index = 0x100
-		if start_index < minimum_start_index:
-			start_index = minimum_start_index
-			processed_vgm.write_header_offset(relative_offset_index, start_index)
+		segments.append(processed_vgm.header)
+		processed_vgm.relocate_header_offset(relative_offset_index, segments.mark())
 
-		# Loop index needs adjusting based on data being added / removed
-		loop_index_adjusted = None
+		# PCM blocks are inserted here once they're all known
+		pcm_segments = segments.insertion_point()
 
-		# PCM address remapping:
+		# Track OPN/PSG state for upcoming conversion (from YM2612):
 
-		adpcm_a_bank_indexes = []
-		adpcm_b_bank_indexes = []
+		opn_state = None
+		dac_state = None
+		if ym2612_chip is not None:
+			opn_state = OPNState(reference_clock=ym2612_chip.clock, target_clock=self.assumed_clock)
+			dac_state = YM2612DACState()
 
-		def record_reg_write():
-			nonlocal index, vgm_in, adpcm_a_bank_indexes, adpcm_b_bank_indexes
+		psg_state = None
+		if psg_chip is not None:
+			psg_state = PSGState(reference_clock=psg_chip.clock, target_clock=self.assumed_clock)
 
-			data_index = index + 2
+		# DAC samples are collected first since the DAC triggers are written in the main pass
 
-			cmd = vgm_in[index + 0]
-			address = vgm_in[index + 1]
-			data = vgm_in[data_index]
+		encoded_dac_blocks = []
+		dac_triggers = []
 
-			if cmd == 0x59:
-				address += 0x100
+		if dac_state is not None:
+			with profile.stage('dac_scan'):
+				self.scan_dac(vgm_in, index, dac_state)
+
+			(encoded_dac_blocks, dac_triggers) = self.encode_dac_blocks(dac_state, byteswap_pcm, write_wav)
+
+		# Bank bytes are remapped after all PCM blocks are extracted and laid out
+		# Until then, their offsets in the current output chunk are recorded for each PCMType
+		# The remap tables are applied to all of them in one pass once the output is serialized
+		bank_remap_tables = {pcm_type: bytearray(range(0x100)) for pcm_type in PCMType}
+		bank_bytes_used = {pcm_type: bytearray(0x100) for pcm_type in PCMType}
+		bank_byte_offsets = {pcm_type: [] for pcm_type in PCMType}
+
+		def flush_output():
+			nonlocal output
+
+			mark = segments.mark()
+			for (pcm_type, offsets) in bank_byte_offsets.items():
+				if offsets:
+					profile.count('bank_byte_writes', len(offsets))
+					segments.remap_bytes(mark, array('I', offsets), bank_remap_tables[pcm_type])
+					offsets.clear()
+
+			segments.append(output, spooled=True)
+			output = bytearray()
+
+		# Command handlers:
+		# Each takes the index of a command and its length (from COMMAND_LENGTHS) and returns the next index
+
+		output = bytearray()
+		skipped_commands = set()
+
+		# Elapsed samples are tracked for every delay written to the output
+		# DAC trigger commands are merged in at their exact timestamp, splitting any delay they land in
+		# A keyframe of the output registers is recorded at least every keyframe_interval seconds
+
+		recording_keyframes = self.keyframe_interval is not None
+		if recording_keyframes:
+			register_file = OPNBRegisterFile()
+			keyframe_interval_samples = int(self.keyframe_interval * VGMPreprocessor.SAMPLE_RATE)
+			next_keyframe_time = 0
+		else:
+			register_file = DISABLED_REGISTER_FILE
+			next_keyframe_time = float('inf')
 
-			# ADPCM-A high address
-			is_a_bank = address in range(0x118, 0x11e) or address in range(0x128, 0x12e)
+		elapsed_samples = 0
+		dac_trigger_index = 0
+		next_trigger_time = dac_triggers[0][0] if dac_triggers else float('inf')
 
-			# ADPCM-B high address
-			is_b_bank = address in [0x013, 0x015]
+		def insert_dac_triggers(final=False):
+			nonlocal dac_trigger_index, next_trigger_time
 
-			# This bank address may need adjusting later
-			output_index = len(processed_vgm.data) + 2
+			while dac_trigger_index < len(dac_triggers):
+				timestamp, commands = dac_triggers[dac_trigger_index]
+				if not final and timestamp > elapsed_samples:
+					next_trigger_time = timestamp
+					return
 
-			if is_a_bank:
-				adpcm_a_bank_indexes.append(output_index)
-			elif is_b_bank:
-				adpcm_b_bank_indexes.append(output_index)
+				output.extend(commands)
+				register_file.write_commands(commands)
+				dac_trigger_index += 1
 
-		# Track OPN/PSG state for upcoming conversion (from YM2612):
+			next_trigger_time = float('inf')
 
-		opn_state = None
-		dac_state = None
-		if ym2612_chip is not None:
-			opn_state = OPNState(reference_clock=ym2612_chip.clock, target_clock=self.assumed_clock)
-			dac_state = YM2612DACState()
+		def record_keyframe():
+			nonlocal next_keyframe_time
 
-		psg_state = None
-		if psg_chip is not None:
-			psg_state = PSGState(reference_clock=psg_chip.clock, target_clock=self.assumed_clock)
-			processed_vgm.write_psg(psg_state.preamble())
-
-		# Total size must be tracked as it changes PCM block sorting
-
-		total_size = 0
-
-		while index < len(vgm_in):
-			if loop_index == index and loop_index_adjusted is None:
-				# End of newly written VGM is the new loop index
-				loop_index_adjusted = len(processed_vgm.data)
-
-			cmd = vgm_in[index]
-
-			if cmd in [0x58, 0x59]:
-				# YM2610 reg write
-				record_reg_write()
-				copy(3)
-			elif cmd in [0x52, 0x53]:
-				# YM2612 reg write
-				if opn_state is None:
-					print("Found YM2612 reg write but no YM2612 found in header")
-					sys.exit(1)
-
-				address = vgm_in[index + 1]
-				data = vgm_in[index + 2]
-				if cmd == 0x53:
-					address += 0x100
-
-				# Occasionally there is a direct DAC write that needs manual handling
-				if address == 0x2a:
-					dac_state.set_output(data)
-
-				write_actions = opn_state.write(address, data)
-				processed_vgm.write_opnb(write_actions)
-
-				index += 3
-			elif cmd == 0x4f:
-				# PSG stereo writes which sometimes appear but aren't used
-				index += 2
-			elif cmd == 0x50:
-				# PSG write, needs mapping
-				if psg_state is None:
-					print("Found PSG write but no PSG found in header")
-					sys.exit(1)
-
-				data = vgm_in[index + 1]
-
-				write_actions = psg_state.write(data)
-				processed_vgm.write_opnb(write_actions)
-
-				index += 2
-			elif (cmd & 0xf0) == 0x70:
-				# Delay (4bit)
-				count = (cmd & 0x0f) + 1
-				if dac_state is not None:
-					dac_state.delay(count)
-				copy(1)
-			elif cmd == 0x61:
-				# Delay (16bit)
-				count = int.from_bytes(vgm_in[index + 1 : index + 3], 'little')
-				if dac_state is not None:
-					dac_state.delay(count)
-				copy(3)
-			elif cmd in [0x62, 0x63]:
-				# Delay (50Hz / 60Hz constants)
-				delay = 735 if cmd == 0x62 else 882
-				if dac_state is not None:
-					dac_state.delay(delay)
-				copy(1)
-			elif cmd == 0x66:
-				# End of stream
-				copy(1)
-				break
-			elif (cmd & 0xf0) == 0x80:
-				# YM2612 DAC write from data bank
-				delay = cmd & 0x0f
-				dac_state.output_data_bank_sample(delay)
-
-				# Emit an ordinary delay if needed
-				if delay > 0:
-					processed_vgm.data.append(0x70 | (delay - 1))
-
-				index += 1
-			elif cmd == 0xe0:
-				# PCM data bank seek
-				seek_index = int.from_bytes(vgm_in[index + 1 : index + 5], 'little')
-				dac_state.seek(seek_index)
-				index += 5
-			elif cmd == 0x67:
-				# ADPCM-A/B?
-
-				adpcm_block = PCMBlock.from_vgm(vgm_in, index, byteswap_pcm)
-				if adpcm_block is not None:
-					total_size = max(total_size, adpcm_block.total_size)
-					index += (len(adpcm_block.data) + 15)
-
-					if len(adpcm_block.data) > 0:
-						processed_vgm.pcm_blocks.append(adpcm_block)
-
-					continue
-
-				# Uncompressed data?
-
-				uncompressed_block = UncompressedBlock.from_vgm(vgm_in, index)
-				if uncompressed_block is not None:
-					index += (len(uncompressed_block.data) + 7)
-					dac_state.extend_data_bank(uncompressed_block.data)
-					continue
-
-				print("Unrecognized data block")
-				sys.exit(1)
+			keyframe = VGMKeyframe.capture(elapsed_samples, segments.mark(len(output)), register_file)
+			processed_vgm.keyframes.append(keyframe)
+			next_keyframe_time = elapsed_samples + keyframe_interval_samples
+
+		def delay(samples, command=None):
+			# command is the original delay command, which is copied as-is unless it has to be split
+			nonlocal elapsed_samples
+
+			end_samples = elapsed_samples + samples
+
+			if next_trigger_time < end_samples:
+				while next_trigger_time < end_samples:
+					write_delay(output, next_trigger_time - elapsed_samples)
+					elapsed_samples = next_trigger_time
+					insert_dac_triggers()
+
+				write_delay(output, end_samples - elapsed_samples)
+			elif command is not None:
+				output.extend(command)
 			else:
-				print("Unrecognized command byte: {:X}".format(cmd))
+				write_delay(output, samples)
+
+			elapsed_samples = end_samples
+
+			if elapsed_samples >= next_keyframe_time:
+				record_keyframe()
+
+			if next_trigger_time == elapsed_samples:
+				insert_dac_triggers()
+
+		def ym2610_write(index, length):
+			address = vgm[index + 1]
+			if vgm[index] == 0x59:
+				address += 0x100
+
+			bank_type = ADPCM_BANK_REGISTERS[address]
+			if bank_type is not None and dac_state is None:
+				bank_byte_offsets[bank_type].append(len(output) + 2)
+				bank_bytes_used[bank_type][vgm[index + 2]] = 1
+
+			register_file.write(address, vgm[index + 2])
+			output.extend(vgm[index : index + 3])
+			return index + 3
+
+		def ym2612_write(index, length):
+			address = vgm[index + 1]
+			if vgm[index] == 0x53:
+				address += 0x100
+
+			opn_state.write(output, register_file, address, vgm[index + 2])
+
+			return index + 3
+
+		def psg_write(index, length):
+			psg_state.write(output, register_file, vgm[index + 1])
+
+			return index + 2
+
+		def delay_4bit(index, length):
+			delay((vgm[index] & 0x0f) + 1, vgm[index : index + 1])
+			return index + 1
+
+		def delay_16bit(index, length):
+			delay(vgm[index + 1] | vgm[index + 2] << 8, vgm[index : index + 3])
+
+			return index + 3
+
+		def delay_frame(index, length):
+			delay(735 if vgm[index] == 0x62 else 882, vgm[index : index + 1])
+			return index + 1
+
+		def dac_bank_write(index, length):
+			# Emit an ordinary delay if needed
+			samples = vgm[index] & 0x0f
+			if samples > 0:
+				delay(samples)
+
+			return index + 1
+
+		def end_of_stream(index, length):
+			insert_dac_triggers(final=True)
+			output.append(vgm[index])
+			return len(vgm)
+
+		def skip(index, length):
+			return index + length
+
+		def data_block(index, length):
+			# ADPCM-A/B?
+
+			adpcm_block = PCMBlock.from_vgm(vgm_in, index, byteswap_pcm)
+			if adpcm_block is not None:
+				if len(adpcm_block.data) > 0:
+					processed_vgm.pcm_blocks.append(adpcm_block)
+
+				return index + len(adpcm_block.data) + 15
+
+			# Uncompressed data was already added to the DAC data bank in the first pass
+			if dac_state is None or vgm[index + 2] != 0x00:
+				log.warning("Skipping unsupported data block type: {:X}", vgm[index + 2])
+
+			return index + command_length(vgm, index)
+
+		def skip_unsupported(index, length):
+			cmd = vgm[index]
+			if cmd not in skipped_commands:
+				log.warning("Skipping unsupported command: {:X}", cmd)
+				skipped_commands.add(cmd)
+
+			return index + length
+
+		def unrecognized(index, length):
+			log.error("Unrecognized command byte: {:X} @ {:X}", vgm[index], index)
+			sys.exit(1)
+
+		def missing_chip(message):
+			def handler(index, length):
+				log.error(message)
 				sys.exit(1)
 
-		# Reassign loop index after possible displacement
-		if loop_index_adjusted is not None:
-			loop_offset_adjusted = processed_vgm.write_loop_offset(loop_index_adjusted)
-			print("VGM adjusted loop offset: {:X}".format(loop_offset_adjusted))
+			return handler
+
+		command_table = [(skip_unsupported if length is not None else unrecognized, length) \
+			for length in COMMAND_LENGTHS]
+
+		def assign(commands, handler):
+			for cmd in commands:
+				command_table[cmd] = (handler, COMMAND_LENGTHS[cmd])
 
-		# YM2612 DAC blocks (played using ADPCMB):
+		# YM2610 reg write
+		assign([0x58, 0x59], ym2610_write)
 
-		dac_sample_blocks = None
+		# YM2612 reg write
+		if opn_state is not None:
+			assign([0x52, 0x53], ym2612_write)
+		else:
+			assign([0x52, 0x53], missing_chip("Found YM2612 reg write but no YM2612 found in header"))
+
+		# PSG write, needs mapping
+		if psg_state is not None:
+			assign([0x50], psg_write)
+		else:
+			assign([0x50], missing_chip("Found PSG write but no PSG found in header"))
+
+		# PSG stereo writes which sometimes appear but aren't used
+		assign([0x4f], skip)
+
+		# Delays (4bit, 16bit, 50Hz / 60Hz constants)
+		assign(range(0x70, 0x80), delay_4bit)
+		assign([0x61], delay_16bit)
+		assign([0x62, 0x63], delay_frame)
+
+		# YM2612 DAC write from data bank, PCM data bank seek
 		if dac_state is not None:
-			dac_sample_blocks = dac_state.parition_blocks()
+			assign(range(0x80, 0x90), dac_bank_write)
+			assign([0xe0], skip)
+		else:
+			dac_missing = missing_chip("Found YM2612 DAC write but no YM2612 found in header")
+			assign(range(0x80, 0x90), dac_missing)
+			assign([0xe0], dac_missing)
+
+		assign([0x66], end_of_stream)
+		assign([DATA_BLOCK], data_block)
+
+		# Input commands are only counted when profiling, by wrapping each handler
+		command_counts = [0] * 0x100
+
+		def counted(cmd, handler):
+			def counted_handler(index, length):
+				command_counts[cmd] += 1
+				return handler(index, length)
+
+			return counted_handler
 
-			if write_wav:
-				dac_state.write_wav()
-				dac_state.write_wav_blocks(dac_sample_blocks)
+		if profile.enabled:
+			command_table = [(counted(cmd, handler), length) for (cmd, (handler, length)) in enumerate(command_table)]
 
-			# Encode all blocks from 8bit DAC format to DeltaT
-			encoder = DeltaTEncoder()
-			encoded_blocks = []
-			encoded_offset = 0
-			for block in dac_sample_blocks:
-				pcm_16 = map(lambda x: (x - 0x80) * 0x100, block.data)
-				encoded_samples = encoder.encode(pcm_16)
+		def translate(index, end_index):
+			while index < end_index:
+				handler, length = command_table[vgm[index]]
+				index = handler(index, length)
 
-				encoded_block = PCMBlock()
-				encoded_block.total_size = 0x1000000
-				encoded_block.data = encoded_samples
-				encoded_block.remapped_offset = encoded_offset
+				if len(output) >= self.chunk_size:
+					flush_output()
 
-				encoded_offset += len(encoded_block.data)
+			return index
 
-				if byteswap_pcm:
-					encoded_block.data = PCMBlock.byte_swap(encoded_samples)
-				else:
-					encoded_block.type = PCMType.B
+		with profile.stage('translate'):
+			if recording_keyframes:
+				record_keyframe()
+			insert_dac_triggers()
 
-				processed_vgm.pcm_blocks.append(encoded_block)
+			if psg_state is not None:
+				psg_state.preamble(output, register_file)
 
-			command_inserter = DACCommandInserter(processed_vgm, dac_sample_blocks)
-			command_inserter.insert()
+			# Translation stops at the loop index first since its position in the output has to be recorded
+			loop_mark = None
+			if loop_index >= index:
+				index = translate(index, loop_index)
+				if index == loop_index:
+					loop_mark = segments.mark(len(output))
+
+			index = translate(index, len(vgm))
+			insert_dac_triggers(final=True)
+
+			flush_output()
+
+		for (cmd, count) in enumerate(command_counts):
+			if count > 0:
+				profile.count('commands.{:02X}'.format(cmd), count)
+
+		# Loop offset is resolved after the PCM blocks are inserted before it
+		if loop_mark is not None:
+			processed_vgm.relocate_header_offset(0x1c, loop_mark)
+		elif loop_index > 0:
+			log.warning("VGM loop index not found at a command boundary, looping disabled")
+			processed_vgm.write_header_word(0x1c, 0)
 
 		# Now that PCM blocks are extracted, they need preprocessing too
 		# This isn't done for YM2612 converted tracks since there's no need (always 0-based)
 		if dac_state is None:
-			processed_vgm.preprocess_pcm(adpcm_a_bank_indexes, adpcm_b_bank_indexes, total_size)
+			with profile.stage('pcm_layout'):
+				for (pcm_type, (table, mapped)) in processed_vgm.preprocess_pcm().items():
+					bank_remap_tables[pcm_type][:] = table
+
+					for bank_byte in range(0x100):
+						if bank_bytes_used[pcm_type][bank_byte] and not mapped[bank_byte]:
+							log.warning("Couldn't find matching PCM bank byte: {:X}", bank_byte)
+
+				# Keyframes recorded the original bank bytes too
+				bank_registers = [(address, bank_type) for (address, bank_type) in enumerate(ADPCM_BANK_REGISTERS)
+					if bank_type is not None]
+
+				for keyframe in processed_vgm.keyframes:
+					for (address, bank_type) in bank_registers:
+						if keyframe.written[address]:
+							keyframe.registers[address] = bank_remap_tables[bank_type][keyframe.registers[address]]
+
+		processed_vgm.pcm_blocks.extend(encoded_dac_blocks)
+
+		profile.count('pcm_blocks', len(processed_vgm.pcm_blocks))
+		profile.count('pcm_bytes', sum(len(block.data) for block in processed_vgm.pcm_blocks))
+		profile.count('keyframes', len(processed_vgm.keyframes))
 
 		if rewrite_pcm:
-			total_pcm_size = processed_vgm.write_pcm_blocks(start_index)
-			# Bump loop index which may have been assigned already
-			processed_vgm.displace_loop_offset(total_pcm_size)
+			# Inserting all PCM blocks in sequence at start
+			for chunk in processed_vgm.pcm_block_commands():
+				pcm_segments.append(chunk)
 
 		# Remove GD3 data as it wasn't copied here (trying to save space, but could add it as an option)
 		gd3_offset_index = 0x14
 		gd3_input_index = processed_vgm.read_header_offset(gd3_offset_index)
-		processed_vgm.write_header_offset(gd3_offset_index, len(processed_vgm.data))
-		# Copied GD3 region assumes it spans (index..<eof)
-		processed_vgm.data.extend(vgm_in[gd3_input_index : gd3_input_index + len(vgm_in)])
+		if gd3_input_index > 0:
+			processed_vgm.relocate_header_offset(gd3_offset_index, segments.mark())
+			# Copied GD3 region assumes it spans (index..<eof)
+			segments.append(vgm[gd3_input_index : ])
+		else:
+			processed_vgm.write_header_word(gd3_offset_index, 0)
 
 		# Reassign EOF offset (this particular hardware player doesn't check it but others do)
 		eof_offset_index = 0x04
-		processed_vgm.write_header_offset(eof_offset_index, len(processed_vgm.data))
+		processed_vgm.relocate_header_offset(eof_offset_index, segments.mark())
 
 		# In all cases, the output is a YM2610(B) VGM regardless of original input
 		processed_vgm.write_chip_header(ChipType.YM2610B, self.assumed_clock)
 		processed_vgm.write_chip_header(ChipType.SN76489, 0)
 		processed_vgm.write_chip_header(ChipType.YM2612, 0)
 
-		return processed_vgm
+		processed_vgm.resolve_keyframes()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# vgm_profile.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Leveled logging and per-stage profiling for VGM preprocessing
+#
+# Log messages are printed only if they're at or below the current level, which defaults to warnings and errors
+# Messages are only formatted if they're printed, so debug messages cost little when they're not shown
+# They're still printed to stdout so batch conversion can capture the output of each file
+#
+# VGMProfile accumulates wall / CPU time for named stages and totals for named counters
+# Stages can be nested (their times are then included in the enclosing stage too)
+# CPU time is for this process only, so it excludes work done in worker processes (DeltaT encoding)
+#
+# If trace_memory is set (and tracemalloc is running), the peak traced memory during each stage is recorded too
+
+import time
+import json
+import contextlib
+import tracemalloc
+
+ERROR = 0
+WARNING = 1
+INFO = 2
+DEBUG = 3
+
+class VGMLog:
+	def __init__(self, level=WARNING):
+		self.level = level
+
+	def write(self, level, message, args):
+		if level <= self.level:
+			print(message.format(*args) if args else message)
+
+	def error(self, message, *args):
+		self.write(ERROR, message, args)
+
+	def warning(self, message, *args):
+		self.write(WARNING, message, args)
+
+	def info(self, message, *args):
+		self.write(INFO, message, args)
+
+	def debug(self, message, *args):
+		self.write(DEBUG, message, args)
+
+# Shared by all modules, the level is set once by the command line scripts
+log = VGMLog()
+
+def verbosity_log_level(verbosity):
+	# Number of -v options -> log level
+	return min(WARNING + verbosity, DEBUG)
+
+class StageTime:
+	def __init__(self):
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.calls = 0
+		self.peak_memory = 0
+
+class VGMProfile:
+	def __init__(self, enabled=True, trace_memory=False):
+		self.enabled = enabled
+		self.trace_memory = trace_memory
+		self.stages = {}
+		self.counters = {}
+		# Peak traced memory so far for each stage that's currently running, innermost last
+		self.peak_stack = []
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		if not self.enabled:
+			yield
+			return
+
+		trace_memory = self.trace_memory and tracemalloc.is_tracing()
+		if trace_memory:
+			self.begin_peak()
+
+		wall_start = time.perf_counter()
+		cpu_start = time.process_time()
+
+		try:
+			yield
+		finally:
+			stage_time = self.stages.get(name)
+			if stage_time is None:
+				stage_time = self.stages[name] = StageTime()
+
+			stage_time.wall += time.perf_counter() - wall_start
+			stage_time.cpu += time.process_time() - cpu_start
+			stage_time.calls += 1
+
+			if trace_memory:
+				stage_time.peak_memory = max(stage_time.peak_memory, self.end_peak())
+
+	def begin_peak(self):
+		# tracemalloc only has one peak, so it's saved for the enclosing stage before it's reset for this one
+		(_, peak) = tracemalloc.get_traced_memory()
+		if self.peak_stack:
+			self.peak_stack[-1] = max(self.peak_stack[-1], peak)
+
+		tracemalloc.reset_peak()
+		(current, _) = tracemalloc.get_traced_memory()
+		self.peak_stack.append(current)
+
+	def end_peak(self):
+		(_, peak) = tracemalloc.get_traced_memory()
+		stage_peak = max(self.peak_stack.pop(), peak)
+		if self.peak_stack:
+			self.peak_stack[-1] = max(self.peak_stack[-1], stage_peak)
+
+		return stage_peak
+
+	def count(self, name, amount=1):
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def report(self):
+		# Plain dict (JSON serializable, and picklable for batch conversion workers)
+		stages = {}
+		for (name, stage_time) in self.stages.items():
+			stages[name] = {
+				'wall': stage_time.wall,
+				'cpu': stage_time.cpu,
+				'calls': stage_time.calls
+			}
+
+			if self.trace_memory:
+				stages[name]['peak_memory'] = stage_time.peak_memory
+
+		return {
+			'stages': stages,
+			'counters': dict(self.counters)
+		}
+
+	def merge_report(self, report):
+		# Adds the totals of a report from another profile (a batch conversion worker)
+		for (name, stage_report) in report['stages'].items():
+			stage_time = self.stages.get(name)
+			if stage_time is None:
+				stage_time = self.stages[name] = StageTime()
+
+			stage_time.wall += stage_report['wall']
+			stage_time.cpu += stage_report['cpu']
+			stage_time.calls += stage_report['calls']
+			stage_time.peak_memory = max(stage_time.peak_memory, stage_report.get('peak_memory', 0))
+
+		for (name, amount) in report['counters'].items():
+			self.count(name, amount)
+
+	def write_report(self, path):
+		# JSON report written to path, or stdout if path is '-'
+		report_json = json.dumps(self.report(), indent=1)
+
+		if path == '-':
+			print(report_json)
+		else:
+			with open(path, 'w') as file:
+				file.write(report_json)
+				file.write('\n')
+
+# Used by default, where stages and counters do nothing
+DISABLED_PROFILE = VGMProfile(enabled=False)
@@ -6,18 +6,124 @@
 #
 # SPDX-License-Identifier: MIT
 
-import gzip
+# Reads .vgm and .vgz files
+#
+# The gzip magic is checked up front rather than attempting to decompress every file
+# Plain VGMs are memory mapped so processing can start without reading the whole file into memory
+# VGZs are decompressed incrementally, so the header can be checked before the rest is decompressed
+# and the size limit applies as the data is decompressed (not after)
+
+import os
+import sys
+import mmap
+import zlib
+
+from vgm_profile import log
+
+GZIP_MAGIC = b'\x1f\x8b'
+VGM_MAGIC = b'Vgm '
+
+# Only a gzip stream (with its header and trailer) is accepted
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+class VGZDecompressor:
+	CHUNK_SIZE = 0x10000
+
+	def __init__(self, file, size_limit):
+		self.file = file
+		self.size_limit = size_limit
+		self.data = bytearray()
+		self.decompressor = zlib.decompressobj(GZIP_WBITS)
+		self.eof = False
+
+	def fill(self, length=None):
+		# Decompresses until at least length bytes are available, or all of them if length is None
+		while (length is None or len(self.data) < length) and not self.eof:
+			if self.decompressor.eof:
+				# Concatenated gzip members are decompressed as one stream, same as the gzip module
+				compressed = self.next_member()
+				if compressed is None:
+					self.eof = True
+					break
+
+				self.decompressor = zlib.decompressobj(GZIP_WBITS)
+			else:
+				compressed = self.decompressor.unconsumed_tail or self.file.read(VGZDecompressor.CHUNK_SIZE)
+				if not compressed:
+					log.error("VGZ file is truncated")
+					sys.exit(1)
+
+			try:
+				self.data.extend(self.decompressor.decompress(compressed, VGZDecompressor.CHUNK_SIZE))
+			except zlib.error as e:
+				log.error("Failed to decompress VGZ file: {:s}", str(e))
+				sys.exit(1)
+
+			if len(self.data) > self.size_limit:
+				log.error("Decompressed VGZ is larger than the size limit ({:X} bytes)", self.size_limit)
+				sys.exit(1)
+
+	def next_member(self):
+		# Compressed data starting at the next gzip member, or None if there isn't one
+		# Zero padding after a member is skipped and anything else that isn't a member is ignored
+		trailing = self.decompressor.unused_data
+		while True:
+			trailing = trailing.lstrip(b'\0')
+			if len(trailing) >= len(GZIP_MAGIC):
+				break
+
+			more = self.file.read(VGZDecompressor.CHUNK_SIZE)
+			if not more:
+				if trailing:
+					log.info("Ignoring trailing data after VGZ stream")
+				return None
+
+			trailing += more
+
+		if not trailing.startswith(GZIP_MAGIC):
+			log.info("Ignoring trailing data after VGZ stream")
+			return None
+
+		return trailing
+
+	def header(self, length=0x100):
+		self.fill(length)
+		return bytes(self.data[0 : length])
+
+	def read_all(self):
+		self.fill()
+		return self.data
 
 class VGMReader:
+	DEFAULT_SIZE_LIMIT = 256 * 1024 * 1024
+
 	@staticmethod
-	def read(vgm_path):
-		vgm = None
+	def read(vgm_path, size_limit=DEFAULT_SIZE_LIMIT):
+		# Returns a buffer with the uncompressed VGM: an mmap for .vgm files and a bytearray for .vgz files
+		with open(vgm_path, 'rb') as file:
+			is_gzip = (file.read(len(GZIP_MAGIC)) == GZIP_MAGIC)
+			file.seek(0)
+
+			if is_gzip:
+				vgz = VGZDecompressor(file, size_limit)
+				VGMReader.check_header(vgz.header(), vgm_path)
+				return vgz.read_all()
+
+			size = os.fstat(file.fileno()).st_size
+			if size > size_limit:
+				log.error("VGM is larger than the size limit ({:X} bytes)", size_limit)
+				sys.exit(1)
 
-		try:
-			with gzip.open(vgm_path, 'rb') as file:
-				vgm = file.read()
-		except gzip.BadGzipFile:
-			with open(vgm_path, 'rb') as file:
-				vgm = file.read()
+			if size == 0:
+				VGMReader.check_header(b'', vgm_path)
 
-		return vgm
+			# The mapping stays valid after the file is closed
+			vgm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+			VGMReader.check_header(vgm[0 : len(VGM_MAGIC)], vgm_path)
+			return vgm
+
+	@staticmethod
+	def check_header(header, vgm_path):
+		if header[0 : len(VGM_MAGIC)] != VGM_MAGIC:
+			log.error("Not a VGM file: {:s}", str(vgm_path))
+			sys.exit(1)
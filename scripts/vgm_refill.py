@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# vgm_refill.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Metrics for the VGM buffer refills requested by the firmware during playback
+#
+# The firmware plays from two 8KB buffers (A and B, see fw/ym2610/vgm.c) and requests a refill of one
+# when it starts reading the other, so each refill has to be written before the other buffer is played through
+# That time budget depends on how dense the commands are, so it's found from the delays in the VGM itself
+#
+# Refill latency is measured from receiving the request to the end of the write
+# Refills that take longer than their budget are counted as likely underruns
+#
+# The requested windows are predictable from the track's loop offset, so RefillChunkTable prepares them when the track
+# is loaded and a refill only has to look its window up and write it
+
+import sys
+import json
+import time
+import bisect
+from array import array
+
+from vgm_commands import COMMAND_LENGTHS
+from vgm_commands import command_length
+from usb_upload import VGM_BUFFER_SIZE
+from usb_upload import usb_buffer
+from usb_upload import write_mode_payload
+
+SAMPLE_RATE = 44100
+
+# Firmware buffer layout (fw/ym2610/vgm.c)
+BUFFER_SIZE = 0x2000
+BUFFER_LOOP_OFFSET = 0x12000
+BUFFER_A_OFFSET = 0x14000
+BUFFER_B_OFFSET = 0x16000
+
+def _build_command_delays():
+	# Samples waited by each delay command, 0x61 is read from its operand
+	delays = [0] * 0x100
+	for cmd in range(0x70, 0x80):
+		delays[cmd] = (cmd & 0x0f) + 1
+
+	delays[0x62] = 735
+	delays[0x63] = 882
+
+	return delays
+
+COMMAND_DELAYS = _build_command_delays()
+
+class VGMTimeline:
+	# Playback time at each delay command in a VGM, to find how long a range of its data takes to play
+	def __init__(self, vgm_data):
+		# Offset after each delay and the total samples played by then
+		self.offsets = array('Q')
+		self.samples = array('Q')
+
+		self.start_offset = self.header_offset(vgm_data, 0x34) or 0x40
+		self.loop_offset = self.header_offset(vgm_data, 0x1c)
+		gd3_offset = self.header_offset(vgm_data, 0x14)
+		end_offset = gd3_offset if gd3_offset > 0 else len(vgm_data)
+
+		samples = 0
+		index = self.start_offset
+		while index < end_offset:
+			cmd = vgm_data[index]
+
+			length = COMMAND_LENGTHS[cmd]
+			if length is None:
+				break
+			elif length == 0:
+				length = command_length(vgm_data, index)
+
+			delay = COMMAND_DELAYS[cmd]
+			if cmd == 0x61:
+				delay = vgm_data[index + 1] | vgm_data[index + 2] << 8
+
+			index += length
+
+			if delay > 0:
+				samples += delay
+				self.offsets.append(index)
+				self.samples.append(samples)
+
+	@staticmethod
+	def header_offset(vgm_data, header_index):
+		if len(vgm_data) < header_index + 4:
+			return 0
+
+		offset = int.from_bytes(vgm_data[header_index : header_index + 4], 'little')
+		return header_index + offset if offset > 0 else 0
+
+	def samples_at(self, offset):
+		# Samples played once playback reaches offset
+		index = bisect.bisect_right(self.offsets, offset) - 1
+		return self.samples[index] if index >= 0 else 0
+
+	def duration(self, start, end):
+		# Seconds taken to play the data from start to end
+		return (self.samples_at(end) - self.samples_at(start)) / SAMPLE_RATE
+
+	def refill_budget(self, buffer_target_offset, vgm_start_offset, vgm_chunk_length):
+		# Seconds until the firmware reads the buffer being refilled, or None if it isn't needed soon
+		if buffer_target_offset == BUFFER_LOOP_OFFSET:
+			# Loop start region, only read once the end of the track is reached
+			return None
+
+		if vgm_chunk_length > BUFFER_SIZE:
+			# Both A and B after looping, needed once the data before buffer A is played
+			if self.loop_offset > 0 and vgm_start_offset != BUFFER_A_OFFSET:
+				# From the loop buffer
+				return self.duration(self.loop_offset, self.loop_offset + BUFFER_SIZE)
+
+			restart_offset = self.loop_offset if self.loop_offset > 0 else self.start_offset
+			return self.duration(restart_offset, BUFFER_A_OFFSET)
+
+		# Streaming, needed once the other buffer (the data before this chunk) is played
+		return self.duration(vgm_start_offset - BUFFER_SIZE, vgm_start_offset)
+
+class RefillChunkTable:
+	# Each window the firmware is expected to request, keyed by (buffer target, VGM offset, length)
+	# Entries are the SET_WRITE_MODE payload and an array('B') of the window, which pyusb writes without converting
+	#
+	# Requested windows (fw/ym2610/vgm.c):
+	# Streaming from the start: 8KB from VGM_BUFFER_SIZE on, alternating between buffers A and B
+	# The loop buffer: 8KB from the loop offset, requested once buffer A is first reached
+	# End of the track: 16KB for buffers A and B, from after the loop buffer or from buffer A if it wasn't loaded
+	# Streaming after looping with the loop buffer: 8KB from 24KB after the loop offset, starting with buffer A
+	# Anything else (such as a skipped request) misses and is sliced from the data as it's requested
+	def __init__(self, vgm_data):
+		self.windows = {}
+
+		loop_offset = VGMTimeline.header_offset(vgm_data, 0x1c)
+		view = memoryview(vgm_data)
+
+		self.add_stream(view, VGM_BUFFER_SIZE, BUFFER_A_OFFSET)
+		self.add(view, BUFFER_A_OFFSET, BUFFER_A_OFFSET, BUFFER_SIZE * 2)
+
+		if loop_offset > 0:
+			self.add(view, BUFFER_LOOP_OFFSET, loop_offset, BUFFER_SIZE)
+			self.add(view, BUFFER_A_OFFSET, loop_offset + BUFFER_SIZE, BUFFER_SIZE * 2)
+			self.add_stream(view, loop_offset + BUFFER_SIZE * 3, BUFFER_A_OFFSET)
+
+	def add_stream(self, view, start, first_target):
+		targets = (first_target, BUFFER_B_OFFSET if first_target == BUFFER_A_OFFSET else BUFFER_A_OFFSET)
+		for (index, offset) in enumerate(range(start, len(view), BUFFER_SIZE)):
+			self.add(view, targets[index % 2], offset, BUFFER_SIZE)
+
+	def add(self, view, target, offset, length):
+		window = view[offset : offset + length]
+		if len(window) > 0:
+			self.windows[(target, offset, length)] = (write_mode_payload(len(window), target), usb_buffer(window))
+
+	def lookup(self, request):
+		# (payload, buffer) for the request, or None if it wasn't prepared
+		return self.windows.get((request.buffer_target_offset, request.vgm_start_offset, request.vgm_chunk_length))
+
+class Histogram:
+	def __init__(self, bounds):
+		# Upper bounds (inclusive) of each bucket, values above the last go in an overflow bucket
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.count = 0
+		self.total = 0
+		self.max = None
+
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		self.max = value if self.max is None else max(self.max, value)
+
+	def percentile(self, fraction):
+		# Upper bound of the bucket holding the given fraction of values (the max for the overflow bucket)
+		threshold = fraction * self.count
+		seen = 0
+		for (index, count) in enumerate(self.counts):
+			seen += count
+			if count > 0 and seen >= threshold:
+				return self.bounds[index] if index < len(self.bounds) else self.max
+
+		return None
+
+	def summary(self):
+		labels = ["<={:g}".format(bound) for bound in self.bounds] + [">{:g}".format(self.bounds[-1])]
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count > 0 else None,
+			'max': self.max,
+			'p50': self.percentile(0.5),
+			'p99': self.percentile(0.99),
+			'buckets': {label: count for (label, count) in zip(labels, self.counts) if count > 0}
+		}
+
+class RefillMetrics:
+	LATENCY_BOUNDS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+	BYTES_BOUNDS = [0x400, 0x1000, BUFFER_SIZE, BUFFER_SIZE * 2]
+	GAP_BOUNDS = [1, 2, 4, 16, 256]
+
+	# Underruns listed in each summary
+	UNDERRUN_DETAILS = 8
+
+	def __init__(self):
+		self.reset()
+		self.total_requests = 0
+		self.total_underruns = 0
+
+	def reset(self):
+		self.started_at = time.monotonic()
+		self.latency_ms = Histogram(RefillMetrics.LATENCY_BOUNDS_MS)
+		self.refill_bytes = Histogram(RefillMetrics.BYTES_BOUNDS)
+		self.sequence_gaps = Histogram(RefillMetrics.GAP_BOUNDS)
+		self.min_margin_ms = None
+		self.underrun_count = 0
+		self.underruns = []
+		# Refills that weren't found in the RefillChunkTable
+		self.table_misses = 0
+
+	def record_refill(self, request, latency, length, budget):
+		self.total_requests += 1
+		self.latency_ms.add(latency * 1000)
+		self.refill_bytes.add(length)
+
+		if budget is None:
+			return
+
+		margin_ms = (budget - latency) * 1000
+		self.min_margin_ms = margin_ms if self.min_margin_ms is None else min(self.min_margin_ms, margin_ms)
+
+		if margin_ms < 0:
+			self.underrun_count += 1
+			self.total_underruns += 1
+			if len(self.underruns) < RefillMetrics.UNDERRUN_DETAILS:
+				self.underruns.append({
+					'vgm_offset': request.vgm_start_offset,
+					'latency_ms': latency * 1000,
+					'budget_ms': budget * 1000
+				})
+
+	def record_table_miss(self):
+		self.table_misses += 1
+
+	def record_sequence_gap(self, expected, received):
+		# Requests that were missed, or counted from an earlier playback if the counter went backwards
+		self.sequence_gaps.add((received - expected) & 0xffffff)
+
+	def summary(self):
+		return {
+			'interval': time.monotonic() - self.started_at,
+			'requests': self.latency_ms.count,
+			'underruns': self.underrun_count,
+			'total_requests': self.total_requests,
+			'total_underruns': self.total_underruns,
+			'min_margin_ms': self.min_margin_ms,
+			'table_misses': self.table_misses,
+			'latency_ms': self.latency_ms.summary(),
+			'refill_bytes': self.refill_bytes.summary(),
+			'sequence_gaps': self.sequence_gaps.summary(),
+			'underrun_details': self.underruns
+		}
+
+class MetricsReporter:
+	# Writes a summary of the metrics as a JSON line every interval seconds, then starts a new interval
+	def __init__(self, metrics, path, interval):
+		self.metrics = metrics
+		self.path = path
+		self.interval = interval
+		self.next_report = time.monotonic() + interval
+
+	def update(self, **fields):
+		now = time.monotonic()
+		if now < self.next_report:
+			return
+
+		self.next_report = now + self.interval
+		self.report(**fields)
+
+	def report(self, **fields):
+		summary = dict(fields)
+		summary.update(self.metrics.summary())
+		line = json.dumps(summary) + '\n'
+
+		if self.path == '-':
+			sys.stdout.write(line)
+			sys.stdout.flush()
+		else:
+			with open(self.path, 'a') as file:
+				file.write(line)
+
+		self.metrics.reset()
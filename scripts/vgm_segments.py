@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# vgm_segments.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Output VGM built as a list of segments rather than one contiguous buffer
+#
+# Segments are kept by reference (PCM data and GD3 are views of the input, never copied)
+# Content can be inserted later at an insertion point, and anything that depends on final positions
+# (header offsets) is recorded as a relocation that's only resolved when serializing
+# Bytes that are translated through a table (bank bytes) are recorded in bulk, per segment
+#
+# Segments can optionally be spooled to a file so that memory use doesn't grow with the output
+
+class VGMMark:
+	def __init__(self, segment_list, segment_index, offset):
+		self.segment_list = segment_list
+		self.segment_index = segment_index
+		self.offset = offset
+
+class SpooledSegment:
+	def __init__(self, spool, offset, length):
+		self.spool = spool
+		self.offset = offset
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+	def read(self):
+		self.spool.seek(self.offset)
+		return self.spool.read(self.length)
+
+class VGMSegmentList:
+	def __init__(self, spool=None):
+		self.segments = []
+		self.spool = spool
+		self.relocations = []
+		self.byte_remaps = []
+
+	def __len__(self):
+		return sum(len(segment) for segment in self.segments)
+
+	def append(self, data, spooled=False):
+		# Spooled segments are written out immediately so the caller's buffer can be released
+		if spooled and self.spool is not None:
+			self.spool.seek(0, 2)
+			offset = self.spool.tell()
+			self.spool.write(data)
+			data = SpooledSegment(self.spool, offset, len(data))
+
+		self.segments.append(data)
+
+	def insertion_point(self):
+		# Returns an empty segment list that's serialized at the current position
+		# It can be appended to at any time before serializing
+		child = VGMSegmentList(self.spool)
+		self.segments.append(child)
+		return child
+
+	def mark(self, offset=0):
+		# Marks a position in the segment that will be appended next
+		return VGMMark(self, len(self.segments), offset)
+
+	def relocate(self, mark, resolve):
+		# The byte(s) at mark are replaced by resolve(position) when serialized
+		# position(mark) gives the final index of any other mark in the output
+		self.relocations.append((mark, resolve))
+
+	def remap_bytes(self, mark, offsets, table):
+		# Each byte at (mark + offset) is replaced by table[byte] when serialized
+		# The table can be filled in any time before then
+		self.byte_remaps.append((mark, offsets, table))
+
+	# Serialization:
+
+	def flatten(self):
+		for (index, segment) in enumerate(self.segments):
+			if isinstance(segment, VGMSegmentList):
+				yield from segment.flatten()
+			else:
+				yield (self, index, segment)
+
+	def collect_relocations(self):
+		relocations = list(self.relocations)
+		for segment in self.segments:
+			if isinstance(segment, VGMSegmentList):
+				relocations.extend(segment.collect_relocations())
+
+		return relocations
+
+	def collect_byte_remaps(self):
+		byte_remaps = list(self.byte_remaps)
+		for segment in self.segments:
+			if isinstance(segment, VGMSegmentList):
+				byte_remaps.extend(segment.collect_byte_remaps())
+
+		return byte_remaps
+
+	def segment_positions(self):
+		positions = {}
+		position = 0
+
+		def visit(segment_list):
+			nonlocal position
+
+			for (index, segment) in enumerate(segment_list.segments):
+				positions[(id(segment_list), index)] = position
+				if isinstance(segment, VGMSegmentList):
+					visit(segment)
+				else:
+					position += len(segment)
+
+			# Marks can also refer to the end of a list
+			positions[(id(segment_list), len(segment_list.segments))] = position
+
+		visit(self)
+		return positions
+
+	def position_resolver(self):
+		# Returns position(mark), giving the final index of a mark in the serialized output
+		positions = self.segment_positions()
+
+		def position(mark):
+			return positions[(id(mark.segment_list), mark.segment_index)] + mark.offset
+
+		return position
+
+	def chunks(self):
+		# Yields the serialized output in order, with all relocations applied
+		position = self.position_resolver()
+
+		patches = {}
+		for (mark, resolve) in self.collect_relocations():
+			key = (id(mark.segment_list), mark.segment_index)
+			patches.setdefault(key, []).append((mark.offset, resolve(position)))
+
+		byte_remaps = {}
+		for (mark, offsets, table) in self.collect_byte_remaps():
+			key = (id(mark.segment_list), mark.segment_index)
+			byte_remaps.setdefault(key, []).append((mark.offset, offsets, table))
+
+		for (segment_list, index, segment) in self.flatten():
+			data = segment.read() if isinstance(segment, SpooledSegment) else segment
+
+			key = (id(segment_list), index)
+			segment_patches = patches.get(key)
+			segment_byte_remaps = byte_remaps.get(key)
+
+			if segment_patches is not None or segment_byte_remaps is not None:
+				# Buffers owned by the segment list are patched in place, anything else is copied first
+				# Byte remaps aren't idempotent, so those are always applied to a copy
+				if segment_byte_remaps is not None or not isinstance(data, bytearray):
+					data = bytearray(data)
+
+				for (offset, patch) in segment_patches or []:
+					data[offset : offset + len(patch)] = patch
+
+				for (base_offset, offsets, table) in segment_byte_remaps or []:
+					for offset in offsets:
+						data[base_offset + offset] = table[data[base_offset + offset]]
+
+			yield data
+
+	def write_to(self, file):
+		for chunk in self.chunks():
+			file.write(chunk)
+
+	def to_bytearray(self):
+		data = bytearray()
+		for chunk in self.chunks():
+			data.extend(chunk)
+
+		return data
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# vgm_synth.py
+#
+# Copyright (C) 2021 Dan Rodrigues <danrr.gh.oss@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+# Deterministic synthetic VGMs for benchmarking the conversion pipeline
+#
+# These aren't meant to sound like anything, only to have the same command mix as real tracks:
+# YM2610 tracks with ADPCM-A/B blocks (unified or overlapping address spaces) and bank register writes,
+# and YM2612 + SN76489 tracks with dense FM writes and DAC streams (0xE0 seeks followed by 0x8n writes)
+#
+# The same arguments always produce the same VGM
+
+import random
+
+SAMPLE_RATE = 44100
+FRAME_SAMPLES = 735
+
+YM2610B_CLOCK = 8000000
+YM2612_CLOCK = 7670453
+SN76489_CLOCK = 3579545
+
+def header(clocks):
+	data = bytearray(0x100)
+	data[0x00 : 0x04] = b'Vgm '
+	data[0x08 : 0x0c] = (0x171).to_bytes(4, 'little')
+	data[0x34 : 0x38] = (0x100 - 0x34).to_bytes(4, 'little')
+
+	for (index, clock) in clocks.items():
+		data[index : index + 4] = clock.to_bytes(4, 'little')
+
+	return data
+
+def finish(data, loop_index, total_samples):
+	# Adds the end of stream command, GD3 and the header offsets
+	data.append(0x66)
+
+	gd3_index = len(data)
+	data.extend(b'Gd3 ')
+	data.extend((0x100).to_bytes(4, 'little'))
+	data.extend((4).to_bytes(4, 'little'))
+	data.extend(bytes(4))
+
+	data[0x04 : 0x08] = (len(data) - 0x04).to_bytes(4, 'little')
+	data[0x14 : 0x18] = (gd3_index - 0x14).to_bytes(4, 'little')
+	data[0x18 : 0x1c] = total_samples.to_bytes(4, 'little')
+	data[0x1c : 0x20] = (loop_index - 0x1c).to_bytes(4, 'little')
+
+	return data
+
+def data_block(data, block_type, payload):
+	data.extend([0x67, 0x66, block_type])
+	data.extend(len(payload).to_bytes(4, 'little'))
+	data.extend(payload)
+
+def pcm_block(data, block_type, offset, total_size, payload):
+	data.extend([0x67, 0x66, block_type])
+	data.extend((len(payload) + 8).to_bytes(4, 'little'))
+	data.extend(total_size.to_bytes(4, 'little'))
+	data.extend(offset.to_bytes(4, 'little'))
+	data.extend(payload)
+
+def delay(data, samples):
+	while samples > 0:
+		step = min(samples, 0xffff)
+		data.append(0x61)
+		data.extend(step.to_bytes(2, 'little'))
+		samples -= step
+
+def ym2610_vgm(duration=60, pcm_size=0x100000, overlap=False, seed=1):
+	# YM2610B track with pcm_size bytes of ADPCM-A and B blocks
+	# If overlap is set, both types start at offset 0 (separate address spaces), otherwise they're in one space
+	rng = random.Random(seed)
+	data = header({0x4c: YM2610B_CLOCK | (1 << 31)})
+
+	block_size = 0x8000
+	block_count = max(pcm_size // block_size, 2)
+	a_count = block_count * 3 // 4
+	b_count = block_count - a_count
+
+	# Blocks are spread out with gaps so the packer has something to do
+	blocks = []
+	offset = 0
+	for _ in range(a_count):
+		blocks.append((0x82, offset))
+		offset += block_size * rng.choice([1, 1, 2, 3])
+
+	offset = 0 if overlap else (offset + 0xfffff) & ~0xfffff
+	for _ in range(b_count):
+		blocks.append((0x83, offset))
+		offset += block_size * rng.choice([1, 2])
+
+	total_size = 0x1000000
+	for (block_type, offset) in blocks:
+		pcm_block(data, block_type, offset, total_size, rng.randbytes(block_size))
+
+	a_banks = [offset >> 16 for (block_type, offset) in blocks if block_type == 0x82]
+	b_banks = [offset >> 16 for (block_type, offset) in blocks if block_type == 0x83]
+
+	loop_index = len(data)
+	frames = int(duration * SAMPLE_RATE) // FRAME_SAMPLES
+
+	for frame in range(frames):
+		# FM
+		for _ in range(rng.randrange(4, 12)):
+			data.extend([0x58 | rng.randrange(2), rng.randrange(0x30, 0xb7), rng.randrange(0x100)])
+
+		# ADPCM-A trigger
+		if rng.randrange(4) == 0:
+			channel = rng.randrange(6)
+			bank = rng.choice(a_banks)
+			data.extend([0x59, 0x10 + channel, 0x00, 0x59, 0x18 + channel, bank])
+			data.extend([0x59, 0x20 + channel, 0x7f, 0x59, 0x28 + channel, bank])
+			data.extend([0x59, 0x00, 1 << channel])
+
+		# ADPCM-B trigger
+		if rng.randrange(8) == 0:
+			bank = rng.choice(b_banks)
+			data.extend([0x58, 0x12, 0x00, 0x58, 0x13, bank, 0x58, 0x14, 0x7f, 0x58, 0x15, bank])
+			data.extend([0x58, 0x10, 0x80])
+
+		data.append(0x62)
+
+	return finish(data, loop_index, frames * FRAME_SAMPLES)
+
+def ym2612_vgm(duration=60, psg=True, dac_density=0.5, seed=2):
+	# YM2612 (+ SN76489) track with dense FM writes and DAC streams
+	# dac_density is the fraction of frames that have DAC samples playing
+	rng = random.Random(seed)
+
+	clocks = {0x2c: YM2612_CLOCK}
+	if psg:
+		clocks[0x0c] = SN76489_CLOCK
+
+	data = header(clocks)
+
+	# DAC data bank: a handful of drum-like decaying waveforms
+	sample_starts = []
+	dac_bank = bytearray()
+	for sample in range(8):
+		sample_starts.append(len(dac_bank))
+		period = 12 + sample * 5
+		length = 0x1000 + sample * 0x600
+		for index in range(length):
+			amplitude = 100 * (length - index) // length
+			level = amplitude if (index % period) < (period // 2) else -amplitude
+			dac_bank.append(0x80 + level + rng.randrange(-4, 5))
+
+	data_block(data, 0x00, dac_bank)
+
+	loop_index = len(data)
+	frames = int(duration * SAMPLE_RATE) // FRAME_SAMPLES
+
+	dac_position = None
+	dac_end = 0
+
+	for frame in range(frames):
+		# FM: pitch updates (hi before lo) and operator writes on both ports
+		for _ in range(rng.randrange(6, 16)):
+			port = rng.randrange(2)
+			channel = rng.randrange(3)
+			data.extend([0x52 + port, 0xa4 + channel, rng.randrange(0x40)])
+			data.extend([0x52 + port, 0xa0 + channel, rng.randrange(0x100)])
+			data.extend([0x52 + port, rng.randrange(0x30, 0xa0), rng.randrange(0x100)])
+
+		data.extend([0x52, 0x28, rng.randrange(0x100) & 0xf7])
+
+		# PSG: tone and volume latches
+		if psg:
+			for _ in range(rng.randrange(2, 6)):
+				channel = rng.randrange(3)
+				data.extend([0x50, 0x80 | (channel << 5) | rng.randrange(0x10), 0x50, rng.randrange(0x40)])
+				data.extend([0x50, 0x90 | (channel << 5) | rng.randrange(0x10)])
+
+		# DAC: the frame is played as a stream of 0x8n writes, otherwise it's one delay
+		if dac_position is None and rng.random() < dac_density:
+			sample = rng.randrange(len(sample_starts))
+			dac_position = sample_starts[sample]
+			dac_end = dac_position + 0x1000 + sample * 0x600
+
+			data.extend([0x52, 0x2b, 0x80])
+			data.append(0xe0)
+			data.extend(dac_position.to_bytes(4, 'little'))
+
+		if dac_position is not None:
+			wait = rng.choice([2, 3, 4])
+			count = min(FRAME_SAMPLES // wait, dac_end - dac_position)
+			data.extend(bytes([0x80 | wait]) * count)
+			dac_position += count
+
+			delay(data, FRAME_SAMPLES - count * wait)
+
+			if dac_position >= dac_end:
+				data.extend([0x52, 0x2a, 0x80])
+				dac_position = None
+		else:
+			data.append(0x62)
+
+	return finish(data, loop_index, frames * FRAME_SAMPLES)
+
+# Benchmark corpus: name -> function(scale) returning a VGM
+# scale 1 is roughly a 30 second track
+CORPUS = {
+	'ym2610_unified': lambda scale: ym2610_vgm(duration=30 * scale, pcm_size=0x80000 * scale, overlap=False),
+	'ym2610_overlap': lambda scale: ym2610_vgm(duration=30 * scale, pcm_size=0x80000 * scale, overlap=True),
+	'ym2612_fm_psg': lambda scale: ym2612_vgm(duration=30 * scale, psg=True, dac_density=0.0),
+	'ym2612_dac': lambda scale: ym2612_vgm(duration=30 * scale, psg=False, dac_density=0.8)
+}
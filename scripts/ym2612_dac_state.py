@@ -7,39 +7,172 @@
 # SPDX-License-Identifier: MIT
 
 import wave
+import bisect
+
+from sample_kernels import dac_to_s16_bytes
+from vgm_profile import log
+
+class DACRun:
+	def __init__(self, value, length):
+		self.value = value
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+class DACTimeline:
+	# DAC output, one value per output sample, for the length of the track
+	#
+	# Stored as a list of spans which are either literal samples (bytearray) or a DACRun of one repeated value
+	# Any RUN_THRESHOLD or more consecutive equal samples always end up in a single DACRun,
+	# so idle periods cost the same regardless of their length and literal spans only hold actual DAC audio
+
+	RUN_THRESHOLD = 64
+
+	def __init__(self):
+		self.spans = []
+		self.span_starts = []
+		self.length = 0
+		# Number of equal samples at the very end of the timeline
+		self.tail_repeat = 0
+
+	def __len__(self):
+		return self.length
+
+	def last_sample(self, default=0):
+		if not self.spans:
+			return default
+
+		span = self.spans[-1]
+		return span.value if isinstance(span, DACRun) else span[-1]
+
+	def append(self, value, count):
+		if count == 0:
+			return
+
+		tail = self.spans[-1] if self.spans else None
+		repeat = count + (self.tail_repeat if (tail is not None and self.last_sample() == value) else 0)
+
+		if isinstance(tail, DACRun) and tail.value == value:
+			tail.length += count
+			self.length += count
+		elif repeat >= DACTimeline.RUN_THRESHOLD:
+			# Equal samples already at the end of a literal span are moved into the new run
+			moved = repeat - count
+			if moved > 0:
+				del tail[-moved:]
+				self.length -= moved
+				if len(tail) == 0:
+					self.pop_span()
+
+			self.push_span(DACRun(value, repeat))
+		elif isinstance(tail, bytearray):
+			tail.extend(bytes([value]) * count)
+			self.length += count
+		else:
+			self.push_span(bytearray([value]) * count)
+
+		self.tail_repeat = repeat
+
+	def replace_last(self, value):
+		# Replaces the final sample, if there is one
+		if not self.spans:
+			return
+
+		tail = self.spans[-1]
+		if isinstance(tail, DACRun):
+			tail.length -= 1
+			if tail.length == 0:
+				self.pop_span()
+		else:
+			del tail[-1]
+			if len(tail) == 0:
+				self.pop_span()
+
+		self.length -= 1
+		self.tail_repeat = self.count_tail_repeat()
+		self.append(value, 1)
+
+	def count_tail_repeat(self):
+		if not self.spans:
+			return 0
+
+		tail = self.spans[-1]
+		if isinstance(tail, DACRun):
+			return tail.length
+
+		# Literal spans never end with RUN_THRESHOLD or more equal samples
+		value = tail[-1]
+		repeat = 1
+		while repeat < len(tail) and tail[-1 - repeat] == value:
+			repeat += 1
+
+		return repeat
+
+	def push_span(self, span):
+		self.span_starts.append(self.length)
+		self.spans.append(span)
+		self.length += len(span)
+
+	def pop_span(self):
+		span = self.spans.pop()
+		self.span_starts.pop()
+		self.length -= len(span)
+
+	def samples(self, start, end):
+		# Explicit samples in start..<end
+		samples = bytearray()
+
+		span_index = max(bisect.bisect_right(self.span_starts, start) - 1, 0)
+		while span_index < len(self.spans) and start < end:
+			span = self.spans[span_index]
+			span_start = self.span_starts[span_index]
+			span_end = min(span_start + len(span), end)
+
+			if isinstance(span, DACRun):
+				samples.extend(bytes([span.value]) * (span_end - start))
+			else:
+				samples.extend(span[start - span_start : span_end - span_start])
+
+			start = span_end
+			span_index += 1
+
+		return samples
 
 class YM2612DACState:
 	def __init__(self, seek_logging=False):
 		self.data_bank = bytearray()
-		self.logged_samples = bytearray()
+		self.timeline = DACTimeline()
 		self.index = 0
 		self.seek_logging = seek_logging
 
 	def extend_data_bank(self, data):
-		self.data_bank.extend(data)
-		print("Extended DAC data bank size: {:X}".format(len(self.data_bank)))
+		# The first block is kept as a view of the input, it's only copied once another block is added
+		if not self.data_bank:
+			self.data_bank = data
+		else:
+			if not isinstance(self.data_bank, bytearray):
+				self.data_bank = bytearray(self.data_bank)
+
+			self.data_bank.extend(data)
+
+		log.debug("Extended DAC data bank size: {:X}", len(self.data_bank))
 
 	def seek(self, index):
 		self.index = index
 
 		if self.seek_logging:
-			print("DAC seek to: {:X}".format(index))
+			log.debug("DAC seek to: {:X}", index)
 
 	def set_output(self, data):
-		self.logged_samples[-1] = data
+		self.timeline.replace_last(data)
 
 	def output_data_bank_sample(self, delay):
 		sample = self.read_sample()
-		self.logged_samples.extend([sample] * delay)
-
-	def pad_output(self, data, alignment, padding_byte=0x80):
-		remainder = len(data) % alignment
-		if remainder > 0:
-			 data.extend([padding_byte] * (alignment - remainder))
+		self.timeline.append(sample, delay)
 
 	def delay(self, count):
-		sample = 0 if len(self.logged_samples) == 0 else self.logged_samples[-1]
-		self.logged_samples.extend([sample] * count)
+		self.timeline.append(self.timeline.last_sample(), count)
 
 	def read_sample(self):
 		sample = self.data_bank[self.index]
@@ -48,42 +181,21 @@ class YM2612DACState:
 
 	### 
 
-	def parition_blocks(self):
-		index = 0
-
-		blocks = []
-		current_block = None
+	def parition_blocks(self, segmenter):
+		# Blocks of DAC samples separated by silence (see DACSegmenter)
+		blocks = segmenter.partition(self.timeline)
 
-		while True:
-			# Find range of silence
-			silence_indexes = self.scan_silence(index)
-			if silence_indexes is None:
-				# !!! need to terminate the last one?
-				break
-
-			index = silence_indexes[1]
-
-			if current_block is not None:
-				# ..terminate the current sample block if there was one..
-				current_block.data = self.logged_samples[current_block.timestamp : silence_indexes[0]]
-				self.pad_output(current_block.data, alignment=0x200)
-				blocks.append(current_block)
-
-			# ..then a new sample block starts where the previous one ended
-			current_block = DACSampleBlock()
-			current_block.timestamp = silence_indexes[1]
-
-		print("Created {:X} DAC sample blocks".format(len(blocks)))
+		log.info("Created {:X} DAC sample blocks", len(blocks))
 		total_length = 0
 		for block in blocks:
 			total_length += len(block.data)
-		print("Total length {:X}".format(total_length))
+		log.info("Total length {:X}", total_length)
 
 		return blocks
 
 	def write_wav(self):
 		with wave.open('out.wav', 'wb') as file:
-			self.write_wav_data(file, self.logged_samples)
+			self.write_wav_data(file, self.timeline.samples(0, len(self.timeline)))
 
 	def write_wav_blocks(self, blocks):
 		with wave.open('out_blocks.wav', 'wb') as file:
@@ -98,37 +210,7 @@ class YM2612DACState:
 		file.setsampwidth(2)
 		file.setframerate(44100)
 
-		pcm_s16 = map(lambda x: (x - 0x80) * 0x100, data)
-		pcm_bytes = bytearray()
-		for sample in pcm_s16:
-			pcm_bytes.append(sample & 0xff)
-			pcm_bytes.append((sample >> 8) & 0xff)
-
-		file.writeframes(pcm_bytes)
-
-	def scan_silence(self, index):
-		consecutive = 0
-		prev = 0
-
-		start_index = index
-
-		while index < len(self.logged_samples):
-			sample = self.logged_samples[index]
-
-			if sample == prev:
-				consecutive += 1
-			else:
-				if consecutive >= 512:
-					print("found silence in {:X} samples".format(consecutive))
-					return (start_index, index)
-
-				consecutive = 0
-				start_index = index
-
-			prev = sample
-			index += 1
-
-		return None
+		file.writeframes(dac_to_s16_bytes(data))
 
 class DACSampleBlock:
 	def __init__(self):